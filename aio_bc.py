@@ -1,33 +1,54 @@
 # aio_bc_final.py
 # Panel Bot (python-telegram-bot) + Ubot Sender (Pyrogram) dalam 1 file
 # Fitur:
-# - /setmsg simpan teks + entities (termasuk custom/premium emoji)
+# - /setmsg simpan teks + entities (termasuk custom/premium emoji) atau 1 media + caption (upload sekali, file_id dipakai ulang)
 # - whitelist dengan thread_key (-1 = non-topic, selain itu = topic id)
 # - /adddest /unwhitelist /blacklist /unblacklist bisa dipakai langsung di grup/topic (paling akurat)
 # - fallback forward kalau command dipakai di private
-# - /status + /listdest + /listblack
+# - /status + /listdest + /listblack + /stats (riwayat kirim)
 # - /enable /disable
 # - /force (blast sekali semua whitelist) + /forcehere (blast sekali di chat/topic tempat command)
 # - safe_send max_retry + auto-remove dest yang error permanen biar gak nyangkut
+# - import per mode: panel gak load Pyrogram, ubot gak load PTB (cold start cepet)
+# - panel & sender proses terpisah (mode both = panel + child sender), ngobrol lewat tabel jobs
+# - panel proses update paralel antar user, tapi tetap urut per user
+
+from __future__ import annotations
+
+import time
+_BOOT = time.perf_counter()
 
 import asyncio
+import csv
+import io
 import json
 import sqlite3
-import time
+import threading
 import os
+import queue
+import heapq
+import signal
+import socket
+import hashlib
+import logging
+import logging.handlers
+import sys
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from pathlib import Path
-from typing import Optional, List, Tuple, Set
+from typing import Optional, List, Tuple, Set, Dict, TYPE_CHECKING
 
-from telegram import Update
-from telegram.ext import (
-    Application, CommandHandler, MessageHandler,
-    ContextTypes, filters
-)
-
-from pyrogram import Client
-from pyrogram.errors import FloodWait, SlowmodeWait, RPCError
-from pyrogram.types import MessageEntity
+# PTB & Pyrogram di-import di dalam fungsi yang butuh (lihat run_panel / UbotManager /
+# build_entities / safe_send), di sini cuma buat type hint
+if TYPE_CHECKING:
+    from telegram import Update, InlineKeyboardButton
+    from telegram.ext import Application, ContextTypes
+    from pyrogram import Client
+    from pyrogram.types import MessageEntity
 
 # =======================
 # LOAD .env (TARUH DI SINI)
@@ -63,9 +84,110 @@ DEFAULT_DELAY_SEC = float(os.getenv("DEFAULT_DELAY_SEC", "5"))
 
 PYRO_SESSION_NAME = os.getenv("PYRO_SESSION_NAME", "userbot")
 
+# =======================
+# LOGGING (JSON 1 baris per event, nulis di thread listener)
+# =======================
+# Handler di event loop cuma QueueHandler (put ke queue, gak nyentuh stdout);
+# QueueListener yang format + nulis di thread sendiri -> journald gak bikin loop nunggu.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# event sukses yang volumenya gede (send ok) cuma dicatat 1 dari N
+LOG_OK_EVERY = max(1, int(os.getenv("LOG_OK_EVERY", "100")))
+
+log = logging.getLogger("aio_bc")
+_log_listener: Optional[logging.handlers.QueueListener] = None
+_sample_counts: Dict[str, int] = {}
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "event": record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            data.update((k, v) for k, v in fields.items() if v is not None)
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+class _LogQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # bawaan: format di sini + buang exc_info -> traceback nyangkut di "event".
+        # Record diterusin utuh, traceback di-render JsonFormatter di thread listener.
+        return record
+
+def setup_logging():
+    global _log_listener
+    if _log_listener is not None:
+        return
+    out = logging.StreamHandler(sys.stdout)
+    out.setFormatter(JsonFormatter())
+    q: "queue.SimpleQueue" = queue.SimpleQueue()
+    log.addHandler(_LogQueueHandler(q))
+    log.setLevel(LOG_LEVEL)
+    log.propagate = False
+    _log_listener = logging.handlers.QueueListener(q, out, respect_handler_level=False)
+    _log_listener.start()
+
+def stop_logging():
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()  # flush sisa queue dulu baru balik
+        _log_listener = None
+
+def log_event(level: int, event: str, exc_info=None, **fields):
+    if log.isEnabledFor(level):
+        log.log(level, event, exc_info=exc_info, extra={"fields": fields})
+
+def log_error(event: str, e: BaseException, level: int = logging.WARNING, exc_info: bool = False, **fields):
+    # exc_info=True buat kegagalan tak terduga: traceback ikut sebagai field "exc".
+    # Pakai traceback milik `e` sendiri (callback Task gak punya exception "aktif").
+    log_event(level, event, exc_info=(type(e), e, e.__traceback__) if exc_info else None,
+              error=type(e).__name__, error_msg=str(e), **fields)
+
+def log_sampled(event: str, every: int = LOG_OK_EVERY, **fields):
+    # 1 dari `every` yang dicatat; field sampled=N biar total tetap bisa dihitung
+    n = _sample_counts.get(event, 0) + 1
+    if n >= every:
+        _sample_counts[event] = 0
+        log_event(logging.INFO, event, sampled=every, **fields)
+    else:
+        _sample_counts[event] = n
+
+# ---- startup timing: tiap fase dicatat, dilog 1 event pas semua komponen ready ----
+class StartupTimer:
+    def __init__(self, t0: float):
+        self.t0 = self._last = t0
+        self.mode = ""
+        self.phases: Dict[str, float] = {}
+        self.pending: Set[str] = set()
+        self.done = False
+
+    def expect(self, mode: str, components: Set[str]):
+        self.mode, self.pending = mode, set(components)
+
+    def mark(self, phase: str):
+        if self.done:
+            return  # reconnect dll setelah startup gak usah dicatat
+        t = time.perf_counter()
+        self.phases[phase] = round((t - self._last) * 1000, 1)
+        self._last = t
+
+    def ready(self, component: str):
+        self.mark(f"{component}_ready")
+        if component in self.pending:
+            self.pending.discard(component)
+            if not self.pending:
+                self.done = True
+                log_event(logging.INFO, "startup", mode=self.mode,
+                          total_ms=round((time.perf_counter() - self.t0) * 1000, 1), phases_ms=self.phases)
+
+STARTUP = StartupTimer(_BOOT)
+
 # optional: validasi biar gak jalan kalau belum diisi beneran
 if TOKEN == "ISI_TOKEN_BOTFATHER" or API_HASH == "ISI_API_HASH" or API_ID == 123456 or OWNER_ID == 123456789:
-    print("⚠️ CONFIG belum diisi. Isi file .env dulu (lihat .env.example).")
+    log.warning("⚠️ CONFIG belum diisi. Isi file .env dulu (lihat .env.example).")
 
 # =======================
 # UTIL
@@ -73,6 +195,13 @@ if TOKEN == "ISI_TOKEN_BOTFATHER" or API_HASH == "ISI_API_HASH" or API_ID == 123
 def now() -> int:
     return int(time.time())
 
+def fmt_dur(sec: float) -> str:
+    sec = int(sec)
+    if sec < 60:
+        return f"{sec} detik"
+    h, m = divmod(sec // 60, 60)
+    return f"{h}j {m}m" if h else f"{m}m"
+
 def fmt_ts(ts: int) -> str:
     if not ts:
         return "-"
@@ -82,145 +211,954 @@ def fmt_ts(ts: int) -> str:
 def thread_key_from(thread_id: Optional[int]) -> int:
     return int(thread_id) if thread_id is not None else -1
 
+# =======================
+# METRICS (Prometheus text, opsional)
+# =======================
+# Aktif kalau METRICS_PORT diisi. Counter/histogram di bawah cuma dict +
+# bisect di thread event loop (murah, aman nyala terus di production).
+# Cek: curl http://127.0.0.1:9108/metrics
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0") or 0)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+REGISTRY: list = []
+
+def _fmt_labels(names: Tuple[str, ...], values: tuple, extra: str = "") -> str:
+    parts = ['%s="%s"' % (n, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+             for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Counter:
+    def __init__(self, name: str, doc: str, labels: Tuple[str, ...] = ()):
+        self.name, self.doc, self.labels = name, doc, labels
+        self._v: Dict[tuple, float] = {}
+        REGISTRY.append(self)
+
+    def inc(self, *labelvalues, amount: float = 1.0):
+        self._v[labelvalues] = self._v.get(labelvalues, 0.0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.doc}"
+        yield f"# TYPE {self.name} counter"
+        for key, v in self._v.items():
+            yield f"{self.name}{_fmt_labels(self.labels, key)} {v}"
+
+class Histogram:
+    def __init__(self, name: str, doc: str, labels: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        self.name, self.doc, self.labels = name, doc, labels
+        self.buckets = tuple(buckets)
+        # per label: [hit per bucket..., +Inf], sum
+        self._v: Dict[tuple, list] = {}
+        REGISTRY.append(self)
+
+    def observe(self, value: float, *labelvalues):
+        st = self._v.get(labelvalues)
+        if st is None:
+            st = self._v[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+        st[0][bisect_left(self.buckets, value)] += 1
+        st[1] += value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.doc}"
+        yield f"# TYPE {self.name} histogram"
+        for key, (hits, total) in self._v.items():
+            acc = 0
+            for le, n in zip(self.buckets + (float("inf"),), hits):
+                acc += n
+                le_s = "+Inf" if le == float("inf") else repr(le)
+                labels = _fmt_labels(self.labels, key, 'le="%s"' % le_s)
+                yield f"{self.name}_bucket{labels} {acc}"
+            yield f"{self.name}_sum{_fmt_labels(self.labels, key)} {total}"
+            yield f"{self.name}_count{_fmt_labels(self.labels, key)} {acc}"
+
+class Gauge:
+    # nilai diambil pas scrape (fn), gak perlu di-update manual
+    def __init__(self, name: str, doc: str, fn):
+        self.name, self.doc, self.fn = name, doc, fn
+        REGISTRY.append(self)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.doc}"
+        yield f"# TYPE {self.name} gauge"
+        yield f"{self.name} {float(self.fn())}"
+
+SEND_TOTAL = Counter("ubot_send_total", "Hasil safe_send per outcome", ("outcome",))
+SEND_LATENCY = Histogram("ubot_send_latency_seconds", "Latency send_message (attempt terakhir)", ("outcome",))
+WAIT_SECONDS = Counter("ubot_wait_seconds_total", "Detik FloodWait/SlowmodeWait", ("reason",))
+DB_LATENCY = Histogram("ubot_db_seconds", "Latency query DB (termasuk antri) per call site", ("site",))
+HANDLER_LATENCY = Histogram("ubot_handler_seconds", "Latency handler panel per command", ("command",))
+RUN_DURATION = Histogram("ubot_run_seconds", "Durasi 1 run broadcast", ("kind",),
+                         buckets=(1, 10, 60, 300, 900, 1800, 3600, 7200, 21600, 43200))
+RUN_DESTS = Histogram("ubot_run_destinations", "Jumlah destinasi per run", ("kind",),
+                      buckets=(1, 10, 50, 100, 500, 1000, 5000, 10000, 50000, 100000))
+LOOP_LAG = Histogram("ubot_event_loop_lag_seconds", "Telat bangun event loop",
+                     buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0))
+
+def render_metrics() -> str:
+    lines: List[str] = []
+    for m in REGISTRY:
+        lines.extend(m.render())
+    return "\n".join(lines) + "\n"
+
+def timed(command: str, fn):
+    # bungkus handler PTB buat HANDLER_LATENCY
+    async def wrapper(update, context):
+        t0 = time.perf_counter()
+        try:
+            return await fn(update, context)
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - t0, command)
+    wrapper.__name__ = fn.__name__
+    return wrapper
+
+async def _metrics_conn(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request = await asyncio.wait_for(reader.readline(), timeout=5)
+        while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request.split()
+        if len(parts) >= 2 and parts[1].split(b"?")[0] == b"/metrics":
+            status, body = "200 OK", render_metrics().encode("utf-8")
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("ascii") + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def loop_lag_monitor(interval: float = 0.5):
+    while True:
+        t0 = time.perf_counter()
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(0.0, time.perf_counter() - t0 - interval))
+
+async def start_metrics(port: int = METRICS_PORT, host: str = METRICS_HOST):
+    server = await asyncio.start_server(_metrics_conn, host, port)
+    asyncio.create_task(loop_lag_monitor())
+    log_event(logging.INFO, "metrics_started", host=host, port=server.sockets[0].getsockname()[1])
+    return server
+
 # =======================
 # DB
 # =======================
-def db() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH)
+# Koneksi dipakai ulang per-thread (sqlite3 gak boleh lintas thread),
+# schema + migrasi cuma jalan SEKALI lewat init_db() saat startup.
+_local = threading.local()
+_known_users: Set[int] = set()
+
+# Migrasi versioned (PRAGMA user_version). Index = versi tujuan - 1.
+# JANGAN ubah migrasi lama, tambah entry baru di bawah.
+MIGRATIONS: List[List[str]] = [
+    # v1: schema dasar (aman buat DB lama yang dibuat sebelum ada user_version)
+    [
+        """
+        CREATE TABLE IF NOT EXISTS users(
+            owner_id INTEGER PRIMARY KEY,
+            interval_hours INTEGER DEFAULT 12,
+            delay_sec REAL DEFAULT 5,
+            enabled INTEGER DEFAULT 0,
+            message_text TEXT,
+            message_entities TEXT,
+            next_run INTEGER DEFAULT 0
+        )""",
+        # whitelist pakai thread_key (AMAN di SQLite)
+        """
+        CREATE TABLE IF NOT EXISTS whitelist(
+            owner_id INTEGER,
+            chat_id INTEGER,
+            thread_id INTEGER,
+            thread_key INTEGER DEFAULT -1,
+            title TEXT,
+            UNIQUE(owner_id, chat_id, thread_key)
+        )""",
+        """
+        CREATE TABLE IF NOT EXISTS blacklist(
+            owner_id INTEGER,
+            chat_id INTEGER,
+            UNIQUE(owner_id, chat_id)
+        )""",
+        # migrate kolom DB lama (error "duplicate column" di-skip)
+        "ALTER TABLE users ADD COLUMN message_entities TEXT",
+        "ALTER TABLE users ADD COLUMN next_run INTEGER DEFAULT 0",
+        "ALTER TABLE whitelist ADD COLUMN thread_key INTEGER DEFAULT -1",
+        # backfill thread_key untuk row lama yang NULL
+        "UPDATE whitelist SET thread_key=COALESCE(thread_id, -1) WHERE thread_key IS NULL",
+    ],
+    # v2: scheduler multi-owner (cari owner yang due)
+    [
+        "CREATE INDEX IF NOT EXISTS idx_users_due ON users(enabled, next_run)",
+    ],
+    # v3: run + progress per destinasi (resume setelah restart)
+    [
+        """
+        CREATE TABLE IF NOT EXISTS runs(
+            run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            owner_id INTEGER,
+            kind TEXT,
+            status TEXT DEFAULT 'running',
+            started_at INTEGER,
+            finished_at INTEGER,
+            total INTEGER DEFAULT 0,
+            sent INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_runs_owner ON runs(owner_id, kind, status)",
+        """
+        CREATE TABLE IF NOT EXISTS run_targets(
+            seq INTEGER PRIMARY KEY,
+            run_id INTEGER,
+            chat_id INTEGER,
+            thread_key INTEGER,
+            thread_id INTEGER,
+            done INTEGER DEFAULT 0,
+            ok INTEGER
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_run_targets_pending ON run_targets(run_id, done)",
+    ],
+    # v4: log hasil kirim per destinasi (buat /stats)
+    [
+        """
+        CREATE TABLE IF NOT EXISTS deliveries(
+            id INTEGER PRIMARY KEY,
+            ts INTEGER,
+            owner_id INTEGER,
+            run_id INTEGER,
+            chat_id INTEGER,
+            thread_key INTEGER,
+            outcome TEXT,
+            error TEXT,
+            latency_ms INTEGER,
+            flood_sec INTEGER DEFAULT 0
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_deliveries_owner_ts ON deliveries(owner_id, ts)",
+    ],
+    # v5: karantina dest yang gagal sementara
+    [
+        """
+        CREATE TABLE IF NOT EXISTS quarantine(
+            owner_id INTEGER,
+            chat_id INTEGER,
+            thread_key INTEGER,
+            category TEXT,
+            fails INTEGER DEFAULT 0,
+            until INTEGER,
+            last_error TEXT,
+            PRIMARY KEY(owner_id, chat_id, thread_key)
+        )""",
+    ],
+    # v6: /listdest /listblack keyset pagination (+ judul di blacklist)
+    [
+        "CREATE INDEX IF NOT EXISTS idx_whitelist_title "
+        "ON whitelist(owner_id, title COLLATE NOCASE, chat_id, thread_key)",
+        "ALTER TABLE blacklist ADD COLUMN title TEXT",
+    ],
+    # v7: agregat kirim per owner (EWMA, di-update pas flush delivery log) buat estimasi /status
+    [
+        """
+        CREATE TABLE IF NOT EXISTS send_stats(
+            owner_id INTEGER PRIMARY KEY,
+            sends INTEGER DEFAULT 0,
+            latency_ms REAL,
+            wait_sec REAL,
+            last_run_sec INTEGER,
+            last_run_total INTEGER
+        )""",
+    ],
+    # v8: antrian job panel <-> sender (beda proses)
+    [
+        """
+        CREATE TABLE IF NOT EXISTS jobs(
+            job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            target TEXT,
+            kind TEXT,
+            owner_id INTEGER,
+            payload TEXT,
+            status TEXT DEFAULT 'queued',
+            attempts INTEGER DEFAULT 0,
+            created_at INTEGER,
+            started_at INTEGER,
+            finished_at INTEGER,
+            result TEXT
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_jobs_queue ON jobs(target, status, job_id)",
+    ],
+    # v9: pesan BC bisa media (JSON {"kind", "file", "name"}) + file_id hasil upload pertama
+    [
+        "ALTER TABLE users ADD COLUMN message_media TEXT",
+        """
+        CREATE TABLE IF NOT EXISTS media_cache(
+            file TEXT PRIMARY KEY,
+            kind TEXT,
+            file_id TEXT,
+            uploaded_at INTEGER
+        )""",
+    ],
+    # v10: metadata chat/topic dari sudut pandang ubot (thread_key -1 = level chat)
+    [
+        """
+        CREATE TABLE IF NOT EXISTS chat_meta(
+            chat_id INTEGER,
+            thread_key INTEGER,
+            slowmode_sec INTEGER,
+            can_send INTEGER,
+            can_send_media INTEGER,
+            is_forum INTEGER,
+            topic_closed INTEGER,
+            ready_at INTEGER,
+            last_ok_ts INTEGER,
+            checked_at INTEGER,
+            PRIMARY KEY(chat_id, thread_key)
+        )""",
+    ],
+    # v11: rollup deliveries per jam (span=3600) & per hari (span=86400); /stats baca dari sini.
+    # idx_deliveries_owner_ts gak dipakai lagi (rollup/retensi jalan di atas id) -> dibuang biar insert murah
+    [
+        """
+        CREATE TABLE IF NOT EXISTS delivery_rollup(
+            span INTEGER,
+            owner_id INTEGER,
+            bucket INTEGER,
+            chat_id INTEGER,
+            thread_key INTEGER,
+            sends INTEGER,
+            ok INTEGER,
+            removed INTEGER,
+            quarantined INTEGER,
+            flood_sec INTEGER,
+            PRIMARY KEY(span, owner_id, bucket, chat_id, thread_key)
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_delivery_rollup_expire ON delivery_rollup(span, bucket)",
+        """
+        CREATE TABLE IF NOT EXISTS latency_rollup(
+            span INTEGER,
+            owner_id INTEGER,
+            bucket INTEGER,
+            le_ms INTEGER,
+            n INTEGER,
+            PRIMARY KEY(span, owner_id, bucket, le_ms)
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_latency_rollup_expire ON latency_rollup(span, bucket)",
+        """
+        CREATE TABLE IF NOT EXISTS rollup_state(
+            name TEXT PRIMARY KEY,
+            last_id INTEGER
+        )""",
+        "DROP INDEX IF EXISTS idx_deliveries_owner_ts",
+    ],
+]
+
+# WAL: checkpoint utama dijalanin maintenance_loop (di luar thread writer).
+# autocheckpoint SQLite cuma jaring pengaman kalau maintenance gak jalan.
+WAL_AUTOCHECKPOINT = int(os.getenv("WAL_AUTOCHECKPOINT", "10000"))  # page
+WAL_SIZE_LIMIT_MB = int(os.getenv("WAL_SIZE_LIMIT_MB", "64"))
+
+def _connect() -> sqlite3.Connection:
+    # isolation_level=None: transaksi diatur manual (BEGIN/COMMIT) biar bisa group-commit
+    conn = sqlite3.connect(DB_PATH, isolation_level=None)
     conn.execute("PRAGMA journal_mode=WAL;")
     conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute("PRAGMA busy_timeout=5000;")
+    conn.execute(f"PRAGMA wal_autocheckpoint={WAL_AUTOCHECKPOINT};")
+    # file -wal dipotong balik ke ukuran ini tiap habis checkpoint
+    conn.execute(f"PRAGMA journal_size_limit={WAL_SIZE_LIMIT_MB * 1024 * 1024};")
+    return conn
 
-    conn.execute("""
-    CREATE TABLE IF NOT EXISTS users(
-        owner_id INTEGER PRIMARY KEY,
-        interval_hours INTEGER DEFAULT 12,
-        delay_sec REAL DEFAULT 5,
-        enabled INTEGER DEFAULT 0,
-        message_text TEXT,
-        message_entities TEXT,
-        next_run INTEGER DEFAULT 0
-    )""")
-
-    # whitelist pakai thread_key (AMAN di SQLite)
-    conn.execute("""
-    CREATE TABLE IF NOT EXISTS whitelist(
-        owner_id INTEGER,
-        chat_id INTEGER,
-        thread_id INTEGER,
-        thread_key INTEGER DEFAULT -1,
-        title TEXT,
-        UNIQUE(owner_id, chat_id, thread_key)
-    )""")
-
-    conn.execute("""
-    CREATE TABLE IF NOT EXISTS blacklist(
-        owner_id INTEGER,
-        chat_id INTEGER,
-        UNIQUE(owner_id, chat_id)
-    )""")
-
-    # migrate users (kalau DB lama)
-    for ddl in [
-        "ALTER TABLE users ADD COLUMN message_entities TEXT",
-        "ALTER TABLE users ADD COLUMN next_run INTEGER DEFAULT 0",
-    ]:
+def migrate(conn: sqlite3.Connection) -> int:
+    ver = conn.execute("PRAGMA user_version").fetchone()[0]
+    for target, stmts in enumerate(MIGRATIONS[ver:], start=ver + 1):
+        conn.execute("BEGIN IMMEDIATE")
         try:
-            conn.execute(ddl)
-        except sqlite3.OperationalError:
-            pass
-
-    # migrate whitelist: tambah thread_key (kalau DB lama)
+            for sql in stmts:
+                try:
+                    conn.execute(sql)
+                except sqlite3.OperationalError as e:
+                    # ALTER kolom yang sudah ada (DB lama) -> skip
+                    if "duplicate column" not in str(e):
+                        raise
+            conn.execute(f"PRAGMA user_version={target}")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    return len(MIGRATIONS)
+
+def init_db():
+    # panggil sekali di startup; koneksi sementara langsung ditutup (thread lain buka sendiri)
+    conn = _connect()
     try:
-        conn.execute("ALTER TABLE whitelist ADD COLUMN thread_key INTEGER DEFAULT -1")
-    except sqlite3.OperationalError:
-        pass
+        migrate(conn)
+    finally:
+        conn.close()
+
+def db() -> sqlite3.Connection:
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _connect()
+        _local.conn = conn
+    return conn
+
+# =======================
+# ASYNC DB (biar event loop gak ke-block sqlite)
+# =======================
+# - baca: thread pool kecil, tiap thread punya koneksi sendiri (lihat db())
+# - tulis: 1 thread writer + queue. Job yang numpuk di-commit bareng
+#   dalam 1 transaksi, tiap job dibungkus SAVEPOINT biar error 1 job
+#   gak ikut nge-rollback job lain.
+DB_READERS = int(os.getenv("DB_READERS", "2"))
+DB_WRITE_BATCH = int(os.getenv("DB_WRITE_BATCH", "256"))
+
+_read_pool = ThreadPoolExecutor(max_workers=DB_READERS, thread_name_prefix="db-read")
+
+def _settle(fut: asyncio.Future, ok: bool, value):
+    if fut.cancelled():
+        return
+    if ok:
+        fut.set_result(value)
+    else:
+        fut.set_exception(value)
+
+class DBWriter:
+    def __init__(self, max_batch: int = DB_WRITE_BATCH):
+        self.max_batch = max_batch
+        self._q: "queue.Queue" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._q.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, fn, *args) -> asyncio.Future:
+        self.start()
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._q.put((loop, fut, fn, args))
+        return fut
+
+    def _run(self):
+        conn = db()
+        stop = False
+        while not stop:
+            job = self._q.get()
+            if job is None:
+                break
+            batch = [job]
+            while len(batch) < self.max_batch:
+                try:
+                    nxt = self._q.get_nowait()
+                except queue.Empty:
+                    break
+                if nxt is None:
+                    stop = True
+                    break
+                batch.append(nxt)
+            self._apply(conn, batch)
+
+    def _apply(self, conn: sqlite3.Connection, batch):
+        results = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for _, _, fn, args in batch:
+                conn.execute("SAVEPOINT job")
+                try:
+                    res = fn(conn, *args)
+                    conn.execute("RELEASE job")
+                    results.append((True, res))
+                except Exception as e:
+                    conn.execute("ROLLBACK TO job")
+                    conn.execute("RELEASE job")
+                    results.append((False, e))
+            conn.execute("COMMIT")
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            results = [(False, e)] * len(batch)
+        for (loop, fut, _, _), (ok, value) in zip(batch, results):
+            loop.call_soon_threadsafe(_settle, fut, ok, value)
+
+WRITER = DBWriter()
 
-    # backfill thread_key untuk row lama yang NULL
+def _read_job(fn, args):
+    return fn(db(), *args)
+
+async def db_read(fn, *args):
+    loop = asyncio.get_running_loop()
+    t0 = time.perf_counter()
     try:
-        conn.execute("UPDATE whitelist SET thread_key=COALESCE(thread_id, -1) WHERE thread_key IS NULL")
-    except sqlite3.OperationalError:
-        pass
+        return await loop.run_in_executor(_read_pool, _read_job, fn, args)
+    finally:
+        DB_LATENCY.observe(time.perf_counter() - t0, fn.__name__)
 
-    conn.commit()
-    return conn
+async def db_write(fn, *args):
+    t0 = time.perf_counter()
+    try:
+        return await WRITER.submit(fn, *args)
+    finally:
+        DB_LATENCY.observe(time.perf_counter() - t0, fn.__name__)
 
-def ensure_user(owner_id: int):
-    conn = db()
+# =======================
+# DB HELPERS
+# =======================
+# q_*: query murni (terima conn, gak commit sendiri) -> dipanggil lewat db_read/db_write
+def q_ensure_user(conn: sqlite3.Connection, owner_id: int):
     conn.execute(
         "INSERT OR IGNORE INTO users(owner_id, interval_hours, delay_sec) VALUES(?,?,?)",
         (owner_id, DEFAULT_INTERVAL_HOURS, DEFAULT_DELAY_SEC)
     )
-    conn.commit()
-    conn.close()
 
-# =======================
-# DB HELPERS
-# =======================
-def upsert_whitelist(owner_id: int, chat_id: int, thread_id: Optional[int], title: str) -> int:
+def q_upsert_whitelist(conn: sqlite3.Connection, owner_id: int, chat_id: int,
+                       thread_id: Optional[int], title: str) -> int:
     tkey = thread_key_from(thread_id)
-    conn = db()
     conn.execute(
         "INSERT OR IGNORE INTO whitelist(owner_id, chat_id, thread_id, thread_key, title) VALUES(?,?,?,?,?)",
         (owner_id, chat_id, thread_id, tkey, title)
     )
-    conn.commit()
-    conn.close()
     return tkey
 
-def delete_whitelist(owner_id: int, chat_id: int, thread_id: Optional[int]) -> int:
+def q_delete_whitelist(conn: sqlite3.Connection, owner_id: int, chat_id: int, thread_id: Optional[int]) -> int:
     tkey = thread_key_from(thread_id)
-    conn = db()
     cur = conn.execute(
         "DELETE FROM whitelist WHERE owner_id=? AND chat_id=? AND thread_key=?",
         (owner_id, chat_id, tkey)
     )
-    conn.commit()
-    conn.close()
     return cur.rowcount
 
-def add_blacklist(owner_id: int, chat_id: int):
-    conn = db()
-    conn.execute("INSERT OR IGNORE INTO blacklist(owner_id, chat_id) VALUES(?,?)", (owner_id, chat_id))
-    conn.commit()
-    conn.close()
+def q_add_blacklist(conn: sqlite3.Connection, owner_id: int, chat_id: int, title: Optional[str] = None):
+    conn.execute(
+        "INSERT OR IGNORE INTO blacklist(owner_id, chat_id, title) VALUES(?,?,?)",
+        (owner_id, chat_id, title)
+    )
 
-def remove_blacklist(owner_id: int, chat_id: int) -> int:
-    conn = db()
+def q_remove_blacklist(conn: sqlite3.Connection, owner_id: int, chat_id: int) -> int:
     cur = conn.execute("DELETE FROM blacklist WHERE owner_id=? AND chat_id=?", (owner_id, chat_id))
-    conn.commit()
-    conn.close()
     return cur.rowcount
 
-def remove_dest(owner_id: int, chat_id: int, thread_id: Optional[int]) -> int:
-    # auto-remove dest yang error permanen saat kirim
-    return delete_whitelist(owner_id, chat_id, thread_id)
+def q_set_message(conn: sqlite3.Connection, owner_id: int, text: str, entities_json: str,
+                  media_json: Optional[str] = None):
+    conn.execute(
+        "UPDATE users SET message_text=?, message_entities=?, message_media=? WHERE owner_id=?",
+        (text, entities_json, media_json, owner_id)
+    )
+
+def q_set_interval(conn: sqlite3.Connection, owner_id: int, hours: int):
+    # return next_run baru (kalau enabled) atau None
+    conn.execute("UPDATE users SET interval_hours=? WHERE owner_id=?", (hours, owner_id))
+    row = conn.execute("SELECT enabled FROM users WHERE owner_id=?", (owner_id,)).fetchone()
+    if row and int(row[0]) == 1:
+        next_run = now() + hours * 3600
+        conn.execute("UPDATE users SET next_run=? WHERE owner_id=?", (next_run, owner_id))
+        return next_run
+    return None
+
+def q_set_delay(conn: sqlite3.Connection, owner_id: int, sec: float):
+    conn.execute("UPDATE users SET delay_sec=? WHERE owner_id=?", (sec, owner_id))
+
+def q_enable(conn: sqlite3.Connection, owner_id: int) -> Tuple[Optional[str], int]:
+    # return (None, next_run) kalau sukses, atau (kode alasan gagal, 0)
+    row = conn.execute(
+        "SELECT interval_hours, message_text, message_media FROM users WHERE owner_id=?",
+        (owner_id,)
+    ).fetchone()
+    if not row or not (row[1] or row[2]):
+        return "nomsg", 0
+    if not conn.execute("SELECT 1 FROM whitelist WHERE owner_id=? LIMIT 1", (owner_id,)).fetchone():
+        return "nodest", 0
+    next_run = now() + int(row[0]) * 3600
+    conn.execute("UPDATE users SET enabled=1, next_run=? WHERE owner_id=?", (next_run, owner_id))
+    return None, next_run
+
+def q_disable(conn: sqlite3.Connection, owner_id: int):
+    conn.execute("UPDATE users SET enabled=0, next_run=0 WHERE owner_id=?", (owner_id,))
+    # run terjadwal yang kepotong gak usah dilanjut pas enable lagi
+    q_abort_runs(conn, owner_id, "scheduled")
+
+def q_update_next_run(conn: sqlite3.Connection, owner_id: int, next_run: int):
+    conn.execute("UPDATE users SET next_run=? WHERE owner_id=?", (next_run, owner_id))
 
-def get_user_config(owner_id: int):
-    conn = db()
+def q_unpark_owner(conn: sqlite3.Connection, owner_id: int, next_run: int) -> bool:
+    # cuma owner enabled yang lagi parkir (next_run=0); enable/disable barengan gak ketimpa
+    return conn.execute(
+        "UPDATE users SET next_run=? WHERE owner_id=? AND enabled=1 AND next_run=0", (next_run, owner_id)
+    ).rowcount > 0
+
+LIST_PAGE_SIZE = int(os.getenv("LIST_PAGE_SIZE", "25"))
+
+def _like(q: str) -> str:
+    return "%" + q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+def q_page_whitelist(conn: sqlite3.Connection, owner_id: int, cursor: int, direction: str,
+                     q: str, limit: int = LIST_PAGE_SIZE):
+    # keyset di idx_whitelist_title: (title NOCASE, chat_id, thread_key) > / < baris cursor
+    where = ["owner_id=?"]
+    args: list = [owner_id]
+    if q:
+        where.append("title LIKE ? ESCAPE '\\'")
+        args.append(_like(q))
+    at = None
+    if cursor:
+        at = conn.execute(
+            "SELECT title, chat_id, thread_key FROM whitelist WHERE rowid=? AND owner_id=?",
+            (cursor, owner_id)
+        ).fetchone()
+    if at is None:
+        # cursor hilang (dest dihapus) -> balik ke halaman pertama
+        direction = "n"
+    else:
+        op = ">" if direction == "n" else "<"
+        # bound title duluan biar SQLite bisa range-seek di index (row value sendiri gak)
+        where.append(f"title COLLATE NOCASE {op}= ? AND (title COLLATE NOCASE, chat_id, thread_key) {op} (?,?,?)")
+        args.extend((at[0],) + tuple(at))
+    order = "ASC" if direction == "n" else "DESC"
+    rows = conn.execute(
+        f"SELECT rowid, title, chat_id, thread_id FROM whitelist WHERE {' AND '.join(where)} "
+        f"ORDER BY title COLLATE NOCASE {order}, chat_id {order}, thread_key {order} LIMIT ?",
+        args + [limit + 1]
+    ).fetchall()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if direction == "p":
+        rows.reverse()
+    has_prev = more if direction == "p" else at is not None
+    has_next = True if direction == "p" else more
+    return rows, has_prev, has_next
+
+def q_page_blacklist(conn: sqlite3.Connection, owner_id: int, cursor: int, direction: str,
+                     q: str, limit: int = LIST_PAGE_SIZE):
+    # keyset di UNIQUE(owner_id, chat_id); cursor = chat_id
+    where = ["owner_id=?"]
+    args: list = [owner_id]
+    if q:
+        where.append("title LIKE ? ESCAPE '\\'")
+        args.append(_like(q))
+    if cursor:
+        where.append(f"chat_id {'>' if direction == 'n' else '<'} ?")
+        args.append(cursor)
+    else:
+        direction = "n"
+    order = "ASC" if direction == "n" else "DESC"
+    rows = conn.execute(
+        f"SELECT chat_id, title FROM blacklist WHERE {' AND '.join(where)} ORDER BY chat_id {order} LIMIT ?",
+        args + [limit + 1]
+    ).fetchall()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if direction == "p":
+        rows.reverse()
+    has_prev = more if direction == "p" else bool(cursor)
+    has_next = True if direction == "p" else more
+    return rows, has_prev, has_next
+
+def q_stats(conn: sqlite3.Connection, owner_id: int, since: int, limit: int = 15):
+    # baca rollup (bukan deliveries mentah): > 7 hari pakai per hari, selain itu per jam
+    span = 86400 if now() - since > 7 * 86400 else 3600
+    args = (span, owner_id, since // span * span)
+    total, ok, flood, removed, quarantined = conn.execute(
+        "SELECT COALESCE(SUM(sends), 0), COALESCE(SUM(ok), 0), COALESCE(SUM(flood_sec), 0), "
+        "COALESCE(SUM(removed), 0), COALESCE(SUM(quarantined), 0) "
+        "FROM delivery_rollup WHERE span=? AND owner_id=? AND bucket>=?",
+        args
+    ).fetchone()
+    active_q = conn.execute(
+        "SELECT COUNT(*) FROM quarantine WHERE owner_id=? AND until>?", (owner_id, now())
+    ).fetchone()[0]
+
+    hist = conn.execute(
+        "SELECT le_ms, SUM(n) FROM latency_rollup WHERE span=? AND owner_id=? AND bucket>=? GROUP BY le_ms",
+        args
+    ).fetchall()
+    pct = {"p50": hist_quantile(hist, 0.50), "p95": hist_quantile(hist, 0.95)} if hist else {}
+
+    # destinasi paling sering gagal di atas
+    per_dest = conn.execute(
+        "SELECT chat_id, thread_key, SUM(sends) AS n_sends, SUM(ok) AS n_ok "
+        "FROM delivery_rollup WHERE span=? AND owner_id=? AND bucket>=? "
+        "GROUP BY chat_id, thread_key ORDER BY 1.0 * SUM(ok) / SUM(sends), SUM(sends) DESC LIMIT ?",
+        args + (limit,)
+    ).fetchall()
+
+    return total, ok, flood, (removed, quarantined, active_q), pct, per_dest
+
+def q_history_summary(conn: sqlite3.Connection, owner_id: int, since: int) -> Tuple[int, int]:
+    # ringkasan /status dari rollup harian, tetap murah walau riwayatnya berminggu-minggu
+    return conn.execute(
+        "SELECT COALESCE(SUM(sends), 0), COALESCE(SUM(ok), 0) FROM delivery_rollup "
+        "WHERE span=86400 AND owner_id=? AND bucket>=?",
+        (owner_id, since // 86400 * 86400)
+    ).fetchone()
+
+# ---- bulk import/export whitelist + blacklist ----
+IMPORT_MAX_ROWS = int(os.getenv("IMPORT_MAX_ROWS", "100000"))
+
+def q_export(conn: sqlite3.Connection, owner_id: int):
+    wl = conn.execute(
+        "SELECT chat_id, thread_id, title FROM whitelist WHERE owner_id=? ORDER BY rowid", (owner_id,)
+    ).fetchall()
+    bl = conn.execute(
+        "SELECT chat_id, title FROM blacklist WHERE owner_id=? ORDER BY chat_id", (owner_id,)
+    ).fetchall()
+    return wl, bl
+
+def _load_import_tables(conn: sqlite3.Connection, wl_rows: List[tuple], bl_rows: List[tuple]):
+    # temp table per-koneksi, biar diff + apply full di SQL
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS import_wl(chat_id INTEGER, thread_id INTEGER, thread_key INTEGER, title TEXT)")
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS import_bl(chat_id INTEGER, title TEXT)")
+    conn.execute("DELETE FROM import_wl")
+    conn.execute("DELETE FROM import_bl")
+    conn.executemany(
+        "INSERT INTO import_wl VALUES(?,?,?,?)",
+        [(c, t, thread_key_from(t), title) for c, t, title in wl_rows]
+    )
+    conn.executemany("INSERT INTO import_bl VALUES(?,?)", bl_rows)
+
+def q_import_diff(conn: sqlite3.Connection, owner_id: int, wl_rows: List[tuple], bl_rows: List[tuple]):
+    conn.execute("BEGIN")
+    try:
+        _load_import_tables(conn, wl_rows, bl_rows)
+        wl_new = conn.execute(
+            "SELECT COUNT(*) FROM import_wl i WHERE NOT EXISTS("
+            "  SELECT 1 FROM whitelist w WHERE w.owner_id=? AND w.chat_id=i.chat_id AND w.thread_key=i.thread_key)",
+            (owner_id,)
+        ).fetchone()[0]
+        wl_gone = conn.execute(
+            "SELECT COUNT(*) FROM whitelist w WHERE w.owner_id=? AND NOT EXISTS("
+            "  SELECT 1 FROM import_wl i WHERE i.chat_id=w.chat_id AND i.thread_key=w.thread_key)",
+            (owner_id,)
+        ).fetchone()[0]
+        bl_new = conn.execute(
+            "SELECT COUNT(*) FROM import_bl i WHERE NOT EXISTS("
+            "  SELECT 1 FROM blacklist b WHERE b.owner_id=? AND b.chat_id=i.chat_id)",
+            (owner_id,)
+        ).fetchone()[0]
+        bl_gone = conn.execute(
+            "SELECT COUNT(*) FROM blacklist b WHERE b.owner_id=? AND NOT EXISTS("
+            "  SELECT 1 FROM import_bl i WHERE i.chat_id=b.chat_id)",
+            (owner_id,)
+        ).fetchone()[0]
+    finally:
+        conn.execute("ROLLBACK")
+    return wl_new, wl_gone, bl_new, bl_gone
+
+def q_apply_import(conn: sqlite3.Connection, owner_id: int, wl_rows: List[tuple], bl_rows: List[tuple],
+                   replace: bool):
+    # jalan di writer -> 1 transaksi, semua executemany
+    if replace:
+        conn.execute("DELETE FROM whitelist WHERE owner_id=?", (owner_id,))
+        conn.execute("DELETE FROM blacklist WHERE owner_id=?", (owner_id,))
+    conn.executemany(
+        "INSERT INTO whitelist(owner_id, chat_id, thread_id, thread_key, title) VALUES(?,?,?,?,?) "
+        "ON CONFLICT(owner_id, chat_id, thread_key) DO UPDATE SET title=excluded.title",
+        [(owner_id, c, t, thread_key_from(t), title) for c, t, title in wl_rows]
+    )
+    conn.executemany(
+        "INSERT INTO blacklist(owner_id, chat_id, title) VALUES(?,?,?) "
+        "ON CONFLICT(owner_id, chat_id) DO UPDATE SET title=COALESCE(excluded.title, title)",
+        [(owner_id, c, title) for c, title in bl_rows]
+    )
+
+def q_load_owner_state(conn: sqlite3.Connection, owner_id: int):
     u = conn.execute(
-        "SELECT interval_hours, delay_sec, enabled, message_text, message_entities, next_run "
+        "SELECT interval_hours, delay_sec, enabled, message_text, message_entities, next_run, message_media "
         "FROM users WHERE owner_id=?",
         (owner_id,)
     ).fetchone()
-
     wl = conn.execute(
-        "SELECT chat_id, thread_id, title FROM whitelist WHERE owner_id=?",
+        "SELECT chat_id, thread_key, thread_id, title FROM whitelist WHERE owner_id=? ORDER BY rowid",
         (owner_id,)
     ).fetchall()
-
-    bl = set(r[0] for r in conn.execute(
-        "SELECT chat_id FROM blacklist WHERE owner_id=?",
+    bl = conn.execute("SELECT chat_id FROM blacklist WHERE owner_id=?", (owner_id,)).fetchall()
+    stats = conn.execute(
+        "SELECT sends, latency_ms, wait_sec, last_run_sec, last_run_total FROM send_stats WHERE owner_id=?",
         (owner_id,)
-    ).fetchall())
+    ).fetchone()
+    return u, wl, bl, stats
 
-    conn.close()
-    return u, wl, bl
+# =======================
+# CONFIG CACHE (write-through, LRU per owner)
+# =======================
+# Config + set dest + set blacklist per owner disimpan di memori.
+# Semua helper yang ngubah data update DB dulu, lalu cache-nya (write-through),
+# jadi baca di panel & scheduler gak nyentuh SQLite sama sekali.
+# Owner yang lama gak aktif dibuang (LRU, CONFIG_CACHE_MAX).
+CONFIG_CACHE_MAX = int(os.getenv("CONFIG_CACHE_MAX", "1000"))
+
+class OwnerState:
+    __slots__ = ("interval_hours", "delay_sec", "enabled", "message_text", "message_entities",
+                 "next_run", "message_media", "dests", "black", "stats")
+
+    def __init__(self, u, wl, bl, stats=None):
+        (self.interval_hours, self.delay_sec, self.enabled,
+         self.message_text, self.message_entities, self.next_run, self.message_media) = u
+        # (chat_id, thread_key) -> (thread_id, title), urut sesuai waktu ditambah
+        self.dests: Dict[Tuple[int, int], Tuple[Optional[int], str]] = {
+            (c, k): (t, title) for c, k, t, title in wl
+        }
+        self.black: Set[int] = {r[0] for r in bl}
+        # (sends, latency_ms, wait_sec, last_run_sec, last_run_total) dari send_stats, None = belum ada
+        self.stats: Optional[tuple] = tuple(stats) if stats else None
+
+    def row(self):
+        return (self.interval_hours, self.delay_sec, self.enabled,
+                self.message_text, self.message_entities, self.next_run)
+
+    def has_message(self) -> bool:
+        # media tanpa caption = message_text kosong tapi tetap pesan
+        return bool(self.message_text or self.message_media)
+
+class ConfigCache:
+    def __init__(self, max_owners: int = CONFIG_CACHE_MAX):
+        self.max_owners = max_owners
+        self._owners: "OrderedDict[int, OwnerState]" = OrderedDict()
+        # naik tiap ada write -> load yang balapan sama write dibuang
+        self._version: Dict[int, int] = {}
+
+    async def get(self, owner_id: int) -> Optional[OwnerState]:
+        st = self._owners.get(owner_id)
+        if st is not None:
+            self._owners.move_to_end(owner_id)
+            return st
+        while True:
+            ver = self._version.get(owner_id, 0)
+            u, wl, bl, stats = await db_read(q_load_owner_state, owner_id)
+            if u is None:
+                return None
+            if self._version.get(owner_id, 0) == ver:
+                break
+        st = OwnerState(u, wl, bl, stats)
+        self._owners[owner_id] = st
+        if len(self._owners) > self.max_owners:
+            old, _ = self._owners.popitem(last=False)
+            self._version.pop(old, None)
+        return st
+
+    def peek(self, owner_id: int) -> Optional[OwnerState]:
+        # dipanggil SETELAH write sukses; return None kalau owner gak di-cache
+        self._version[owner_id] = self._version.get(owner_id, 0) + 1
+        return self._owners.get(owner_id)
+
+    def drop_changed(self, scheduled: Dict[int, int]) -> int:
+        # scheduled: owner_id -> next_run dari DB (enabled saja); owner cache yang beda dibuang
+        changed = [
+            owner_id for owner_id, st in self._owners.items()
+            if (int(st.next_run or 0) if st.enabled else 0) != scheduled.get(owner_id, 0)
+        ]
+        for owner_id in changed:
+            self.invalidate(owner_id)
+        return len(changed)
+
+    def invalidate(self, owner_id: Optional[int] = None):
+        if owner_id is None:
+            for oid in list(self._owners):
+                self.peek(oid)
+            self._owners.clear()
+        else:
+            self.peek(owner_id)
+            self._owners.pop(owner_id, None)
+
+CONFIG = ConfigCache()
+
+# versi async (dipakai handler & sender) -> write-through ke CONFIG
+async def ensure_user(owner_id: int):
+    if owner_id in _known_users:
+        return
+    await db_write(q_ensure_user, owner_id)
+    _known_users.add(owner_id)
+
+async def upsert_whitelist(owner_id: int, chat_id: int, thread_id: Optional[int], title: str) -> int:
+    tkey = await db_write(q_upsert_whitelist, owner_id, chat_id, thread_id, title)
+    st = CONFIG.peek(owner_id)
+    if st is not None:
+        st.dests.setdefault((chat_id, tkey), (thread_id, title))
+    # owner enabled yang sempat ke-parkir karena whitelist kosong -> jadwalin lagi
+    await config_changed(owner_id)
+    return tkey
+
+async def delete_whitelist(owner_id: int, chat_id: int, thread_id: Optional[int]) -> int:
+    deleted = await db_write(q_delete_whitelist, owner_id, chat_id, thread_id)
+    st = CONFIG.peek(owner_id)
+    if st is not None:
+        st.dests.pop((chat_id, thread_key_from(thread_id)), None)
+    await config_changed(owner_id)
+    return deleted
+
+async def add_blacklist(owner_id: int, chat_id: int, title: Optional[str] = None):
+    await db_write(q_add_blacklist, owner_id, chat_id, title)
+    st = CONFIG.peek(owner_id)
+    if st is not None:
+        st.black.add(chat_id)
+    await config_changed(owner_id)
+
+async def remove_blacklist(owner_id: int, chat_id: int) -> int:
+    deleted = await db_write(q_remove_blacklist, owner_id, chat_id)
+    st = CONFIG.peek(owner_id)
+    if st is not None:
+        st.black.discard(chat_id)
+    await config_changed(owner_id)
+    return deleted
+
+async def remove_dest(owner_id: int, chat_id: int, thread_id: Optional[int]) -> int:
+    # auto-remove dest yang error permanen saat kirim
+    return await delete_whitelist(owner_id, chat_id, thread_id)
+
+async def set_message(owner_id: int, text: str, entities_json: str, media_json: Optional[str] = None):
+    await db_write(q_set_message, owner_id, text, entities_json, media_json)
+    st = CONFIG.peek(owner_id)
+    if st is not None:
+        st.message_text, st.message_entities, st.message_media = text, entities_json, media_json
+
+async def set_interval(owner_id: int, hours: int):
+    next_run = await db_write(q_set_interval, owner_id, hours)
+    st = CONFIG.peek(owner_id)
+    if st is not None:
+        st.interval_hours = hours
+        if next_run is not None:
+            st.next_run = next_run
+
+async def set_delay(owner_id: int, sec: float):
+    await db_write(q_set_delay, owner_id, sec)
+    st = CONFIG.peek(owner_id)
+    if st is not None:
+        st.delay_sec = sec
+    await config_changed(owner_id)
+
+async def enable_owner(owner_id: int) -> Optional[str]:
+    err, next_run = await db_write(q_enable, owner_id)
+    st = CONFIG.peek(owner_id)
+    if st is not None and err is None:
+        st.enabled, st.next_run = 1, next_run
+    return err
+
+async def disable_owner(owner_id: int):
+    await db_write(q_disable, owner_id)
+    st = CONFIG.peek(owner_id)
+    if st is not None:
+        st.enabled, st.next_run = 0, 0
+
+def cache_next_run(owner_id: int, next_run: int):
+    # dipanggil setelah next_run ditulis sender
+    st = CONFIG.peek(owner_id)
+    if st is not None:
+        st.next_run = next_run
 
 # =======================
 # PANEL COMMANDS
 # =======================
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    ensure_user(update.effective_user.id)
+    await ensure_user(update.effective_user.id)
     await update.message.reply_text(
         "✅ Panel BC siap.\n\n"
         "Flow paling aman (support forum/topics):\n"
@@ -233,7 +1171,8 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/blacklist, /unblacklist\n"
         "/setinterval 12, /setdelay 5\n"
         "/enable, /disable, /status\n"
-        "/listdest, /listblack\n"
+        "/listdest [cari], /listblack [cari], /stats\n"
+        "/exportdest [csv], /importdest\n"
         "/force, /forcehere\n\n"
         "Catatan: untuk forum/topics, ketik /adddest & /unwhitelist langsung di TOPIC-nya."
     )
@@ -244,15 +1183,30 @@ async def cmd_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # ---- setmsg step-by-step (tanpa reply) ----
 async def cmd_setmsg(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    ensure_user(update.effective_user.id)
+    await ensure_user(update.effective_user.id)
     context.user_data["awaiting"] = "setmsg"
     await update.message.reply_text(
         "✍️ Silakan kirim PESAN BC sekarang.\n"
         "• 1 pesan saja\n"
         "• Bisa teks + emoji premium\n"
+        "• Bisa juga 1 foto/video/GIF/dokumen + caption (maks 20MB)\n"
         "• (Untuk batal) ketik /cancel"
     )
 
+async def save_setmsg(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, ents_json: str,
+                      media_json: Optional[str] = None) -> bool:
+    # validasi entities sekarang, bukan pas kirim (tanpa Pyrogram)
+    context.user_data.clear()
+    try:
+        validate_entities(text, ents_json)
+    except (ValueError, TypeError) as e:
+        await update.message.reply_text(f"❌ Format pesan gak valid: {e}\nCoba /setmsg lagi.")
+        return False
+
+    await set_message(update.effective_user.id, text, ents_json, media_json)
+    await config_changed(update.effective_user.id)
+    return True
+
 async def on_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if context.user_data.get("awaiting") != "setmsg":
         return
@@ -260,25 +1214,77 @@ async def on_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = update.message
     if not msg.text:
         context.user_data.clear()
-        return await msg.reply_text("❌ Pesan harus berupa teks.")
+        return await msg.reply_text("❌ Pesan harus berupa teks atau 1 media.")
+
+    ents_json = json.dumps([e.to_dict() for e in (msg.entities or [])], ensure_ascii=False)
+    if await save_setmsg(update, context, msg.text, ents_json):
+        await msg.reply_text("✅ Pesan BC berhasil disimpan (entities/premium emoji ikut).")
+
+def media_of(msg) -> Tuple[Optional[str], object]:
+    # animation dicek duluan: GIF juga kebaca sebagai document di PTB
+    if msg.animation:
+        return "animation", msg.animation
+    if msg.photo:
+        return "photo", msg.photo[-1]  # ukuran paling besar
+    if msg.video:
+        return "video", msg.video
+    if msg.document:
+        return "document", msg.document
+    return None, None
+
+MEDIA_EXT = {"photo": ".jpg", "video": ".mp4", "animation": ".mp4", "document": ""}
+
+async def store_media(obj, kind: str) -> dict:
+    # download dari Bot API -> simpan di MEDIA_DIR dengan nama sha1 isi file
+    # (file sama = nama sama = file_id di media_cache kepakai lagi)
+    name = getattr(obj, "file_name", None)
+    ext = (Path(name).suffix if name else "") or MEDIA_EXT[kind]
+    MEDIA_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = MEDIA_DIR / f".{obj.file_unique_id}.part"
+    tg_file = await obj.get_file()
+    await tg_file.download_to_drive(tmp)
+    digest = await asyncio.to_thread(file_sha1, tmp)
+    await asyncio.to_thread(os.replace, tmp, MEDIA_DIR / f"{digest}{ext}")
+
+    media = {"kind": kind, "file": f"{digest}{ext}"}
+    if kind == "document" and name:
+        media["name"] = name
+    return media
+
+async def on_media_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if context.user_data.get("awaiting") != "setmsg":
+        return
 
-    text = msg.text
-    ents = [e.to_dict() for e in (msg.entities or [])]
+    msg = update.message
+    kind, obj = media_of(msg)
+    if obj is None:
+        return
+    if (obj.file_size or 0) > MEDIA_MAX_BYTES:
+        context.user_data.clear()
+        return await msg.reply_text("❌ File kegedean (maks 20MB, batas download bot). Coba /setmsg lagi.")
 
-    conn = db()
-    conn.execute(
-        "UPDATE users SET message_text=?, message_entities=? WHERE owner_id=?",
-        (text, json.dumps(ents, ensure_ascii=False), update.effective_user.id)
-    )
-    conn.commit()
-    conn.close()
+    text = msg.caption or ""
+    if utf16_len(text) > CAPTION_MAX:
+        context.user_data.clear()
+        return await msg.reply_text(f"❌ Caption kepanjangan (maks {CAPTION_MAX} karakter). Coba /setmsg lagi.")
+    ents_json = json.dumps([e.to_dict() for e in (msg.caption_entities or [])], ensure_ascii=False)
 
-    context.user_data.clear()
-    await msg.reply_text("✅ Pesan BC berhasil disimpan (entities/premium emoji ikut).")
+    try:
+        media = await store_media(obj, kind)
+    except Exception as e:
+        context.user_data.clear()
+        log_error("media_download", e, owner_id=update.effective_user.id, kind=kind)
+        return await msg.reply_text("❌ Gagal download media. Coba /setmsg lagi.")
+
+    if await save_setmsg(update, context, text, ents_json, json.dumps(media)):
+        await msg.reply_text(
+            f"✅ Pesan BC ({kind}) berhasil disimpan.\n"
+            "Upload ke Telegram cuma sekali pas kirim pertama, selanjutnya pakai ulang."
+        )
 
 # ---- interval/delay ----
 async def cmd_setinterval(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    ensure_user(update.effective_user.id)
+    await ensure_user(update.effective_user.id)
     parts = update.message.text.split()
     if len(parts) != 2 or not parts[1].isdigit():
         return await update.message.reply_text("Pakai: /setinterval 12")
@@ -287,18 +1293,12 @@ async def cmd_setinterval(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if hours < 1 or hours > 72:
         return await update.message.reply_text("Biar aman, interval 1–72 jam.")
 
-    conn = db()
-    conn.execute("UPDATE users SET interval_hours=? WHERE owner_id=?", (hours, update.effective_user.id))
-    row = conn.execute("SELECT enabled FROM users WHERE owner_id=?", (update.effective_user.id,)).fetchone()
-    if row and int(row[0]) == 1:
-        conn.execute("UPDATE users SET next_run=? WHERE owner_id=?",
-                     (now() + hours * 3600, update.effective_user.id))
-    conn.commit()
-    conn.close()
+    await set_interval(update.effective_user.id, hours)
+    await config_changed(update.effective_user.id)
     await update.message.reply_text(f"✅ Interval diset: {hours} jam.")
 
 async def cmd_setdelay(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    ensure_user(update.effective_user.id)
+    await ensure_user(update.effective_user.id)
     parts = update.message.text.split()
     if len(parts) != 2:
         return await update.message.reply_text("Pakai: /setdelay 5")
@@ -311,15 +1311,12 @@ async def cmd_setdelay(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if sec < 0 or sec > 60:
         return await update.message.reply_text("Delay 0–60 detik aja ya.")
 
-    conn = db()
-    conn.execute("UPDATE users SET delay_sec=? WHERE owner_id=?", (sec, update.effective_user.id))
-    conn.commit()
-    conn.close()
+    await set_delay(update.effective_user.id, sec)
     await update.message.reply_text(f"✅ Delay antar grup diset: {sec} detik.")
 
 # ---- whitelist/blacklist smart (langsung di grup/topic) + fallback forward di private ----
 async def cmd_adddest(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    ensure_user(update.effective_user.id)
+    await ensure_user(update.effective_user.id)
     chat = update.effective_chat
     msg = update.message
 
@@ -327,7 +1324,7 @@ async def cmd_adddest(update: Update, context: ContextTypes.DEFAULT_TYPE):
         chat_id = chat.id
         thread_id = getattr(msg, "message_thread_id", None)
         title = chat.title or str(chat_id)
-        tkey = upsert_whitelist(update.effective_user.id, chat_id, thread_id, title)
+        tkey = await upsert_whitelist(update.effective_user.id, chat_id, thread_id, title)
         return await msg.reply_text(
             f"✅ Masuk whitelist: {title}\nchat_id={chat_id}\nthread_id={thread_id}\nthread_key={tkey}\n\n"
             f"Forum: pastiin kamu ketik /adddest di TOPIC yang mau dituju."
@@ -340,7 +1337,7 @@ async def cmd_adddest(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 async def cmd_unwhitelist(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    ensure_user(update.effective_user.id)
+    await ensure_user(update.effective_user.id)
     chat = update.effective_chat
     msg = update.message
 
@@ -348,7 +1345,7 @@ async def cmd_unwhitelist(update: Update, context: ContextTypes.DEFAULT_TYPE):
         chat_id = chat.id
         thread_id = getattr(msg, "message_thread_id", None)
         title = chat.title or str(chat_id)
-        deleted = delete_whitelist(update.effective_user.id, chat_id, thread_id)
+        deleted = await delete_whitelist(update.effective_user.id, chat_id, thread_id)
         return await msg.reply_text(
             f"🗑️ Unwhitelist: {title}\nchat_id={chat_id}\nthread_id={thread_id}\nTerhapus: {deleted}\n\n"
             f"Forum: ketik /unwhitelist di TOPIC yang sesuai."
@@ -361,28 +1358,28 @@ async def cmd_unwhitelist(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 async def cmd_blacklist(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    ensure_user(update.effective_user.id)
+    await ensure_user(update.effective_user.id)
     chat = update.effective_chat
     msg = update.message
 
     if chat and chat.type in ("group", "supergroup"):
         chat_id = chat.id
         title = chat.title or str(chat_id)
-        add_blacklist(update.effective_user.id, chat_id)
+        await add_blacklist(update.effective_user.id, chat_id, title)
         return await msg.reply_text(f"⛔ Masuk blacklist: {title}\nchat_id={chat_id}")
 
     context.user_data["mode"] = "blacklist"
     await msg.reply_text("Forward 1 pesan dari grup yang mau diblok (BLACKLIST).")
 
 async def cmd_unblacklist(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    ensure_user(update.effective_user.id)
+    await ensure_user(update.effective_user.id)
     chat = update.effective_chat
     msg = update.message
 
     if chat and chat.type in ("group", "supergroup"):
         chat_id = chat.id
         title = chat.title or str(chat_id)
-        deleted = remove_blacklist(update.effective_user.id, chat_id)
+        deleted = await remove_blacklist(update.effective_user.id, chat_id)
         return await msg.reply_text(f"✅ Dihapus dari blacklist: {title}\nchat_id={chat_id}\nTerhapus: {deleted}")
 
     context.user_data["mode"] = "unblacklist"
@@ -406,74 +1403,87 @@ async def on_forward(update: Update, context: ContextTypes.DEFAULT_TYPE):
     title = fchat.title or str(chat_id)
 
     if mode == "whitelist":
-        upsert_whitelist(owner_id, chat_id, thread_id, title)
+        await upsert_whitelist(owner_id, chat_id, thread_id, title)
         await msg.reply_text(f"✅ Masuk whitelist: {title}\nchat_id={chat_id}\nthread_id={thread_id}\nthread_key={tkey}")
 
     elif mode == "blacklist":
-        add_blacklist(owner_id, chat_id)
+        await add_blacklist(owner_id, chat_id, title)
         await msg.reply_text(f"⛔ Masuk blacklist: {title}\nchat_id={chat_id}")
 
     elif mode == "unwhitelist":
-        deleted = delete_whitelist(owner_id, chat_id, thread_id)
+        deleted = await delete_whitelist(owner_id, chat_id, thread_id)
         await msg.reply_text(f"🗑️ Dihapus dari whitelist: {title}\nchat_id={chat_id}\nthread_id={thread_id}\nTerhapus: {deleted}")
 
     elif mode == "unblacklist":
-        deleted = remove_blacklist(owner_id, chat_id)
+        deleted = await remove_blacklist(owner_id, chat_id)
         await msg.reply_text(f"✅ Dihapus dari blacklist: {title}\nchat_id={chat_id}\nTerhapus: {deleted}")
 
     context.user_data.clear()
 
 # ---- enable/disable/status ----
 async def cmd_enable(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    ensure_user(update.effective_user.id)
-    conn = db()
-
-    row = conn.execute(
-        "SELECT interval_hours, message_text FROM users WHERE owner_id=?",
-        (update.effective_user.id,)
-    ).fetchone()
-    wcnt = conn.execute("SELECT COUNT(*) FROM whitelist WHERE owner_id=?", (update.effective_user.id,)).fetchone()[0]
+    await ensure_user(update.effective_user.id)
+    err = await enable_owner(update.effective_user.id)
 
-    if not row or not row[1]:
-        conn.close()
+    if err == "nomsg":
         return await update.message.reply_text("❌ Set dulu pesan: /setmsg lalu kirim pesannya.")
-    if wcnt == 0:
-        conn.close()
+    if err == "nodest":
         return await update.message.reply_text("❌ Tambah dulu whitelist: /adddest (langsung di grup/topic)")
 
-    interval_hours = int(row[0])
-    conn.execute(
-        "UPDATE users SET enabled=1, next_run=? WHERE owner_id=?",
-        (now() + interval_hours * 3600, update.effective_user.id)
-    )
-    conn.commit()
-    conn.close()
+    await config_changed(update.effective_user.id)
     await update.message.reply_text("✅ Enabled. Ubot akan BC otomatis sesuai jadwal.")
 
 async def cmd_disable(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    ensure_user(update.effective_user.id)
-    conn = db()
-    conn.execute("UPDATE users SET enabled=0, next_run=0 WHERE owner_id=?", (update.effective_user.id,))
-    conn.commit()
-    conn.close()
+    await ensure_user(update.effective_user.id)
+    await disable_owner(update.effective_user.id)
+    await config_changed(update.effective_user.id)
     await update.message.reply_text("⛔ Disabled.")
 
-async def cmd_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    ensure_user(update.effective_user.id)
-    conn = db()
-    row = conn.execute(
-        "SELECT interval_hours, delay_sec, enabled, message_text, next_run FROM users WHERE owner_id=?",
-        (update.effective_user.id,)
-    ).fetchone()
-    wcnt = conn.execute("SELECT COUNT(*) FROM whitelist WHERE owner_id=?", (update.effective_user.id,)).fetchone()[0]
-    bcnt = conn.execute("SELECT COUNT(*) FROM blacklist WHERE owner_id=?", (update.effective_user.id,)).fetchone()[0]
-    sample = conn.execute(
-        "SELECT title, chat_id, thread_id FROM whitelist WHERE owner_id=? ORDER BY rowid DESC LIMIT 5",
-        (update.effective_user.id,)
-    ).fetchall()
-    conn.close()
+# ---- estimasi durasi run (dari agregat send_stats di cache, gak scan DB) ----
+ESTIMATE_LATENCY_MS = float(os.getenv("ESTIMATE_LATENCY_MS", "500"))  # tebakan kalau belum ada data kirim
+CAPACITY_WARN_RATIO = float(os.getenv("CAPACITY_WARN_RATIO", "0.8"))
+
+def estimate_run(st: OwnerState) -> Tuple[float, float, float]:
+    # return (detik per dest, total detik 1 run, rasio ke interval)
+    # jatah governor dihitung dari awal kirim ke awal kirim berikutnya -> yang kepake
+    # max(delay, min gap akun, latency), ditambah rata-rata nunggu FloodWait/Slowmode
+    stats = st.stats
+    lat_ms = stats[1] if stats and stats[1] is not None else ESTIMATE_LATENCY_MS
+    wait = stats[2] if stats and stats[2] is not None else 0.0
+    per_dest = max(float(st.delay_sec), GOVERNOR.min_gap, lat_ms / 1000.0) + wait
+    # whitelist penuh = batas atas (blacklist/karantina di-skip pas run)
+    total = per_dest * len(st.dests)
+    return per_dest, total, total / max(1, int(st.interval_hours) * 3600)
+
+def capacity_lines(st: OwnerState) -> List[str]:
+    if not st.dests:
+        return []
+    per_dest, total, ratio = estimate_run(st)
+    stats = st.stats
+    lines = [f"Estimasi 1 run: ~{fmt_dur(total)} ({len(st.dests)} dest × {per_dest:.2f}s) = "
+             f"{ratio:.0%} dari interval"]
+    if stats and stats[1] is not None:
+        lines.append(f"Basis: latency {stats[1]:.0f}ms, nunggu {stats[2]:.2f}s/kirim (dari {stats[0]} kirim)")
+    else:
+        lines.append(f"Basis: belum ada data kirim, latency ditebak {ESTIMATE_LATENCY_MS:.0f}ms")
+    if stats and stats[3] is not None:
+        lines.append(f"Run terakhir: {fmt_dur(stats[3])} ({stats[4]} dest)")
+    last_over = bool(stats and stats[3] is not None and stats[3] > int(st.interval_hours) * 3600)
+    if ratio >= 1 or last_over:
+        lines.append("⚠️ OVERSUBSCRIBED: 1 run lebih lama dari interval -> jadwal bakal molor terus.\n"
+                     "Kurangi dest / delay, atau naikkan /setinterval.")
+    elif ratio >= CAPACITY_WARN_RATIO:
+        lines.append(f"⚠️ Mepet: run makan >{CAPACITY_WARN_RATIO:.0%} interval, FloodWait dikit aja bisa bikin molor.")
+    return lines
 
-    interval_hours, delay_sec, enabled, message_text, next_run = row
+async def cmd_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await ensure_user(update.effective_user.id)
+    st = await CONFIG.get(update.effective_user.id)
+    interval_hours, delay_sec, enabled, _, _, next_run = st.row()
+    wcnt, bcnt = len(st.dests), len(st.black)
+    # 5 dest terakhir ditambah (dict urut waktu insert)
+    sample = [(title, chat_id, thread_id)
+              for (chat_id, _), (thread_id, title) in islice(reversed(st.dests.items()), 5)]
     next_run_human = fmt_ts(int(next_run)) if next_run else "-"
 
     lines = [
@@ -482,9 +1492,16 @@ async def cmd_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"Delay/grup: {delay_sec} detik",
         f"Whitelist: {wcnt}",
         f"Blacklist: {bcnt}",
-        f"Message set: {bool(message_text)}",
+        f"Message set: {st.has_message()}" + (f" ({json.loads(st.message_media)['kind']})" if st.message_media else ""),
         f"Next run: {next_run_human} (epoch={next_run})",
     ]
+    lines.extend(capacity_lines(st))
+    sends, ok = await db_read(q_history_summary, update.effective_user.id, now() - 7 * 86400)
+    if sends:
+        lines.append(f"Riwayat 7 hari: {sends} kirim, sukses {100.0 * ok / sends:.1f}%")
+    gov = GOVERNOR.snapshot()
+    if gov["queue_depth"] or gov["paused_for"]:
+        lines.append(f"Antrian kirim: {gov['queue_depth']} | FloodWait pause: {int(gov['paused_for'])} detik")
     if sample:
         lines.append("\nContoh whitelist (max 5):")
         for title, chat_id, thread_id in sample:
@@ -492,302 +1509,2203 @@ async def cmd_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     await update.message.reply_text("\n".join(lines))
 
-async def cmd_listdest(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    ensure_user(update.effective_user.id)
-    conn = db()
-    rows = conn.execute(
-        "SELECT title, chat_id, thread_id FROM whitelist WHERE owner_id=? ORDER BY title COLLATE NOCASE",
-        (update.effective_user.id,)
-    ).fetchall()
-    conn.close()
-
+# ---- list pakai keyset pagination + tombol prev/next ----
+def _page_button(label: str, kind: str, direction: str, cursor: int, q: str) -> InlineKeyboardButton:
+    # callback_data max 64 byte -> filter dipotong kalau kepanjangan
+    data = f"{kind}|{direction}|{cursor}|"
+    room = 64 - len(data.encode("utf-8"))
+    qb = q.encode("utf-8")[:room].decode("utf-8", "ignore")
+    from telegram import InlineKeyboardButton
+    return InlineKeyboardButton(label, callback_data=data + qb)
+
+def _page_markup(kind: str, first: int, last: int, has_prev: bool, has_next: bool, q: str):
+    buttons = []
+    if has_prev:
+        buttons.append(_page_button("⬅️ Prev", kind, "p", first, q))
+    if has_next:
+        buttons.append(_page_button("Next ➡️", kind, "n", last, q))
+    from telegram import InlineKeyboardMarkup
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
+async def render_dest_page(owner_id: int, cursor: int, direction: str, q: str):
+    rows, has_prev, has_next = await db_read(q_page_whitelist, owner_id, cursor, direction, q)
     if not rows:
-        return await update.message.reply_text("Whitelist kosong. Pakai /adddest dulu.")
+        if q:
+            return f"Gak ada whitelist yang judulnya mengandung '{q}'.", None
+        return "Whitelist kosong. Pakai /adddest dulu.", None
 
-    out = ["📌 WHITELIST:"]
-    for title, chat_id, thread_id in rows[:80]:
+    out = [f"📌 WHITELIST{f' (filter: {q})' if q else ''}:"]
+    for _, title, chat_id, thread_id in rows:
         out.append(f"• {title} | chat_id={chat_id} | thread_id={thread_id}")
-    if len(rows) > 80:
-        out.append(f"... dan {len(rows)-80} lainnya")
+    return "\n".join(out), _page_markup("ld", rows[0][0], rows[-1][0], has_prev, has_next, q)
+
+async def render_black_page(owner_id: int, cursor: int, direction: str, q: str):
+    rows, has_prev, has_next = await db_read(q_page_blacklist, owner_id, cursor, direction, q)
+    if not rows:
+        return ("Gak ada blacklist yang cocok." if q else "Blacklist kosong."), None
+
+    out = [f"⛔ BLACKLIST{f' (filter: {q})' if q else ''}:"]
+    for chat_id, title in rows:
+        out.append(f"• {title} | chat_id={chat_id}" if title else f"• chat_id={chat_id}")
+    return "\n".join(out), _page_markup("lb", rows[0][0], rows[-1][0], has_prev, has_next, q)
 
-    await update.message.reply_text("\n".join(out))
+PAGE_RENDERERS = {"ld": render_dest_page, "lb": render_black_page}
+
+async def cmd_listdest(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await ensure_user(update.effective_user.id)
+    # /listdest [kata] -> filter judul
+    q = " ".join(context.args or []).strip()
+    text, markup = await render_dest_page(update.effective_user.id, 0, "n", q)
+    await update.message.reply_text(text, reply_markup=markup)
 
 async def cmd_listblack(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    ensure_user(update.effective_user.id)
-    conn = db()
-    rows = conn.execute(
-        "SELECT chat_id FROM blacklist WHERE owner_id=? ORDER BY chat_id",
-        (update.effective_user.id,)
-    ).fetchall()
-    conn.close()
+    await ensure_user(update.effective_user.id)
+    q = " ".join(context.args or []).strip()
+    text, markup = await render_black_page(update.effective_user.id, 0, "n", q)
+    await update.message.reply_text(text, reply_markup=markup)
 
-    if not rows:
-        return await update.message.reply_text("Blacklist kosong.")
+async def on_list_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    try:
+        kind, direction, cursor, q = query.data.split("|", 3)
+        render = PAGE_RENDERERS[kind]
+        cursor = int(cursor)
+    except (ValueError, KeyError):
+        return await query.answer("Tombol gak valid.")
+
+    await query.answer()
+    text, markup = await render(query.from_user.id, cursor, direction, q)
+    await query.edit_message_text(text, reply_markup=markup)
+
+# ---- export/import dest (pindah akun) ----
+def _int_or_none(v) -> Optional[int]:
+    if v is None or str(v).strip() in ("", "None", "null"):
+        return None
+    return int(v)
+
+def dump_dest(wl: List[tuple], bl: List[tuple], fmt: str) -> bytes:
+    if fmt == "csv":
+        buf = io.StringIO()
+        w = csv.writer(buf)
+        w.writerow(["list", "chat_id", "thread_id", "title"])
+        for chat_id, thread_id, title in wl:
+            w.writerow(["whitelist", chat_id, "" if thread_id is None else thread_id, title or ""])
+        for chat_id, title in bl:
+            w.writerow(["blacklist", chat_id, "", title or ""])
+        return buf.getvalue().encode("utf-8")
+
+    doc = {
+        "version": 1,
+        "whitelist": [{"chat_id": c, "thread_id": t, "title": title} for c, t, title in wl],
+        "blacklist": [{"chat_id": c, "title": title} for c, title in bl],
+    }
+    return json.dumps(doc, ensure_ascii=False, indent=1).encode("utf-8")
+
+def parse_dest(data: bytes) -> Tuple[List[tuple], List[tuple]]:
+    # return (wl_rows [(chat_id, thread_id, title)], bl_rows [(chat_id, title)]); ValueError kalau rusak
+    text = data.decode("utf-8-sig")
+    wl: List[tuple] = []
+    bl: List[tuple] = []
+    if text.lstrip().startswith("{"):
+        doc = json.loads(text)
+        for r in doc.get("whitelist") or []:
+            wl.append((int(r["chat_id"]), _int_or_none(r.get("thread_id")), r.get("title") or str(r["chat_id"])))
+        for r in doc.get("blacklist") or []:
+            bl.append((int(r["chat_id"]), r.get("title")))
+    else:
+        for r in csv.DictReader(io.StringIO(text)):
+            kind = (r.get("list") or "").strip().lower()
+            if kind == "whitelist":
+                wl.append((int(r["chat_id"]), _int_or_none(r.get("thread_id")), r.get("title") or r["chat_id"]))
+            elif kind == "blacklist":
+                bl.append((int(r["chat_id"]), r.get("title") or None))
+            else:
+                raise ValueError(f"kolom list harus whitelist/blacklist, dapat '{kind}'")
+    if len(wl) + len(bl) > IMPORT_MAX_ROWS:
+        raise ValueError(f"kebanyakan baris (max {IMPORT_MAX_ROWS})")
+    return wl, bl
+
+async def cmd_exportdest(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await ensure_user(update.effective_user.id)
+    fmt = (context.args[0].lower() if context.args else "json")
+    if fmt not in ("json", "csv"):
+        return await update.message.reply_text("Pakai: /exportdest atau /exportdest csv")
+
+    wl, bl = await db_read(q_export, update.effective_user.id)
+    data = dump_dest(wl, bl, fmt)
+    await update.message.reply_document(
+        document=io.BytesIO(data),
+        filename=f"dest_{update.effective_user.id}.{fmt}",
+        caption=f"📦 Export: {len(wl)} whitelist, {len(bl)} blacklist.\nImport di akun lain: /importdest",
+    )
+
+async def cmd_importdest(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await ensure_user(update.effective_user.id)
+    context.user_data.clear()
+    context.user_data["awaiting"] = "importdest"
+    await update.message.reply_text(
+        "📥 Kirim file hasil /exportdest (JSON/CSV) sekarang.\n"
+        "Nanti muncul preview dulu sebelum diterapkan. (Batal: /cancel)"
+    )
+
+async def on_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if context.user_data.get("awaiting") != "importdest":
+        return
+
+    msg = update.message
+    try:
+        f = await msg.document.get_file()
+        wl, bl = parse_dest(bytes(await f.download_as_bytearray()))
+    except (ValueError, KeyError, TypeError, UnicodeDecodeError, csv.Error) as e:
+        context.user_data.clear()
+        return await msg.reply_text(f"❌ File gak kebaca: {e}")
+
+    wl_new, wl_gone, bl_new, bl_gone = await db_read(q_import_diff, update.effective_user.id, wl, bl)
+    context.user_data.clear()
+    context.user_data["import"] = (wl, bl)
+
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+    markup = InlineKeyboardMarkup([[
+        InlineKeyboardButton("✅ Gabung", callback_data="imp|merge"),
+        InlineKeyboardButton("♻️ Ganti total", callback_data="imp|replace"),
+        InlineKeyboardButton("❌ Batal", callback_data="imp|cancel"),
+    ]])
+    await msg.reply_text(
+        f"📋 Preview import ({len(wl)} whitelist, {len(bl)} blacklist di file):\n"
+        f"Whitelist: +{wl_new} baru | {wl_gone} yang gak ada di file\n"
+        f"Blacklist: +{bl_new} baru | {bl_gone} yang gak ada di file\n\n"
+        f"Gabung = tambah yang baru (judul di-update).\n"
+        f"Ganti total = yang gak ada di file ikut DIHAPUS.",
+        reply_markup=markup,
+    )
+
+async def on_import_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    action = query.data.split("|", 1)[1]
+    pending = context.user_data.pop("import", None)
+    await query.answer()
+
+    if action == "cancel":
+        return await query.edit_message_text("✅ Import dibatalkan.")
+    if not pending:
+        return await query.edit_message_text("❌ Data import sudah kedaluwarsa. Ulangi /importdest.")
+
+    owner_id = query.from_user.id
+    wl, bl = pending
+    await db_write(q_apply_import, owner_id, wl, bl, action == "replace")
+    CONFIG.invalidate(owner_id)
+    await config_changed(owner_id)
+    await query.edit_message_text(
+        f"✅ Import selesai ({'ganti total' if action == 'replace' else 'gabung'}): "
+        f"{len(wl)} whitelist, {len(bl)} blacklist."
+    )
+
+async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await ensure_user(update.effective_user.id)
+    parts = update.message.text.split()
+    hours = 24
+    if len(parts) == 2:
+        if not parts[1].isdigit() or not 1 <= int(parts[1]) <= 720:
+            return await update.message.reply_text("Pakai: /stats 24 (jam, 1–720)")
+        hours = int(parts[1])
+
+    # rollup diurus maintenance sender (tiap MAINT_SEC) -> kiriman paling baru bisa telat masuk
+    total, ok, flood, (removed, quarantined, active_q), pct, per_dest = await db_read(
+        q_stats, update.effective_user.id, now() - hours * 3600
+    )
+    if not total:
+        return await update.message.reply_text(f"Belum ada riwayat kirim dalam {hours} jam terakhir.")
 
-    out = ["⛔ BLACKLIST:"]
-    for (chat_id,) in rows[:150]:
-        out.append(f"• chat_id={chat_id}")
-    if len(rows) > 150:
-        out.append(f"... dan {len(rows)-150} lainnya")
+    lines = [
+        f"📊 STATS {hours} jam terakhir:",
+        f"Kirim: {total} | Sukses: {ok} ({100.0 * ok / total:.1f}%)",
+        f"Latency p50: {pct.get('p50', '-')} ms | p95: {pct.get('p95', '-')} ms",
+        f"Total FloodWait/Slowmode: {flood} detik",
+        f"Dest mati dihapus: {removed} | Masuk karantina: {quarantined} | Karantina aktif: {active_q}",
+        "\nPer destinasi (paling jelek dulu):",
+    ]
+    for chat_id, thread_key, n, n_ok in per_dest:
+        thread_id = None if thread_key == -1 else thread_key
+        lines.append(f"• chat_id={chat_id} | thread_id={thread_id} | {n_ok}/{n} ({100.0 * n_ok / n:.0f}%)")
 
-    await update.message.reply_text("\n".join(out))
+    await update.message.reply_text("\n".join(lines))
 
 # =======================
-# ENTITIES BUILDER
+# COMPILED MESSAGE CACHE
 # =======================
-def build_entities(message_entities_json: Optional[str]):
+# Entities divalidasi SEKALI waktu /setmsg disimpan, lalu hasil build
+# (MessageEntity Pyrogram) di-cache per content hash. Semua jalur kirim
+# (scheduler, /force, /forcehere) dapat objek yang sama.
+MSG_CACHE_MAX = int(os.getenv("MSG_CACHE_MAX", "256"))
+
+class CompiledMessage:
+    __slots__ = ("digest", "text", "entities", "media")
+
+    def __init__(self, digest: str, text: str, entities: Optional[List[MessageEntity]],
+                 media: Optional[dict] = None):
+        self.digest = digest
+        self.text = text
+        self.entities = entities
+        # media: {"kind", "file", "name"?} -> text jadi caption
+        self.media = media
+
+_msg_cache: "OrderedDict[str, CompiledMessage]" = OrderedDict()
+
+def utf16_len(text: str) -> int:
+    # offset/length entity Telegram dihitung dalam UTF-16 code unit
+    return len(text.encode("utf-16-le")) // 2
+
+def message_digest(text: str, entities_json: Optional[str], media_json: Optional[str] = None) -> str:
+    return hashlib.sha1(f"{text}\0{entities_json or ''}\0{media_json or ''}".encode("utf-8")).hexdigest()
+
+# nama type entity (Bot API / PTB to_dict) yang juga ada di pyrogram enums.MessageEntityType
+ENTITY_TYPES = frozenset({
+    "MENTION", "HASHTAG", "CASHTAG", "BOT_COMMAND", "URL", "EMAIL", "PHONE_NUMBER",
+    "BOLD", "ITALIC", "UNDERLINE", "STRIKETHROUGH", "SPOILER", "CODE", "PRE",
+    "BLOCKQUOTE", "TEXT_LINK", "TEXT_MENTION", "BANK_CARD", "CUSTOM_EMOJI",
+})
+
+def validate_entities(text: str, message_entities_json: Optional[str]) -> List[dict]:
+    # raise ValueError kalau ada entity yang gak valid (biar gak kekirim polos diam-diam)
+    # pure Python -> panel bisa validasi tanpa import Pyrogram
     if not message_entities_json:
+        return []
+    raw = json.loads(message_entities_json)
+    if not raw:
+        return []
+
+    limit = utf16_len(text)
+    for i, e in enumerate(raw):
+        etype = str(e.get("type") or "").upper()
+        if etype not in ENTITY_TYPES:
+            raise ValueError(f"entity #{i}: type '{e.get('type')}' tidak dikenal")
+
+        offset, length = int(e.get("offset", 0)), int(e.get("length", 0))
+        if offset < 0 or length <= 0 or offset + length > limit:
+            raise ValueError(f"entity #{i} ({etype.lower()}): offset/length di luar teks")
+
+        if etype == "CUSTOM_EMOJI" and not str(e.get("custom_emoji_id") or "").isdigit():
+            raise ValueError(f"entity #{i}: custom_emoji_id kosong/tidak valid")
+        if etype == "TEXT_LINK" and not e.get("url"):
+            raise ValueError(f"entity #{i}: text_link tanpa url")
+        if etype == "TEXT_MENTION" and not (e.get("user") or {}).get("id"):
+            raise ValueError(f"entity #{i}: text_mention tanpa user id")
+    return raw
+
+def build_entities(text: str, message_entities_json: Optional[str]) -> Optional[List[MessageEntity]]:
+    raw = validate_entities(text, message_entities_json)
+    if not raw:
         return None
-    try:
-        raw = json.loads(message_entities_json)
-        entities: List[MessageEntity] = []
-        for e in raw:
-            entities.append(
-                MessageEntity(
-                    type=e.get("type"),
-                    offset=e.get("offset", 0),
-                    length=e.get("length", 0),
-                    url=e.get("url"),
-                    user=e.get("user"),
-                    language=e.get("language"),
-                    custom_emoji_id=e.get("custom_emoji_id"),
-                )
+
+    from pyrogram import enums
+    from pyrogram.types import MessageEntity, User
+    entities: List[MessageEntity] = []
+    for i, e in enumerate(raw):
+        try:
+            kind = enums.MessageEntityType[str(e["type"]).upper()]
+        except KeyError:
+            raise ValueError(f"entity #{i}: type '{e.get('type')}' gak didukung Pyrogram")
+
+        custom_emoji_id = e.get("custom_emoji_id")
+        user = None
+        if kind == enums.MessageEntityType.TEXT_MENTION:
+            user = User(id=int(e["user"]["id"]))
+
+        entities.append(
+            MessageEntity(
+                type=kind,
+                offset=int(e.get("offset", 0)),
+                length=int(e.get("length", 0)),
+                url=e.get("url"),
+                user=user,
+                language=e.get("language"),
+                custom_emoji_id=int(custom_emoji_id) if custom_emoji_id else None,
             )
-        return entities
-    except Exception:
+        )
+    return entities
+
+def compile_message(text: str, entities_json: Optional[str],
+                    media_json: Optional[str] = None) -> CompiledMessage:
+    digest = message_digest(text, entities_json, media_json)
+    cm = _msg_cache.get(digest)
+    if cm is not None:
+        _msg_cache.move_to_end(digest)
+        return cm
+
+    try:
+        entities = build_entities(text, entities_json)
+    except (ValueError, TypeError, json.JSONDecodeError) as e:
+        # data lama yang lolos sebelum ada validasi -> kirim polos tapi JANGAN diam-diam
+        log_error("entities_invalid", e, digest=digest[:8])
+        entities = None
+
+    cm = CompiledMessage(digest, text, entities, json.loads(media_json) if media_json else None)
+    _msg_cache[digest] = cm
+    if len(_msg_cache) > MSG_CACHE_MAX:
+        _msg_cache.popitem(last=False)
+    return cm
+
+def invalidate_message(text: Optional[str], entities_json: Optional[str],
+                       media_json: Optional[str] = None):
+    if text or media_json:
+        _msg_cache.pop(message_digest(text or "", entities_json, media_json), None)
+
+def owner_message(st: OwnerState) -> CompiledMessage:
+    return compile_message(st.message_text or "", st.message_entities, st.message_media)
+
+# =======================
+# SCHEDULER (heap due-time, tanpa polling)
+# =======================
+# Sender tidur PAS sampai next_run paling awal. Handler yang ubah jadwal
+# (enable/disable/setinterval/setmsg) manggil config_changed() -> heap
+# di-update + sender dibangunin saat itu juga. Perubahan dari panel (proses lain)
+# datang lewat job reload + bel socket; resync berkala dari DB cuma nyala kalau
+# bel gagal dibuka (lihat ubot_loop), jadi sender idle beneran gak bangun.
+SCHED_RESYNC_SEC = int(os.getenv("SCHED_RESYNC_SEC", "300"))
+
+class Scheduler:
+    def __init__(self):
+        self._heap: List[Tuple[int, int]] = []
+        self._due: Dict[int, int] = {}
+        self._wake = asyncio.Event()
+        # resync berkala dari DB (fallback kalau bel job gak jalan), None = mati
+        self.resync: Optional[int] = None
+        # True cuma di proses sender (ubot_loop jalan)
+        self.active = False
+
+    def set_due(self, owner_id: int, ts: int):
+        if ts:
+            self._due[owner_id] = int(ts)
+            heapq.heappush(self._heap, (int(ts), owner_id))
+        else:
+            self._due.pop(owner_id, None)
+        self._wake.set()
+
+    def _peek(self) -> Optional[Tuple[int, int]]:
+        # entry basi (jadwal sudah diganti/dihapus) dibuang lazily
+        while self._heap:
+            ts, owner_id = self._heap[0]
+            if self._due.get(owner_id) == ts:
+                return ts, owner_id
+            heapq.heappop(self._heap)
         return None
 
+    def pop_due(self, t: float) -> List[int]:
+        owners = []
+        while True:
+            top = self._peek()
+            if top is None or top[0] > t:
+                return owners
+            heapq.heappop(self._heap)
+            del self._due[top[1]]
+            owners.append(top[1])
+
+    async def wait_due(self) -> List[int]:
+        while True:
+            self._wake.clear()
+            top = self._peek()
+            timeout = None if top is None else top[0] - time.time()
+            if timeout is not None and timeout <= 0:
+                return self.pop_due(time.time())
+            if self.resync is not None:
+                timeout = self.resync if timeout is None else min(timeout, self.resync)
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                if self.resync is not None and (top is None or top[0] > time.time()):
+                    await self.reload_all(resync=True)
+
+    async def reload(self, owner_id: int):
+        st = await CONFIG.get(owner_id)
+        if st is not None and st.enabled and not st.next_run and st.has_message() and st.dests:
+            # owner parkir (lihat run_owner) yang udah siap lagi -> langsung jalan
+            t = now()
+            if await db_write(q_unpark_owner, owner_id, t):
+                cache_next_run(owner_id, t)
+                await enqueue_job("panel", "reload", owner_id)
+        enabled, next_run = (st.enabled, st.next_run) if st else (0, 0)
+        self.set_due(owner_id, int(next_run or 0) if enabled else 0)
+
+    async def reload_all(self, resync: bool = False):
+        scheduled = {owner_id: int(next_run) for owner_id, next_run in await db_read(q_scheduled_owners)}
+        if resync:
+            # cuma owner yang jadwalnya beda sama DB yang dibuang dari cache / heap
+            dropped = CONFIG.drop_changed(scheduled)
+            for owner_id in [o for o in self._due if o not in scheduled]:
+                self.set_due(owner_id, 0)
+            if dropped:
+                log_event(logging.INFO, "sched_resync", changed=dropped)
+        for owner_id, next_run in scheduled.items():
+            if self._due.get(owner_id) != next_run:
+                self.set_due(owner_id, next_run)
+
+SCHEDULER = Scheduler()
+
+def q_scheduled_owners(conn: sqlite3.Connection):
+    return conn.execute(
+        "SELECT owner_id, next_run FROM users WHERE enabled=1 AND next_run>0"
+    ).fetchall()
+
+def q_due_owners(conn: sqlite3.Connection, t: int) -> List[int]:
+    # range scan di idx_users_due -> biaya gak tergantung jumlah owner
+    return [r[0] for r in conn.execute(
+        "SELECT owner_id FROM users WHERE enabled=1 AND next_run>0 AND next_run<=?",
+        (t,)
+    )]
+
+async def config_changed(owner_id: int):
+    # dipanggil setelah jadwal/pesan/dest berubah
+    if SCHEDULER.active:
+        await SCHEDULER.reload(owner_id)
+    else:
+        # proses panel: scheduler + cache sender ada di proses lain -> titip job reload
+        await enqueue_job("sender", "reload", owner_id)
+
 # =======================
-# UBOT SENDER CORE
+# UBOT CLIENT (1 client Pyrogram dipakai bareng)
 # =======================
-def fetch_owner_config(owner_id: int):
-    conn = db()
-    u = conn.execute(
-        "SELECT interval_hours, delay_sec, enabled, message_text, message_entities, next_run "
-        "FROM users WHERE owner_id=?",
-        (owner_id,)
+# Scheduler + /force + /forcehere pakai client yang SAMA (session file cuma
+# dibuka sekali -> gak ada lagi "database is locked"). Ada health check
+# berkala + reconnect otomatis.
+UBOT_HEALTH_SEC = int(os.getenv("UBOT_HEALTH_SEC", "60"))
+
+class UbotManager:
+    def __init__(self):
+        # None = pyrogram.Client (di-import pas connect pertama); bench bisa ganti fake client
+        self.client_cls = None
+        self._app: Optional[Client] = None
+        self._lock = asyncio.Lock()
+        self._health_task: Optional[asyncio.Task] = None
+
+    async def get(self) -> Client:
+        app = self._app
+        if app is not None and app.is_connected:
+            return app
+        async with self._lock:
+            if self._app is None or not self._app.is_connected:
+                await self._restart()
+            if self._health_task is None:
+                self._health_task = asyncio.create_task(self._health_loop())
+            return self._app
+
+    async def _restart(self):
+        old, self._app = self._app, None
+        if old is not None:
+            try:
+                await old.stop()
+            except Exception:
+                pass
+        if self.client_cls is None:
+            from pyrogram import Client
+            self.client_cls = Client
+            STARTUP.mark("import_pyrogram")
+        app = self.client_cls(PYRO_SESSION_NAME, api_id=API_ID, api_hash=API_HASH)
+        await app.start()
+        STARTUP.mark("ubot_connect")
+        self._app = app
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(UBOT_HEALTH_SEC)
+            app = self._app
+            try:
+                if app is None or not app.is_connected:
+                    raise ConnectionError("not connected")
+                await asyncio.wait_for(app.get_me(), timeout=30)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log_error("ubot_unhealthy", e)
+                async with self._lock:
+                    if self._app is app:
+                        try:
+                            await self._restart()
+                        except Exception as e2:
+                            # coba lagi di putaran health berikutnya
+                            log_error("ubot_reconnect_failed", e2)
+
+    async def stop(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            self._health_task = None
+        async with self._lock:
+            app, self._app = self._app, None
+            if app is not None:
+                try:
+                    await app.stop()
+                except Exception:
+                    pass
+
+UBOT = UbotManager()
+
+# =======================
+# SEND GOVERNOR (1 per akun userbot)
+# =======================
+# Semua jalur kirim (scheduler, /force, /forcehere) lewat sini:
+# - delay_sec jadi rate limit beneran per owner (bukan sleep setelah kirim)
+# - jarak minimum antar kirim untuk 1 akun (SEND_MIN_GAP_SEC)
+# - FloodWait dari sender mana pun = SEMUA sender pause sampai lewat
+SEND_MIN_GAP_SEC = float(os.getenv("SEND_MIN_GAP_SEC", "0.5"))
+
+class SendGovernor:
+    def __init__(self, min_gap: float = SEND_MIN_GAP_SEC):
+        self.min_gap = min_gap
+        self._lock = asyncio.Lock()
+        self._last = 0.0
+        self._paused_until = 0.0
+        self._next_ok: Dict[int, float] = {}
+        self.waiting = 0
+        self.flood_count = 0
+        self.flood_total_sec = 0.0
+
+    async def acquire(self, key: int, spacing: float):
+        self.waiting += 1
+        try:
+            while True:
+                # jatah per-owner ditunggu di luar lock biar owner lain gak ikut ketahan
+                delay = self._next_ok.get(key, 0.0) - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                async with self._lock:
+                    # sender lain owner yang sama bisa ngambil jatahnya duluan -> cek ulang di dalam lock
+                    if self._next_ok.get(key, 0.0) > time.monotonic():
+                        continue
+                    while True:
+                        t = time.monotonic()
+                        ready = max(self._paused_until, self._last + self.min_gap)
+                        if ready <= t:
+                            break
+                        await asyncio.sleep(ready - t)
+                    self._last = t
+                    self._next_ok[key] = t + max(0.0, float(spacing))
+                    return
+        finally:
+            self.waiting -= 1
+
+    async def wait_pause(self):
+        # cuma nunggu pause FloodWait akun lewat, TANPA makan jatah min gap (buat request non-kirim)
+        while True:
+            delay = self._paused_until - time.monotonic()
+            if delay <= 0:
+                return
+            await asyncio.sleep(delay)
+
+    def penalize(self, seconds: float):
+        until = time.monotonic() + seconds
+        if until > self._paused_until:
+            # FloodWait yang overlap gak dijumlah dobel
+            self.flood_total_sec += until - max(self._paused_until, time.monotonic())
+            self._paused_until = until
+        self.flood_count += 1
+
+    def snapshot(self) -> Dict[str, float]:
+        return {
+            "queue_depth": self.waiting,
+            "paused_for": max(0.0, self._paused_until - time.monotonic()),
+            "flood_count": self.flood_count,
+            "flood_total_sec": self.flood_total_sec,
+        }
+
+GOVERNOR = SendGovernor()
+Gauge("ubot_send_queue_depth", "Sender yang lagi nunggu slot governor", lambda: GOVERNOR.waiting)
+Gauge("ubot_flood_pause_seconds", "Sisa pause FloodWait akun", lambda: GOVERNOR.snapshot()["paused_for"])
+
+# =======================
+# RUNS (checkpoint per destinasi, biar restart gak kirim dobel)
+# =======================
+# Tiap run nyimpen snapshot target di run_targets. Target yang selesai
+# ditandai done=1 secara batch (RUN_CHECKPOINT_EVERY / RUN_CHECKPOINT_SEC),
+# jadi kalau crash paling banyak 1 batch yang kekirim ulang.
+RUN_CHECKPOINT_EVERY = int(os.getenv("RUN_CHECKPOINT_EVERY", "20"))
+RUN_CHECKPOINT_SEC = float(os.getenv("RUN_CHECKPOINT_SEC", "5"))
+RUN_STREAM_BATCH = int(os.getenv("RUN_STREAM_BATCH", "500"))
+
+def q_open_run(conn: sqlite3.Connection, owner_id: int, kind: str, resume: bool) -> int:
+    row = conn.execute(
+        "SELECT run_id FROM runs WHERE owner_id=? AND kind=? AND status='running' "
+        "ORDER BY run_id DESC LIMIT 1",
+        (owner_id, kind)
     ).fetchone()
+    if row and resume:
+        return row[0]
+    if row:
+        conn.execute(
+            "UPDATE runs SET status='aborted', finished_at=? WHERE owner_id=? AND kind=? AND status='running'",
+            (now(), owner_id, kind)
+        )
 
-    wl = conn.execute(
-        "SELECT chat_id, thread_id FROM whitelist WHERE owner_id=?",
-        (owner_id,)
-    ).fetchall()
+    cur = conn.execute(
+        "INSERT INTO runs(owner_id, kind, status, started_at) VALUES(?,?, 'running', ?)",
+        (owner_id, kind, now())
+    )
+    run_id = cur.lastrowid
+    cur = conn.execute(
+        "INSERT INTO run_targets(run_id, chat_id, thread_key, thread_id) "
+        "SELECT ?, w.chat_id, w.thread_key, w.thread_id FROM whitelist w "
+        "WHERE w.owner_id=? AND NOT EXISTS("
+        "  SELECT 1 FROM quarantine q WHERE q.owner_id=w.owner_id AND q.chat_id=w.chat_id "
+        "  AND q.thread_key=w.thread_key AND q.until>?"
+        ") AND NOT EXISTS("
+        "  SELECT 1 FROM blacklist b WHERE b.owner_id=w.owner_id AND b.chat_id=w.chat_id"
+        ") ORDER BY w.rowid",
+        (run_id, owner_id, now())
+    )
+    conn.execute("UPDATE runs SET total=? WHERE run_id=?", (cur.rowcount, run_id))
+    return run_id
+
+def q_pending_targets(conn: sqlite3.Connection, owner_id: int, run_id: int,
+                      after_seq: int, limit: int, media: bool = False) -> "TargetBatch":
+    # keyset per batch + anti-join blacklist LIVE (blacklist baru langsung berlaku di tengah run)
+    # + rencana dari chat_meta (yang masih fresh): -1 = skip, >0 = ready_at slowmode
+    fresh = now() - CHAT_META_TTL_SEC
+    cur = conn.execute(
+        "SELECT t.seq, t.chat_id, t.thread_key, "
+        "  CASE WHEN c.checked_at>=? AND (c.can_send=0 OR (? AND c.can_send_media=0)) THEN -1 "
+        "       WHEN tp.checked_at>=? AND tp.topic_closed=1 THEN -1 "
+        "       ELSE COALESCE(c.ready_at, 0) END "
+        "FROM run_targets t "
+        "LEFT JOIN chat_meta c ON c.chat_id=t.chat_id AND c.thread_key=-1 "
+        "LEFT JOIN chat_meta tp ON tp.chat_id=t.chat_id AND tp.thread_key=t.thread_key AND t.thread_key<>-1 "
+        "WHERE t.run_id=? AND t.done=0 AND t.seq>? AND NOT EXISTS("
+        "  SELECT 1 FROM blacklist b WHERE b.owner_id=? AND b.chat_id=t.chat_id"
+        ") ORDER BY t.seq LIMIT ?",
+        (fresh, int(media), fresh, run_id, after_seq, owner_id, limit)
+    )
+    batch = TargetBatch()
+    for seq, chat_id, thread_key, plan in cur:
+        batch.append(seq, chat_id, thread_key, plan)
+    return batch
+
+def q_mark_targets(conn: sqlite3.Connection, run_id: int, items: List[Tuple[Optional[int], int]]):
+    # items: (ok, seq) -> ok 1=terkirim, 0=gagal, NULL=skip (blacklist)
+    conn.executemany("UPDATE run_targets SET done=1, ok=? WHERE seq=?", items)
+    sent = sum(1 for ok, _ in items if ok)
+    failed = sum(1 for ok, _ in items if ok == 0)
+    conn.execute("UPDATE runs SET sent=sent+?, failed=failed+? WHERE run_id=?", (sent, failed, run_id))
+
+def q_finish_run(conn: sqlite3.Connection, run_id: int, owner_id: int, next_run: Optional[int],
+                 status: str = "done"):
+    # tutup run + set jadwal berikutnya dalam 1 transaksi; return row send_stats terbaru
+    conn.execute("UPDATE runs SET status=?, finished_at=? WHERE run_id=?", (status, now(), run_id))
+    if next_run is not None:
+        q_update_next_run(conn, owner_id, next_run)
+    conn.execute(
+        "INSERT INTO send_stats(owner_id, last_run_sec, last_run_total) "
+        "SELECT owner_id, finished_at - started_at, total FROM runs WHERE run_id=? "
+        "ON CONFLICT(owner_id) DO UPDATE SET "
+        "last_run_sec=excluded.last_run_sec, last_run_total=excluded.last_run_total",
+        (run_id,)
+    )
+    return q_send_stats_row(conn, owner_id)
+
+def q_abort_runs(conn: sqlite3.Connection, owner_id: int, kind: str):
+    conn.execute(
+        "UPDATE runs SET status='aborted', finished_at=? WHERE owner_id=? AND kind=? AND status='running'",
+        (now(), owner_id, kind)
+    )
+
+class TargetBatch:
+    # 4 array int64 (bukan list of tuple) -> jauh lebih hemat memori
+    # plan: 0 = kirim, -1 = skip (chat_meta), >0 = epoch slowmode kelar
+    __slots__ = ("seqs", "chat_ids", "thread_keys", "plans")
+
+    def __init__(self):
+        self.seqs = array("q")
+        self.chat_ids = array("q")
+        self.thread_keys = array("q")
+        self.plans = array("q")
+
+    def append(self, seq: int, chat_id: int, thread_key: int, plan: int = 0):
+        self.seqs.append(seq)
+        self.chat_ids.append(chat_id)
+        self.thread_keys.append(thread_key)
+        self.plans.append(plan)
+
+    def __len__(self) -> int:
+        return len(self.seqs)
+
+    def __iter__(self):
+        for seq, chat_id, tkey, plan in zip(self.seqs, self.chat_ids, self.thread_keys, self.plans):
+            yield seq, chat_id, (None if tkey == -1 else tkey), plan
+
+class RunProgress:
+    def __init__(self, run_id: int):
+        self.run_id = run_id
+        self._buf: List[Tuple[Optional[int], int]] = []
+        self._last_flush = time.monotonic()
+
+    async def mark(self, seq: int, ok: Optional[bool]):
+        self._buf.append((None if ok is None else int(ok), seq))
+        if len(self._buf) >= RUN_CHECKPOINT_EVERY or time.monotonic() - self._last_flush >= RUN_CHECKPOINT_SEC:
+            await self.flush()
+
+    async def flush(self):
+        self._last_flush = time.monotonic()
+        if not self._buf:
+            return
+        items, self._buf = self._buf, []
+        await db_write(q_mark_targets, self.run_id, items)
+
+async def finish_run(run_id: int, owner_id: int, next_run: Optional[int] = None, status: str = "done"):
+    stats = await db_write(q_finish_run, run_id, owner_id, next_run, status)
+    cache_send_stats({owner_id: stats})
+    if next_run is not None:
+        cache_next_run(owner_id, next_run)
+        SCHEDULER.set_due(owner_id, next_run)
+    # cache panel (next_run, dest yang dihapus, send_stats) udah basi
+    await enqueue_job("panel", "reload", owner_id)
+
+# =======================
+# ERROR CLASS + KARANTINA
+# =======================
+# permanent  -> dest mati beneran, hapus dari whitelist + laporin
+# permission -> akun gak boleh kirim (bisa dibuka lagi admin) -> karantina lama
+# transient  -> server lagi error -> karantina pendek, backoff eksponensial
+# message    -> isi pesan yang ditolak (kepanjangan, entity rusak), bukan salah dest:
+#               gak ada yang dikarantina, run dihentikan + owner dikabarin buat benerin /setmsg
+# Run berikutnya nge-skip dest yang masih dikarantina (until > now).
+PERMANENT_ERRORS = {
+    "PeerIdInvalid", "ChannelInvalid", "ChannelPrivate", "ChatIdInvalid", "ChatInvalid",
+    "ChannelBanned", "InputUserDeactivated", "UserDeactivated", "UsernameNotOccupied",
+    "UsernameInvalid", "TopicDeleted", "MessageThreadIdInvalid",
+}
+PERMISSION_ERRORS = {
+    "ChatWriteForbidden", "ChatAdminRequired", "UserBannedInChannel", "ChatRestricted",
+    "ChatSendPlainForbidden", "ChatSendMediaForbidden", "ChatGuestSendForbidden",
+    "TopicClosed", "UserNotParticipant", "ChannelPublicGroupNa",
+}
+MESSAGE_ERRORS = {
+    "MessageTooLong", "MessageEmpty", "MediaCaptionTooLong", "EntityBoundsInvalid", "EntitiesTooLong",
+    "EntityTextInvalid", "EntityMentionUserInvalid", "ButtonUrlInvalid", "ReplyMarkupInvalid",
+}
+QUARANTINE_BASE_SEC = {"transient": 15 * 60, "permission": 6 * 3600}
+QUARANTINE_MAX_SEC = int(os.getenv("QUARANTINE_MAX_SEC", str(7 * 24 * 3600)))
+
+def classify_error(e: BaseException) -> str:
+    name = type(e).__name__
+    if name in PERMANENT_ERRORS:
+        return "permanent"
+    if name in PERMISSION_ERRORS or getattr(e, "CODE", None) == 403:
+        return "permission"
+    if name in MESSAGE_ERRORS:
+        return "message"
+    # 5xx, timeout, BadRequest yang gak dikenal -> jangan hapus, karantina aja
+    return "transient"
+
+def q_quarantine(conn: sqlite3.Connection, owner_id: int, chat_id: int, thread_key: int,
+                 category: str, error: str) -> int:
+    row = conn.execute(
+        "SELECT fails FROM quarantine WHERE owner_id=? AND chat_id=? AND thread_key=?",
+        (owner_id, chat_id, thread_key)
+    ).fetchone()
+    fails = (row[0] if row else 0) + 1
+    backoff = min(QUARANTINE_BASE_SEC[category] * 2 ** (fails - 1), QUARANTINE_MAX_SEC)
+    conn.execute(
+        "INSERT OR REPLACE INTO quarantine(owner_id, chat_id, thread_key, category, fails, until, last_error) "
+        "VALUES(?,?,?,?,?,?,?)",
+        (owner_id, chat_id, thread_key, category, fails, now() + backoff, error)
+    )
+    return backoff
+
+def q_clear_quarantine(conn: sqlite3.Connection, keys: List[Tuple[int, int, int]]):
+    conn.executemany("DELETE FROM quarantine WHERE owner_id=? AND chat_id=? AND thread_key=?", keys)
+
+# =======================
+# CHAT META (slowmode/izin/forum/topic per dest)
+# =======================
+# Biar gak belajar dari gagal kirim doang. Sumber data:
+# - refresh aktif: get_chat (+ get_chat_member "me" kalau member biasa dilarang kirim),
+#   jalan di background tiap run, batch kecil, cuma chat yang basi (CHAT_META_TTL_SEC)
+# - pasif: hasil kirim (ok / error izin / SlowmodeWait) ikut di flush DeliveryLog
+# Planner (q_pending_targets) skip dest yang pasti gagal dan nunda dest yang
+# masih kena slowmode ke akhir run. Info lebih tua dari TTL dianggap gak tahu.
+CHAT_META_TTL_SEC = int(os.getenv("CHAT_META_TTL_SEC", str(12 * 3600)))
+CHAT_META_BATCH = int(os.getenv("CHAT_META_BATCH", "50"))
+CHAT_META_REFRESH_MAX = int(os.getenv("CHAT_META_REFRESH_MAX", "500"))
+CHAT_META_CONCURRENCY = int(os.getenv("CHAT_META_CONCURRENCY", "2"))
+# jarak minimum antar request meta (limiter sendiri, gak ngerebut slot kirim GOVERNOR)
+CHAT_META_GAP_SEC = float(os.getenv("CHAT_META_GAP_SEC", "1.0"))
+# error kirim -> kolom chat_meta yang di-set 0/1
+META_ERRORS = {
+    "ChatWriteForbidden": ("can_send", 0), "ChatSendPlainForbidden": ("can_send", 0),
+    "ChatRestricted": ("can_send", 0), "UserBannedInChannel": ("can_send", 0),
+    "ChatSendMediaForbidden": ("can_send_media", 0), "TopicClosed": ("topic_closed", 1),
+}
+
+# chat_id -> epoch slowmode kelar (dari SlowmodeWait terakhir), dibaca heap deferred broadcast
+SLOWMODE_UNTIL: Dict[int, float] = {}
+
+def note_slowmode(chat_id: int, wait_s: int):
+    SLOWMODE_UNTIL[chat_id] = time.time() + wait_s
+    DELIVERIES.slowmode(chat_id, wait_s)
+
+def _flag(v) -> Optional[int]:
+    return None if v is None else int(bool(v))
+
+def q_stale_meta_chats(conn: sqlite3.Connection, owner_id: int, limit: int) -> List[int]:
+    # chat di whitelist owner yang belum punya meta / sudah lewat TTL (paling basi duluan)
+    return [r[0] for r in conn.execute(
+        "SELECT w.chat_id FROM whitelist w "
+        "LEFT JOIN chat_meta m ON m.chat_id=w.chat_id AND m.thread_key=-1 "
+        "WHERE w.owner_id=? AND (m.checked_at IS NULL OR m.checked_at<?) "
+        "GROUP BY w.chat_id ORDER BY MIN(COALESCE(m.checked_at, 0)), MIN(w.rowid) LIMIT ?",
+        (owner_id, now() - CHAT_META_TTL_SEC, limit)
+    )]
+
+def q_save_chat_meta(conn: sqlite3.Connection, rows: List[tuple], touched: List[int] = ()):
+    # rows: (chat_id, slowmode_sec, can_send, can_send_media, is_forum, checked_at)
+    # izin dari refresh = sumber kebenaran (NULL = gak tahu -> planner tetap kirim)
+    conn.executemany(
+        "INSERT INTO chat_meta(chat_id, thread_key, slowmode_sec, can_send, can_send_media, is_forum, checked_at) "
+        "VALUES(?,-1,?,?,?,?,?) ON CONFLICT(chat_id, thread_key) DO UPDATE SET "
+        "slowmode_sec=COALESCE(excluded.slowmode_sec, slowmode_sec), "
+        "can_send=excluded.can_send, can_send_media=excluded.can_send_media, "
+        "is_forum=COALESCE(excluded.is_forum, is_forum), checked_at=excluded.checked_at",
+        rows
+    )
+    # touched: refresh gagal sementara -> isi lama dibiarin, cuma ditandai sudah dicek
+    t = now()
+    conn.executemany(
+        "INSERT INTO chat_meta(chat_id, thread_key, checked_at) VALUES(?,-1,?) "
+        "ON CONFLICT(chat_id, thread_key) DO UPDATE SET checked_at=excluded.checked_at",
+        [(chat_id, t) for chat_id in touched]
+    )
+
+def q_observe_chat_meta(conn: sqlite3.Connection, oks: List[Tuple[int, int, int]],
+                        flags: List[Tuple[int, int, str, int, int]], slowmodes: Dict[int, Tuple[int, int]]):
+    # oks: (chat_id, thread_key, ts) | flags: (chat_id, thread_key, kolom, nilai, ts)
+    # slowmodes: chat_id -> (ready_at, detik slowmode minimal)
+    for chat_id, (ready_at, sec) in slowmodes.items():
+        conn.execute(
+            "INSERT INTO chat_meta(chat_id, thread_key, slowmode_sec, ready_at) VALUES(?,-1,?,?) "
+            "ON CONFLICT(chat_id, thread_key) DO UPDATE SET "
+            "slowmode_sec=MAX(COALESCE(slowmode_sec, 0), excluded.slowmode_sec), ready_at=excluded.ready_at",
+            (chat_id, sec, ready_at)
+        )
+    for chat_id, tkey, ts in oks:
+        # kirim sukses = boleh kirim; slowmode (kalau ada) mulai dihitung dari sini
+        conn.execute(
+            "INSERT INTO chat_meta(chat_id, thread_key, can_send, last_ok_ts, ready_at) VALUES(?,-1,1,?,?) "
+            "ON CONFLICT(chat_id, thread_key) DO UPDATE SET can_send=1, last_ok_ts=excluded.last_ok_ts, "
+            "ready_at=excluded.last_ok_ts + COALESCE(slowmode_sec, 0)",
+            (chat_id, ts, ts)
+        )
+        if tkey != -1:
+            conn.execute(
+                "INSERT INTO chat_meta(chat_id, thread_key, topic_closed, last_ok_ts, checked_at) VALUES(?,?,0,?,?) "
+                "ON CONFLICT(chat_id, thread_key) DO UPDATE SET topic_closed=0, "
+                "last_ok_ts=excluded.last_ok_ts, checked_at=excluded.checked_at",
+                (chat_id, tkey, ts, ts)
+            )
+    for chat_id, tkey, col, val, ts in flags:
+        # kolom dari META_ERRORS (bukan input user)
+        conn.execute(
+            f"INSERT INTO chat_meta(chat_id, thread_key, {col}, checked_at) VALUES(?,?,?,?) "
+            f"ON CONFLICT(chat_id, thread_key) DO UPDATE SET {col}=excluded.{col}, checked_at=excluded.checked_at",
+            (chat_id, tkey if col == "topic_closed" else -1, val, ts)
+        )
+
+# get_chat/get_chat_member dipacing limiter sendiri; pause FloodWait akun (GOVERNOR) tetap dihormati
+META_LIMITER = SendGovernor(min_gap=CHAT_META_GAP_SEC)
+
+async def meta_slot():
+    await GOVERNOR.wait_pause()
+    await META_LIMITER.acquire(0, 0.0)
+
+async def fetch_chat_meta(app: Client, chat_id: int) -> Optional[tuple]:
+    # return row buat q_save_chat_meta; None = gak jelas (transient), biarin basi
+    from pyrogram.errors import RPCError
+    try:
+        await meta_slot()
+        chat = await app.get_chat(chat_id)
+        perms = getattr(chat, "permissions", None)
+        can_send = _flag(getattr(perms, "can_send_messages", None))
+        can_media = _flag(getattr(perms, "can_send_media_messages", None))
+        if can_send == 0 or can_media == 0:
+            # izin default member dilarang -> cek status akun sendiri (admin tetap boleh)
+            await meta_slot()
+            member = await app.get_chat_member(chat_id, "me")
+            status = str(getattr(getattr(member, "status", None), "name", "")).upper()
+            if status in ("OWNER", "ADMINISTRATOR"):
+                can_send = can_media = 1
+            elif getattr(member, "permissions", None) is not None:
+                can_send = _flag(getattr(member.permissions, "can_send_messages", can_send))
+                can_media = _flag(getattr(member.permissions, "can_send_media_messages", can_media))
+        slowmode = getattr(chat, "slow_mode_delay", None)
+        return (chat_id, slowmode, can_send, can_media, _flag(getattr(chat, "is_forum", None)), now())
+    except RPCError as e:
+        if type(e).__name__ == "FloodWait":
+            raise
+        category = classify_error(e)
+        if category == "transient":
+            return None
+        if category == "permanent":
+            # dest mati -> JANGAN di-skip; biar safe_send yang kena error-nya lalu hapus + laporin
+            return (chat_id, None, None, None, None, now())
+        # dibanned / gak boleh kirim -> gak usah dicoba sampai TTL lewat
+        return (chat_id, None, 0, 0, None, now())
+
+async def refresh_chat_meta(owner_id: int):
+    # background per run: refresh meta basi per batch; FloodWait -> berhenti, lanjut run berikutnya
+    from pyrogram.errors import FloodWait
+    sem = asyncio.Semaphore(CHAT_META_CONCURRENCY)
+
+    async def one(app: Client, chat_id: int):
+        async with sem:
+            return await fetch_chat_meta(app, chat_id)
+
+    done = 0
+    while done < CHAT_META_REFRESH_MAX:
+        chat_ids = await db_read(q_stale_meta_chats, owner_id, min(CHAT_META_BATCH, CHAT_META_REFRESH_MAX - done))
+        if not chat_ids:
+            break
+        app = await UBOT.get()
+        results = await asyncio.gather(*(one(app, c) for c in chat_ids), return_exceptions=True)
+        flood = next((r for r in results if isinstance(r, FloodWait)), None)
+        rows, touched = [], []
+        for chat_id, r in zip(chat_ids, results):
+            if isinstance(r, tuple):
+                rows.append(r)
+            elif r is not flood:
+                # gagal gak jelas tetap ditandai dicek biar batch berikutnya gak ngulang chat yang sama
+                touched.append(chat_id)
+                if r is not None:
+                    log_error("chat_meta_error", r, owner_id=owner_id, chat_id=chat_id)
+        await db_write(q_save_chat_meta, rows, touched)
+        done += len(chat_ids)
+        if flood is not None:
+            GOVERNOR.penalize(int(getattr(flood, "value", 0)) or 30)
+            log_error("chat_meta_flood", flood, owner_id=owner_id, refreshed=done)
+            return
+    if done:
+        log_event(logging.DEBUG, "chat_meta_refreshed", owner_id=owner_id, chats=done)
 
-    bl = set(r[0] for r in conn.execute(
-        "SELECT chat_id FROM blacklist WHERE owner_id=?",
+# =======================
+# DELIVERY LOG (write-behind)
+# =======================
+# Tiap hasil kirim masuk buffer di memori, lalu di-insert bulk
+# (executemany, 1 transaksi) tiap DELIVERY_FLUSH_ROWS baris / DELIVERY_FLUSH_SEC.
+# Loop kirim gak pernah nunggu DB cuma buat logging.
+DELIVERY_FLUSH_ROWS = int(os.getenv("DELIVERY_FLUSH_ROWS", "200"))
+DELIVERY_FLUSH_SEC = float(os.getenv("DELIVERY_FLUSH_SEC", "2"))
+
+def q_insert_deliveries(conn: sqlite3.Connection, rows: List[tuple]):
+    conn.executemany(
+        "INSERT INTO deliveries(ts, owner_id, run_id, chat_id, thread_key, outcome, error, latency_ms, flood_sec) "
+        "VALUES(?,?,?,?,?,?,?,?,?)",
+        rows
+    )
+
+# bobot 1 sample di EWMA latency/wait (0.05 ~ rata-rata 20 kirim terakhir)
+SEND_STATS_ALPHA = float(os.getenv("SEND_STATS_ALPHA", "0.05"))
+
+def q_send_stats_row(conn: sqlite3.Connection, owner_id: int):
+    return conn.execute(
+        "SELECT sends, latency_ms, wait_sec, last_run_sec, last_run_total FROM send_stats WHERE owner_id=?",
         (owner_id,)
-    ).fetchall())
+    ).fetchone()
 
-    conn.close()
-    return u, wl, bl
+def q_update_send_stats(conn: sqlite3.Connection, aggs: Dict[int, Tuple[int, float, float]]):
+    # aggs: owner_id -> (n, total latency_ms, total wait_sec) dari 1 batch flush
+    # EWMA per batch: alpha efektif = 1-(1-a)^n, setara update n kali dengan rata-rata batch
+    out = {}
+    for owner_id, (n, lat_sum, wait_sum) in aggs.items():
+        row = conn.execute(
+            "SELECT sends, latency_ms, wait_sec FROM send_stats WHERE owner_id=?", (owner_id,)
+        ).fetchone()
+        lat, wait = lat_sum / n, wait_sum / n
+        if row and row[1] is not None:
+            a = 1.0 - (1.0 - SEND_STATS_ALPHA) ** n
+            lat = row[1] + a * (lat - row[1])
+            wait = row[2] + a * (wait - row[2])
+        conn.execute(
+            "INSERT INTO send_stats(owner_id, sends, latency_ms, wait_sec) VALUES(?,?,?,?) "
+            "ON CONFLICT(owner_id) DO UPDATE SET sends=sends+excluded.sends, "
+            "latency_ms=excluded.latency_ms, wait_sec=excluded.wait_sec",
+            (owner_id, n, lat, wait)
+        )
+        out[owner_id] = q_send_stats_row(conn, owner_id)
+    return out
+
+def cache_send_stats(rows: Dict[int, tuple]):
+    for owner_id, stats in rows.items():
+        st = CONFIG.peek(owner_id)
+        if st is not None and stats:
+            st.stats = tuple(stats)
+
+class DeliveryLog:
+    def __init__(self):
+        self._buf: List[tuple] = []
+        self._slowmodes: Dict[int, Tuple[int, int]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._flushing: Optional[asyncio.Task] = None
+
+    def record(self, owner_id: int, run_id: Optional[int], chat_id: int, thread_id: Optional[int],
+               outcome: str, error: Optional[BaseException], t0: float, flood_sec: int = 0,
+               t1: Optional[float] = None):
+        # t1 = waktu request kirim selesai (default: sekarang); latency gak boleh ikut waktu DB
+        latency = (t1 or time.perf_counter()) - t0
+        latency_ms = int(latency * 1000)
+        SEND_TOTAL.inc(outcome)
+        SEND_LATENCY.observe(latency, outcome)
+        self._buf.append((
+            now(), owner_id, run_id, chat_id, thread_key_from(thread_id), outcome,
+            type(error).__name__ if error is not None else None, latency_ms, int(flood_sec),
+        ))
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+        if len(self._buf) >= DELIVERY_FLUSH_ROWS and (self._flushing is None or self._flushing.done()):
+            self._flushing = asyncio.create_task(self.flush())
+
+    def slowmode(self, chat_id: int, wait_s: int):
+        # SlowmodeWait -> chat_meta.ready_at (ikut flush berikutnya)
+        self._slowmodes[chat_id] = (now() + wait_s, wait_s)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(DELIVERY_FLUSH_SEC)
+            try:
+                await self.flush()
+            except Exception as e:
+                log_error("delivery_flush_failed", e, exc_info=True)
+
+    async def flush(self):
+        if not self._buf and not self._slowmodes:
+            return
+        rows, self._buf = self._buf, []
+        slowmodes, self._slowmodes = self._slowmodes, {}
+        await db_write(q_insert_deliveries, rows)
+        oks = [(r[3], r[4], r[0]) for r in rows if r[5] == "ok"]
+        flags = [(r[3], r[4]) + META_ERRORS[r[6]] + (r[0],) for r in rows if r[6] in META_ERRORS]
+        if oks or flags or slowmodes:
+            await db_write(q_observe_chat_meta, oks, flags, slowmodes)
+        # sukses = keluar dari karantina (kalau ada)
+        ok_keys = [(r[1], r[3], r[4]) for r in rows if r[5] == "ok"]
+        if ok_keys:
+            await db_write(q_clear_quarantine, ok_keys)
+        # agregat buat estimasi durasi run di /status (gak ada scan deliveries)
+        aggs: Dict[int, List] = {}
+        for r in rows:
+            a = aggs.setdefault(r[1], [0, 0.0, 0.0])
+            a[0] += 1
+            a[1] += r[7]
+            a[2] += r[8]
+        if aggs:
+            cache_send_stats(await db_write(q_update_send_stats, aggs))
+
+DELIVERIES = DeliveryLog()
 
-def update_next_run(owner_id: int, next_run: int):
-    conn = db()
-    conn.execute("UPDATE users SET next_run=? WHERE owner_id=?", (next_run, owner_id))
-    conn.commit()
-    conn.close()
+# =======================
+# RIWAYAT KIRIM (rollup + retensi + WAL)
+# =======================
+# deliveries = data mentah (write-behind dari DeliveryLog). maintenance_loop di
+# proses sender tiap MAINT_SEC:
+# - rollup: baris baru (id > watermark di rollup_state) digabung ke delivery_rollup
+#   + latency_rollup per jam & per hari, per chunk ROLLUP_CHUNK (1 transaksi pendek)
+# - retensi: hapus mentah yang sudah di-rollup & lebih tua dari DELIVERY_KEEP_DAYS,
+#   rollup jam > ROLLUP_HOURLY_KEEP_DAYS, harian > ROLLUP_DAILY_KEEP_DAYS;
+#   run_targets dari run yang sudah gak 'running' (cuma kepake buat resume),
+#   baris runs yang selesai > RUN_KEEP_DAYS;
+#   DELETE per PRUNE_CHUNK baris biar gak pernah nahan lock tulis lama
+# - WAL: checkpoint PASSIVE tiap putaran, TRUNCATE kalau file -wal kegedean
+MAINT_SEC = float(os.getenv("MAINT_SEC", "60"))
+ROLLUP_CHUNK = int(os.getenv("ROLLUP_CHUNK", "5000"))
+PRUNE_CHUNK = int(os.getenv("PRUNE_CHUNK", "2000"))
+PRUNE_MAX_CHUNKS = int(os.getenv("PRUNE_MAX_CHUNKS", "50"))  # per putaran, sisanya putaran berikutnya
+DELIVERY_KEEP_DAYS = int(os.getenv("DELIVERY_KEEP_DAYS", "14"))
+ROLLUP_HOURLY_KEEP_DAYS = int(os.getenv("ROLLUP_HOURLY_KEEP_DAYS", "60"))
+ROLLUP_DAILY_KEEP_DAYS = int(os.getenv("ROLLUP_DAILY_KEEP_DAYS", "730"))
+RUN_KEEP_DAYS = int(os.getenv("RUN_KEEP_DAYS", "30"))
+WAL_TRUNCATE_MB = int(os.getenv("WAL_TRUNCATE_MB", "32"))
+ROLLUP_SPANS = (3600, 86400)
+# batas atas bucket latency (ms) buat p50/p95 dari rollup; -1 = di atas semua
+LAT_BUCKETS_MS = (50, 100, 250, 500, 1000, 2500, 5000, 10000)
+_LAT_CASE = "CASE " + " ".join(f"WHEN latency_ms<={b} THEN {b}" for b in LAT_BUCKETS_MS) + " ELSE -1 END"
+
+def hist_quantile(hist: List[Tuple[int, int]], q: float) -> str:
+    # hist: (le_ms, n); nearest-rank, hasilnya batas bucket ("≤250")
+    rows = sorted(hist, key=lambda r: r[0] if r[0] >= 0 else float("inf"))
+    total = sum(n for _, n in rows)
+    target, seen = max(1, int(q * total + 0.999999)), 0
+    for le, n in rows:
+        seen += n
+        if seen >= target:
+            return f"≤{le}" if le >= 0 else f">{LAT_BUCKETS_MS[-1]}"
+    return "-"
+
+def q_rollup_deliveries(conn: sqlite3.Connection, chunk: int) -> int:
+    # 1 chunk: agregat + geser watermark dalam 1 transaksi -> tiap baris masuk rollup tepat sekali
+    row = conn.execute("SELECT last_id FROM rollup_state WHERE name='deliveries'").fetchone()
+    last = row[0] if row else 0
+    n, hi = conn.execute(
+        "SELECT COUNT(*), MAX(id) FROM (SELECT id FROM deliveries WHERE id>? ORDER BY id LIMIT ?)",
+        (last, chunk)
+    ).fetchone()
+    if not n:
+        return 0
+    for span in ROLLUP_SPANS:
+        conn.execute(
+            "INSERT INTO delivery_rollup(span, owner_id, bucket, chat_id, thread_key, "
+            "sends, ok, removed, quarantined, flood_sec) "
+            "SELECT ?, owner_id, ts / ? * ?, chat_id, thread_key, COUNT(*), SUM(outcome='ok'), "
+            "SUM(outcome='removed'), SUM(outcome='quarantined'), COALESCE(SUM(flood_sec), 0) "
+            "FROM deliveries WHERE id>? AND id<=? GROUP BY 2, 3, 4, 5 "
+            "ON CONFLICT(span, owner_id, bucket, chat_id, thread_key) DO UPDATE SET "
+            "sends=sends+excluded.sends, ok=ok+excluded.ok, removed=removed+excluded.removed, "
+            "quarantined=quarantined+excluded.quarantined, flood_sec=flood_sec+excluded.flood_sec",
+            (span, span, span, last, hi)
+        )
+        conn.execute(
+            "INSERT INTO latency_rollup(span, owner_id, bucket, le_ms, n) "
+            f"SELECT ?, owner_id, ts / ? * ?, {_LAT_CASE}, COUNT(*) "
+            "FROM deliveries WHERE id>? AND id<=? AND outcome='ok' GROUP BY 2, 3, 4 "
+            "ON CONFLICT(span, owner_id, bucket, le_ms) DO UPDATE SET n=n+excluded.n",
+            (span, span, span, last, hi)
+        )
+    conn.execute(
+        "INSERT INTO rollup_state(name, last_id) VALUES('deliveries', ?) "
+        "ON CONFLICT(name) DO UPDATE SET last_id=excluded.last_id",
+        (hi,)
+    )
+    return n
+
+def q_prune_deliveries(conn: sqlite3.Connection, before: int, limit: int) -> int:
+    # cuma yang sudah di-rollup; id naik seiring ts -> cukup jalan dari id terkecil
+    row = conn.execute("SELECT last_id FROM rollup_state WHERE name='deliveries'").fetchone()
+    cur = conn.execute(
+        "DELETE FROM deliveries WHERE id IN (SELECT id FROM deliveries WHERE id<=? ORDER BY id LIMIT ?) "
+        "AND ts<?",
+        (row[0] if row else 0, limit, before)
+    )
+    return cur.rowcount
+
+def q_prune_rollup(conn: sqlite3.Connection, table: str, span: int, before: int, limit: int) -> int:
+    # table: delivery_rollup / latency_rollup (konstanta, bukan input user)
+    cur = conn.execute(
+        f"DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} WHERE span=? AND bucket<? LIMIT ?)",
+        (span, before, limit)
+    )
+    return cur.rowcount
+
+def q_prune_run_targets(conn: sqlite3.Connection, limit: int) -> int:
+    # NOT IN 'running' (bukan IN done/aborted) -> target yatim yang run-nya udah kehapus ikut bersih
+    cur = conn.execute(
+        "DELETE FROM run_targets WHERE seq IN (SELECT seq FROM run_targets WHERE run_id NOT IN "
+        "(SELECT run_id FROM runs WHERE status='running') ORDER BY seq LIMIT ?)",
+        (limit,)
+    )
+    return cur.rowcount
+
+def q_prune_runs(conn: sqlite3.Connection, before: int, limit: int) -> int:
+    cur = conn.execute(
+        "DELETE FROM runs WHERE run_id IN (SELECT run_id FROM runs WHERE status<>'running' "
+        "AND finished_at<? ORDER BY run_id LIMIT ?)",
+        (before, limit)
+    )
+    return cur.rowcount
+
+def q_wal_checkpoint(conn: sqlite3.Connection, mode: str) -> Tuple[int, int, int]:
+    # (busy, page di WAL, page yang sudah di-checkpoint); TRUNCATE gak boleh nunggu lama
+    # (selama nunggu reader, writer lain ketahan) -> busy_timeout 0, gagal = coba putaran berikutnya
+    if mode == "TRUNCATE":
+        conn.execute("PRAGMA busy_timeout=0;")
+    try:
+        return conn.execute(f"PRAGMA wal_checkpoint({mode})").fetchone()
+    finally:
+        if mode == "TRUNCATE":
+            conn.execute("PRAGMA busy_timeout=5000;")
+
+def wal_size() -> int:
+    try:
+        return os.path.getsize(f"{DB_PATH}-wal")
+    except OSError:
+        return 0
+
+async def rollup_deliveries() -> int:
+    total = 0
+    while True:
+        n = await db_write(q_rollup_deliveries, ROLLUP_CHUNK)
+        total += n
+        if n < ROLLUP_CHUNK:
+            return total
+
+async def prune_history() -> int:
+    t = now()
+    jobs = [(q_prune_deliveries, t - DELIVERY_KEEP_DAYS * 86400),
+            (q_prune_run_targets,), (q_prune_runs, t - RUN_KEEP_DAYS * 86400)]
+    for table in ("delivery_rollup", "latency_rollup"):
+        jobs.append((q_prune_rollup, table, 3600, t - ROLLUP_HOURLY_KEEP_DAYS * 86400))
+        jobs.append((q_prune_rollup, table, 86400, t - ROLLUP_DAILY_KEEP_DAYS * 86400))
+
+    deleted, chunks = 0, 0
+    for fn, *args in jobs:
+        # tiap chunk = transaksi sendiri; write lain nyelip di antaranya
+        while chunks < PRUNE_MAX_CHUNKS:
+            n = await db_write(fn, *args, PRUNE_CHUNK)
+            deleted += n
+            chunks += 1
+            if n < PRUNE_CHUNK:
+                break
+    return deleted
+
+async def wal_checkpoint():
+    mode = "TRUNCATE" if wal_size() > WAL_TRUNCATE_MB * 1024 * 1024 else "PASSIVE"
+    busy, pages, done = await db_read(q_wal_checkpoint, mode)
+    if mode == "TRUNCATE" or busy:
+        log_event(logging.INFO, "wal_checkpoint", mode=mode, busy=busy, pages=pages, checkpointed=done)
+
+async def maintenance_loop():
+    last_gc = time.monotonic()  # GC media pertama nunggu 1 MEDIA_GC_SEC (startup gak dibebani)
+    while True:
+        await asyncio.sleep(MAINT_SEC)
+        try:
+            rolled = await rollup_deliveries()
+            deleted = await prune_history()
+            await wal_checkpoint()
+            if time.monotonic() - last_gc > MEDIA_GC_SEC:
+                last_gc = time.monotonic()
+                await gc_media()
+            if rolled or deleted:
+                log_event(logging.DEBUG, "maintenance", rolled_up=rolled, deleted=deleted)
+        except Exception as e:
+            log_error("maintenance_failed", e, exc_info=True)
+
+Gauge("ubot_db_wal_bytes", "Ukuran file WAL SQLite", wal_size)
+
+# =======================
+# MEDIA (upload sekali, file_id dipakai ulang)
+# =======================
+# File /setmsg disimpan lokal (nama = sha1 isi). Kirim pertama upload dari
+# disk, file_id hasilnya (file_reference ikut di dalamnya) disimpan di
+# media_cache -> kirim berikutnya (lintas run/restart) cuma kirim file_id,
+# biayanya sama kayak kirim teks. Kalau file_reference basi -> upload ulang 1x.
+MEDIA_DIR = Path(os.getenv("MEDIA_DIR", str(DB_PATH.parent / "media")))
+MEDIA_MAX_BYTES = 20 * 1024 * 1024  # batas download Bot API
+CAPTION_MAX = 1024
+MEDIA_REFRESH_ERRORS = frozenset({
+    "FileReferenceExpired", "FileReferenceInvalid", "FileReferenceEmpty", "FileIdInvalid", "MediaEmpty",
+})
+
+def q_media_file_id(conn: sqlite3.Connection, file: str) -> Optional[str]:
+    row = conn.execute("SELECT file_id FROM media_cache WHERE file=?", (file,)).fetchone()
+    return row[0] if row else None
+
+def q_save_media_file_id(conn: sqlite3.Connection, file: str, kind: str, file_id: Optional[str]):
+    conn.execute(
+        "INSERT INTO media_cache(file, kind, file_id, uploaded_at) VALUES(?,?,?,?) "
+        "ON CONFLICT(file) DO UPDATE SET kind=excluded.kind, file_id=excluded.file_id, "
+        "uploaded_at=excluded.uploaded_at",
+        (file, kind, file_id, now())
+    )
+
+def q_media_in_use(conn: sqlite3.Connection) -> Set[str]:
+    return {r[0] for r in conn.execute(
+        "SELECT DISTINCT json_extract(message_media, '$.file') FROM users WHERE message_media IS NOT NULL"
+    )}
+
+def q_media_cached(conn: sqlite3.Connection) -> List[str]:
+    return [r[0] for r in conn.execute("SELECT file FROM media_cache")]
+
+def q_drop_media(conn: sqlite3.Connection, files: List[str]) -> List[str]:
+    # cek ulang di transaksi tulis: /setmsg yang barusan masuk bisa aja pakai file yang sama
+    used = q_media_in_use(conn)
+    dropped = [f for f in files if f not in used]
+    conn.executemany("DELETE FROM media_cache WHERE file=?", [(f,) for f in dropped])
+    return dropped
+
+def file_sha1(path: Path) -> str:
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+class MediaCache:
+    def __init__(self):
+        self._ids: Dict[str, str] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        # file -> jumlah run/forcehere yang lagi pakai (bisa upload ulang kapan aja) -> jangan di-GC
+        self._held: Dict[str, int] = {}
+
+    def hold(self, msg: "CompiledMessage"):
+        if msg.media is not None:
+            file = msg.media["file"]
+            self._held[file] = self._held.get(file, 0) + 1
+
+    def release(self, msg: "CompiledMessage"):
+        if msg.media is not None:
+            file = msg.media["file"]
+            self._held[file] -= 1
+            if not self._held[file]:
+                del self._held[file]
+
+    def held(self, file: str) -> bool:
+        return file in self._held
+
+    def evict(self, file: str):
+        self._ids.pop(file, None)
+
+    async def file_id(self, file: str) -> Optional[str]:
+        fid = self._ids.get(file)
+        if fid is None:
+            fid = await db_read(q_media_file_id, file)
+            if fid:
+                self._ids[file] = fid
+        return fid
+
+    def lock(self, file: str) -> asyncio.Lock:
+        # 1 lock per file: target paralel gak upload barengan
+        return self._locks.setdefault(file, asyncio.Lock())
+
+    async def remember(self, file: str, kind: str, sent):
+        fid = getattr(getattr(sent, kind, None), "file_id", None)
+        if fid:
+            self._ids[file] = fid
+            await db_write(q_save_media_file_id, file, kind, fid)
+
+    async def forget(self, file: str, kind: str, stale: str):
+        # cuma hapus kalau masih file_id yang basi (bisa aja sudah di-refresh task lain)
+        if self._ids.get(file, stale) == stale:
+            self._ids.pop(file, None)
+            await db_write(q_save_media_file_id, file, kind, None)
+
+MEDIA = MediaCache()
+
+# GC jalan di proses sender (yang tahu run mana lagi pakai file apa), dari maintenance_loop.
+# File yang lebih muda dari MEDIA_GC_GRACE_SEC dibiarin: panel bisa lagi di antara
+# store_media dan pesan /setmsg-nya tersimpan.
+MEDIA_GC_SEC = float(os.getenv("MEDIA_GC_SEC", "3600"))
+MEDIA_GC_GRACE_SEC = int(os.getenv("MEDIA_GC_GRACE_SEC", "3600"))
+
+def _media_gc_candidates(used: Set[str], cached: List[str]) -> List[str]:
+    # file di disk (+ sisa .part download gagal) & baris media_cache yang gak dipakai owner mana pun
+    old = time.time() - MEDIA_GC_GRACE_SEC
+    files = set()
+    if MEDIA_DIR.is_dir():
+        for p in MEDIA_DIR.iterdir():
+            try:
+                if p.is_file() and p.stat().st_mtime < old:
+                    files.add(p.name)
+            except OSError:
+                pass
+    files.update(f for f in cached if not (MEDIA_DIR / f).exists())
+    return [f for f in files if f not in used and not MEDIA.held(f)]
+
+async def gc_media() -> int:
+    used = await db_read(q_media_in_use)
+    cached = await db_read(q_media_cached)
+    candidates = await asyncio.to_thread(_media_gc_candidates, used, cached)
+    if not candidates:
+        return 0
+    dropped = await db_write(q_drop_media, candidates)
+    for file in dropped:
+        if MEDIA.held(file):
+            continue  # run baru mulai pakai file ini pas kita nunggu DB
+        MEDIA.evict(file)
+        try:
+            await asyncio.to_thread(os.unlink, MEDIA_DIR / file)
+        except FileNotFoundError:
+            pass
+    log_event(logging.INFO, "media_gc", dropped=len(dropped))
+    return len(dropped)
+
+def _send_media(app: Client, chat_id: int, thread_id: Optional[int], msg: CompiledMessage, media):
+    # media: file_id (string) atau path lokal buat upload
+    kind = msg.media["kind"]
+    kw = {}
+    if kind == "document" and msg.media.get("name"):
+        kw["file_name"] = msg.media["name"]
+    return getattr(app, f"send_{kind}")(
+        chat_id, media,
+        caption=msg.text,
+        caption_entities=msg.entities,
+        message_thread_id=thread_id,
+        **kw
+    )
+
+async def send_compiled(app: Client, chat_id: int, thread_id: Optional[int], msg: CompiledMessage):
+    if msg.media is None:
+        return await app.send_message(
+            chat_id=chat_id,
+            text=msg.text,
+            entities=msg.entities,
+            message_thread_id=thread_id
+        )
+
+    from pyrogram.errors import RPCError
+    file, kind = msg.media["file"], msg.media["kind"]
+    fid = await MEDIA.file_id(file)
+    if fid is not None:
+        try:
+            return await _send_media(app, chat_id, thread_id, msg, fid)
+        except RPCError as e:
+            if type(e).__name__ not in MEDIA_REFRESH_ERRORS:
+                raise
+            log_error("media_refresh", e, level=logging.INFO, file=file)
+            await MEDIA.forget(file, kind, fid)
+
+    async with MEDIA.lock(file):
+        fid = await MEDIA.file_id(file)
+        if fid is None:
+            sent = await _send_media(app, chat_id, thread_id, msg, str(MEDIA_DIR / file))
+            await MEDIA.remember(file, kind, sent)
+            log_event(logging.INFO, "media_uploaded", file=file, kind=kind)
+            return sent
+    return await _send_media(app, chat_id, thread_id, msg, fid)
 
+# =======================
+# UBOT SENDER CORE
+# =======================
 async def safe_send(
     app: Client,
     owner_id: int,
     chat_id: int,
     thread_id: Optional[int],
-    text: str,
-    entities,
-    max_retry: int = 3
-) -> bool:
+    msg: CompiledMessage,
+    max_retry: int = 3,
+    delay_sec: float = 0.0,
+    run_id: Optional[int] = None,
+    defer: bool = False,
+    deferred: int = 0
+) -> str:
+    # return: ok / fail / removed / quarantined / invalid / error / deferred
+    # invalid = pesannya sendiri ditolak Telegram -> caller stop kirim ke dest lain
+    # defer=True: SlowmodeWait gak di-sleep di sini -> "deferred", caller yang nunda
+    # (deferred = berapa kali dest ini sudah ditunda, ikut jatah max_retry)
+    from pyrogram.errors import FloodWait, SlowmodeWait, RPCError
     attempt = 0
+    waited = 0
     while True:
+        await GOVERNOR.acquire(owner_id, delay_sec)
+        t0 = time.perf_counter()
         try:
-            await app.send_message(
-                chat_id=chat_id,
-                text=text,
-                entities=entities,
-                message_thread_id=thread_id
-            )
-            return True
+            await send_compiled(app, chat_id, thread_id, msg)
+            DELIVERIES.record(owner_id, run_id, chat_id, thread_id, "ok", None, t0, waited)
+            log_sampled("send_ok", owner_id=owner_id, run_id=run_id, chat_id=chat_id,
+                        thread_key=thread_key_from(thread_id), waited=waited or None)
+            return "ok"
 
         except SlowmodeWait as e:
             attempt += 1
             wait_s = int(getattr(e, "value", 0)) or 10
-            if attempt > max_retry:
-                return False
+            note_slowmode(chat_id, wait_s)
+            if attempt + deferred > max_retry:
+                DELIVERIES.record(owner_id, run_id, chat_id, thread_id, "fail", e, t0, waited)
+                return "fail"
+            if defer:
+                return "deferred"
+            waited += wait_s
+            WAIT_SECONDS.inc("slowmode", amount=wait_s)
             await asyncio.sleep(wait_s)
 
         except FloodWait as e:
+            # limit akun -> pause semua sender, retry nunggu di GOVERNOR.acquire()
             attempt += 1
             wait_s = int(getattr(e, "value", 0)) or 30
+            GOVERNOR.penalize(wait_s)
+            waited += wait_s
+            WAIT_SECONDS.inc("flood", amount=wait_s)
             if attempt > max_retry:
-                return False
-            await asyncio.sleep(wait_s)
+                DELIVERIES.record(owner_id, run_id, chat_id, thread_id, "fail", e, t0, waited)
+                return "fail"
 
         except RPCError as e:
-            removed = remove_dest(owner_id, chat_id, thread_id)
-            print(f"⚠️ RPCError={type(e).__name__} chat_id={chat_id} thread_id={thread_id} removed={removed}")
-            return False
+            t1 = time.perf_counter()  # stop timer sebelum remove_dest/karantina (nunggu DB)
+            category = classify_error(e)
+            if category == "permanent":
+                removed = await remove_dest(owner_id, chat_id, thread_id)
+                DELIVERIES.record(owner_id, run_id, chat_id, thread_id, "removed", e, t0, waited, t1)
+                log_error("send_removed", e, owner_id=owner_id, run_id=run_id, chat_id=chat_id,
+                          thread_key=thread_key_from(thread_id), removed=removed)
+                return "removed"
+            if category == "message":
+                DELIVERIES.record(owner_id, run_id, chat_id, thread_id, "invalid", e, t0, waited, t1)
+                log_error("send_invalid_message", e, level=logging.ERROR, owner_id=owner_id, run_id=run_id,
+                          chat_id=chat_id, thread_key=thread_key_from(thread_id))
+                return "invalid"
+
+            backoff = await db_write(
+                q_quarantine, owner_id, chat_id, thread_key_from(thread_id), category, type(e).__name__
+            )
+            DELIVERIES.record(owner_id, run_id, chat_id, thread_id, "quarantined", e, t0, waited, t1)
+            log_error("send_quarantined", e, owner_id=owner_id, run_id=run_id, chat_id=chat_id,
+                      thread_key=thread_key_from(thread_id), category=category, backoff_sec=backoff)
+            return "quarantined"
 
         except Exception as e:
-            print(f"⚠️ UnknownError={type(e).__name__} chat_id={chat_id} thread_id={thread_id}")
-            return False
+            DELIVERIES.record(owner_id, run_id, chat_id, thread_id, "error", e, t0, waited)
+            log_error("send_error", e, level=logging.ERROR, owner_id=owner_id, run_id=run_id,
+                      chat_id=chat_id, thread_key=thread_key_from(thread_id))
+            return "error"
+
+INVALID_MESSAGE_TEXT = (
+    "❌ Pesan ditolak Telegram (kepanjangan / format entity rusak). Broadcast dihentikan, "
+    "gak ada dest yang dikarantina. Benerin dulu lewat /setmsg."
+)
 
-async def ubot_loop():
-    app = Client(PYRO_SESSION_NAME, api_id=API_ID, api_hash=API_HASH)
-    await app.start()
-    print("✅ Ubot sender running...")
+# slowmode dest lebih lama dari ini (pas nunggu heap deferred di akhir run) -> di-skip
+SLOWMODE_DEFER_MAX_SEC = int(os.getenv("SLOWMODE_DEFER_MAX_SEC", "300"))
+_meta_refresh: Dict[int, asyncio.Task] = {}
 
-    while True:
-        u, wl, bl = fetch_owner_config(OWNER_ID)
-        if not u:
-            await asyncio.sleep(10)
-            continue
+def start_meta_refresh(owner_id: int):
+    # 1 refresh jalan per owner; gak ikut di-cancel pas run kelar biar progresnya gak kebuang
+    task = _meta_refresh.get(owner_id)
+    if task is not None and not task.done():
+        return
+    task = asyncio.create_task(refresh_chat_meta(owner_id))
+    _meta_refresh[owner_id] = task
+    task.add_done_callback(lambda t: _meta_refresh_done(owner_id, t))
+
+def _meta_refresh_done(owner_id: int, task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        log_error("chat_meta_failed", task.exception(), exc_info=True, owner_id=owner_id)
+
+async def broadcast(owner_id: int, kind: str, msg: CompiledMessage, delay_sec: float,
+                    resume: bool) -> Tuple[int, Dict[str, int]]:
+    # counts: jumlah per outcome safe_send
+    run_id = await db_write(q_open_run, owner_id, kind, resume)
+    progress = RunProgress(run_id)
+    counts: Dict[str, int] = {}
+    last_seq = 0
+    t0 = time.perf_counter()
+    start_meta_refresh(owner_id)
+    # heap dest yang kena slowmode: (ready_at epoch, seq, chat_id, thread_id, sudah ditunda berapa kali)
+    # slowmode cuma ngunci 1 chat -> run lanjut ke chat lain, balik lagi pas due.
+    # FloodWait (limit akun) tetap nahan semua lewat GOVERNOR.
+    deferred: List[Tuple[float, int, int, Optional[int], int]] = []
+
+    async def send(seq: int, chat_id: int, thread_id: Optional[int], n: int = 0):
+        app = await UBOT.get()
+        outcome = await safe_send(app, owner_id, chat_id, thread_id, msg, max_retry=3,
+                                  delay_sec=delay_sec, run_id=run_id, defer=True, deferred=n)
+        if outcome == "deferred":
+            ready_at = SLOWMODE_UNTIL.pop(chat_id, time.time())
+            heapq.heappush(deferred, (ready_at, seq, chat_id, thread_id, n + 1))
+            return
+        counts[outcome] = counts.get(outcome, 0) + 1
+        if outcome == "invalid":
+            return  # target dibiarin (gak di-mark); loop di bawah berhenti
+        await progress.mark(seq, outcome == "ok")
+
+    def aborted() -> bool:
+        # pesan ditolak Telegram -> dest lain pasti kena hal yang sama, stop run
+        return "invalid" in counts
+
+    async def send_due():
+        while deferred and deferred[0][0] <= time.time() and not aborted():
+            _, seq, chat_id, thread_id, n = heapq.heappop(deferred)
+            await send(seq, chat_id, thread_id, n)
+
+    async def skip(seq: int):
+        counts["skipped"] = counts.get("skipped", 0) + 1
+        await progress.mark(seq, None)
+
+    # file media pesan ini dipegang sampai run kelar (upload ulang pas file_reference basi butuh file-nya)
+    MEDIA.hold(msg)
+    try:
+        while True:
+            batch = await db_read(q_pending_targets, owner_id, run_id, last_seq, RUN_STREAM_BATCH,
+                                  msg.media is not None)
+            if not batch:
+                break
+            for seq, chat_id, thread_id, plan in batch:
+                if plan < 0:
+                    await skip(seq)
+                elif plan > now():
+                    heapq.heappush(deferred, (float(plan), seq, chat_id, thread_id, 0))
+                else:
+                    await send(seq, chat_id, thread_id)
+                await send_due()
+                if aborted():
+                    break
+            if aborted():
+                break
+            last_seq = batch.seqs[-1]
+
+        # sisa heap: tinggal nunggu slowmode yang belum kelar
+        while deferred and not aborted():
+            wait = deferred[0][0] - time.time()
+            if wait > SLOWMODE_DEFER_MAX_SEC:
+                # slowmode panjang -> coba lagi run berikutnya, jangan nahan run
+                _, seq, *_ = heapq.heappop(deferred)
+                await skip(seq)
+                continue
+            if wait > 0:
+                await asyncio.sleep(wait)
+            await send_due()
+    finally:
+        MEDIA.release(msg)
+        await progress.flush()
+        RUN_DURATION.observe(time.perf_counter() - t0, kind)
+        RUN_DESTS.observe(sum(counts.values()), kind)
+        log_event(logging.INFO, "run_finished", owner_id=owner_id, run_id=run_id, kind=kind,
+                  duration_sec=round(time.perf_counter() - t0, 1), **counts)
+
+    return run_id, counts
+
+async def run_owner(owner_id: int):
+    st = await CONFIG.get(owner_id)
+    if st is None:
+        return
 
-        interval_hours, delay_sec, enabled, message_text, message_entities, next_run = u
-        if not enabled or not message_text or not wl:
-            await asyncio.sleep(10)
-            continue
+    # belum siap kirim -> parkir (next_run=0, keluar dari q_due_owners);
+    # config_changed() -> SCHEDULER.reload() yang jadwalin ulang pas udah siap
+    if not st.enabled or not st.has_message() or not st.dests:
+        await park_owner(owner_id)
+        return
 
-        t = now()
-        if not next_run or t < int(next_run):
-            await asyncio.sleep(10)
-            continue
+    cm = owner_message(st)
 
-        entities = build_entities(message_entities)
+    # resume=True: run yang kepotong restart dilanjut dari target yang belum done
+    run_id, counts = await broadcast(owner_id, "scheduled", cm, float(st.delay_sec), resume=True)
+    if counts.get("invalid"):
+        # jadwal tetap maju 1 interval biar gak nyoba pesan rusak yang sama tiap bangun
+        await finish_run(run_id, owner_id, now() + int(st.interval_hours) * 3600, status="aborted")
+        await notify(owner_id, {"chat_id": owner_id}, INVALID_MESSAGE_TEXT)
+        return
+    await finish_run(run_id, owner_id, now() + int(st.interval_hours) * 3600)
 
-        for chat_id, thread_id in wl:
-            if chat_id in bl:
-                continue
-            await safe_send(app, OWNER_ID, chat_id, thread_id, message_text, entities, max_retry=3)
-            await asyncio.sleep(float(delay_sec))
+async def park_owner(owner_id: int):
+    await db_write(q_update_next_run, owner_id, 0)
+    cache_next_run(owner_id, 0)
+    SCHEDULER.set_due(owner_id, 0)
+    await enqueue_job("panel", "reload", owner_id)
 
-        update_next_run(OWNER_ID, now() + int(interval_hours) * 3600)
+async def ubot_loop():
+    await UBOT.get()
+
+    SCHEDULER.active = True
+    await SCHEDULER.reload_all()
+    worker = JobWorker("sender", SENDER_JOBS)
+    await worker.start()
+    if not worker.has_bell():
+        # job reload dari panel cuma ketangkep poll -> jadwal juga dicek berkala dari DB
+        SCHEDULER.resync = SCHED_RESYNC_SEC
+        log_event(logging.WARNING, "sched_resync_fallback", every_sec=SCHED_RESYNC_SEC)
+    maint = asyncio.create_task(maintenance_loop())
+    STARTUP.ready("ubot")
+    log_event(logging.INFO, "ubot_running")
+
+    # tiap owner jalan sebagai task sendiri (pacing delay_sec masing-masing)
+    running: Dict[int, asyncio.Task] = {}
+
+    try:
+        while True:
+            await SCHEDULER.wait_due()
+            # heap cuma nentuin kapan bangun; daftar due diambil dari DB (sumber kebenaran)
+            for owner_id in await db_read(q_due_owners, now()):
+                if owner_id in running:
+                    continue
+                task = asyncio.create_task(run_owner(owner_id))
+                running[owner_id] = task
+                task.add_done_callback(lambda t, oid=owner_id: _owner_done(running, oid, t))
+    finally:
+        maint.cancel()
+        await worker.stop()
+
+def _owner_done(running: Dict[int, asyncio.Task], owner_id: int, task: asyncio.Task):
+    running.pop(owner_id, None)
+    if not task.cancelled() and task.exception() is not None:
+        log_error("run_failed", task.exception(), level=logging.ERROR, exc_info=True, owner_id=owner_id)
+        # next_run masih di masa lalu -> coba lagi sebentar lagi
+        SCHEDULER.set_due(owner_id, now() + 60)
 
 # =======================
 # FORCE SEND COMMANDS
 # =======================
+def reply_payload(update: Update) -> dict:
+    # ke mana hasil job dibales (lewat job 'notify' di proses panel)
+    return {"chat_id": update.effective_chat.id, "reply_to": update.message.message_id}
+
 async def cmd_force(update: Update, context: ContextTypes.DEFAULT_TYPE):
     owner_id = update.effective_user.id
-    ensure_user(owner_id)
+    await ensure_user(owner_id)
 
-    u, wl, bl = get_user_config(owner_id)
-    if not u:
+    st = await CONFIG.get(owner_id)
+    if st is None:
         return await update.message.reply_text("❌ Config user tidak ketemu.")
 
-    interval_hours, delay_sec, enabled, message_text, message_entities, next_run = u
-    if not message_text:
+    if not st.has_message():
         return await update.message.reply_text("❌ Pesan belum diset. Pakai /setmsg dulu.")
-    if not wl:
+    if not st.dests:
         return await update.message.reply_text("❌ Whitelist kosong. Pakai /adddest dulu.")
 
-    await update.message.reply_text("🚀 Force BC dimulai...")
-
-    app = Client(PYRO_SESSION_NAME, api_id=API_ID, api_hash=API_HASH)
-    try:
-        await app.start()
-    except Exception as e:
-        return await update.message.reply_text(f"❌ Gagal start userbot: {type(e).__name__}")
-
-    entities = build_entities(message_entities)
-
-    sent = 0
-    skipped = 0
-
-    for chat_id, thread_id, title in wl:
-        if chat_id in bl:
-            skipped += 1
-            continue
-
-        ok = await safe_send(app, owner_id, chat_id, thread_id, message_text, entities, max_retry=3)
-        if ok:
-            sent += 1
-        else:
-            skipped += 1
-
-        await asyncio.sleep(float(delay_sec))
-
-    try:
-        await app.stop()
-    except Exception:
-        pass
+    active = await db_read(q_active_job, "sender", "force", owner_id)
+    if active:
+        return await update.message.reply_text(f"⏳ Force sebelumnya (job #{active}) masih jalan. Tunggu selesai dulu.")
 
-    await update.message.reply_text(f"✅ Force selesai.\nTerkirim: {sent}\nSkip/Gagal/Blacklist: {skipped}")
+    # broadcast jalan di proses sender; handler langsung balik
+    job_id = await enqueue_job("sender", "force", owner_id, reply_payload(update))
+    await update.message.reply_text(f"🚀 Force BC masuk antrian (job #{job_id}). Hasilnya dikabarin di sini.")
 
 async def cmd_forcehere(update: Update, context: ContextTypes.DEFAULT_TYPE):
     owner_id = update.effective_user.id
-    ensure_user(owner_id)
+    await ensure_user(owner_id)
 
     chat = update.effective_chat
     msg = update.message
     if not chat:
         return await msg.reply_text("❌ Chat tidak kebaca.")
 
-    u, wl, bl = get_user_config(owner_id)
-    if not u:
+    st = await CONFIG.get(owner_id)
+    if st is None:
         return await msg.reply_text("❌ Config user tidak ketemu.")
-    interval_hours, delay_sec, enabled, message_text, message_entities, next_run = u
 
-    if not message_text:
+    if not st.has_message():
         return await msg.reply_text("❌ Pesan belum diset. Pakai /setmsg dulu.")
 
     chat_id = chat.id
     thread_id = getattr(msg, "message_thread_id", None)
 
-    if chat_id in bl:
+    if chat_id in st.black:
         return await msg.reply_text("⛔ Chat ini lagi masuk blacklist.")
 
-    await msg.reply_text("🚀 Forcehere dimulai...")
+    payload = reply_payload(update)
+    payload["thread_id"] = thread_id
+    await enqueue_job("sender", "forcehere", owner_id, payload)
+
+# ---- sisi sender: job dari panel ----
+# owner yang force-nya lagi jalan di proses ini; force kedua ditolak biar gak kirim dobel
+FORCE_ACTIVE: Set[int] = set()
 
-    app = Client(PYRO_SESSION_NAME, api_id=API_ID, api_hash=API_HASH)
+async def job_force(owner_id: int, payload: dict, attempts: int):
+    if owner_id in FORCE_ACTIVE:
+        await notify(owner_id, payload, "⏳ Force sebelumnya masih jalan, yang ini di-skip.")
+        return {"skipped": "force_running"}
+    FORCE_ACTIVE.add(owner_id)
     try:
-        await app.start()
-    except Exception as e:
-        return await msg.reply_text(f"❌ Gagal start userbot: {type(e).__name__}")
+        return await _job_force(owner_id, payload, attempts)
+    finally:
+        FORCE_ACTIVE.discard(owner_id)
+
+async def _job_force(owner_id: int, payload: dict, attempts: int):
+    st = await CONFIG.get(owner_id)
+    if st is None or not st.has_message() or not st.dests:
+        await notify(owner_id, payload, "❌ Force batal: pesan/whitelist kosong.")
+        return {}
+
+    cm = owner_message(st)
+
+    # job yang diulang (sender mati di tengah run) lanjut dari target yang belum done
+    run_id, counts = await broadcast(owner_id, "force", cm, float(st.delay_sec), resume=attempts > 1)
+    if counts.get("invalid"):
+        await finish_run(run_id, owner_id, status="aborted")
+        await notify(owner_id, payload, f"{INVALID_MESSAGE_TEXT}\nTerkirim sebelum berhenti: {counts.get('ok', 0)}")
+        return counts
+    await finish_run(run_id, owner_id)
+
+    sent = counts.get("ok", 0)
+    skipped = counts.get("fail", 0) + counts.get("error", 0) + counts.get("skipped", 0)
+    await notify(
+        owner_id, payload,
+        f"✅ Force selesai.\nTerkirim: {sent}\nSkip/Gagal: {skipped}\n"
+        f"Dihapus (dest mati): {counts.get('removed', 0)}\n"
+        f"Dikarantina (gagal sementara/akses): {counts.get('quarantined', 0)}"
+    )
+    return counts
 
-    entities = build_entities(message_entities)
-    ok = await safe_send(app, owner_id, chat_id, thread_id, message_text, entities, max_retry=3)
+async def job_forcehere(owner_id: int, payload: dict, attempts: int):
+    st = await CONFIG.get(owner_id)
+    if st is None or not st.has_message():
+        await notify(owner_id, payload, "❌ Pesan belum diset. Pakai /setmsg dulu.")
+        return None
 
+    app = await UBOT.get()
+    cm = owner_message(st)
+    MEDIA.hold(cm)
     try:
-        await app.stop()
-    except Exception:
-        pass
-
-    if ok:
-        await msg.reply_text("✅ Forcehere sukses terkirim.")
+        outcome = await safe_send(app, owner_id, payload["chat_id"], payload.get("thread_id"), cm,
+                                  max_retry=3, delay_sec=float(st.delay_sec))
+    finally:
+        MEDIA.release(cm)
+
+    if outcome == "ok":
+        await notify(owner_id, payload, "✅ Forcehere sukses terkirim.")
+    elif outcome == "invalid":
+        await notify(owner_id, payload, INVALID_MESSAGE_TEXT)
     else:
-        await msg.reply_text("⚠️ Forcehere gagal / di-skip.")
+        await notify(owner_id, payload, "⚠️ Forcehere gagal / di-skip.")
+    return outcome
+
+async def job_reload_sender(owner_id: int, payload: dict, attempts: int):
+    # cache pesan ter-compile cuma ada di proses sender -> buang versi lama di sini
+    st = CONFIG.peek(owner_id)
+    if st is not None:
+        invalidate_message(st.message_text, st.message_entities, st.message_media)
+    CONFIG.invalidate(owner_id)
+    await SCHEDULER.reload(owner_id)
+
+SENDER_JOBS = {"force": job_force, "forcehere": job_forcehere, "reload": job_reload_sender}
 
 # =======================
-# RUNNERS
+# JOB QUEUE (panel <-> sender, beda proses)
 # =======================
-async def run_panel():
-    application = Application.builder().token(TOKEN).build()
+# Panel gak pernah kirim sendiri: /force, /forcehere & perubahan config masuk tabel jobs
+# (tahan restart), lalu "bel" Unix socket (datagram) ngebangunin proses tujuan.
+# Bel = jalur utama; poll JOB_POLL_SEC cuma jaring pengaman kalau datagram ilang
+# (cek antrian lewat db_read dulu, claim/BEGIN IMMEDIATE hanya kalau memang ada job).
+#   target 'sender': force / forcehere / reload (panel ngubah config owner)
+#   target 'panel' : notify (balas hasil job ke chat) / reload (sender ngubah config owner)
+JOB_POLL_SEC = float(os.getenv("JOB_POLL_SEC", "60"))
+# socket bel gagal dibuka -> gak ada yang ngebangunin, poll lebih rapat
+JOB_POLL_NOBELL_SEC = float(os.getenv("JOB_POLL_NOBELL_SEC", "5"))
+JOB_KEEP_DAYS = int(os.getenv("JOB_KEEP_DAYS", "7"))
+JOB_SOCKET_DIR = Path(os.getenv("JOB_SOCKET_DIR", str(DB_PATH.parent)))
+# job yang lama (kirim) jalan sebagai task; sisanya diproses urut di loop worker
+LONG_JOBS = {"force", "forcehere"}
+
+def job_socket(target: str) -> str:
+    return str(JOB_SOCKET_DIR / f"{DB_PATH.stem}.{target}.sock")
+
+def q_enqueue_job(conn: sqlite3.Connection, target: str, kind: str, owner_id: int,
+                  payload: Optional[dict]) -> int:
+    if kind == "reload":
+        # 1 reload yang belum diambil per owner udah cukup
+        row = conn.execute(
+            "SELECT job_id FROM jobs WHERE target=? AND status='queued' AND kind='reload' AND owner_id=?",
+            (target, owner_id)
+        ).fetchone()
+        if row:
+            return row[0]
+    cur = conn.execute(
+        "INSERT INTO jobs(target, kind, owner_id, payload, created_at) VALUES(?,?,?,?,?)",
+        (target, kind, owner_id, json.dumps(payload, ensure_ascii=False) if payload else None, now())
+    )
+    return cur.lastrowid
+
+def q_active_job(conn: sqlite3.Connection, target: str, kind: str, owner_id: int) -> Optional[int]:
+    row = conn.execute(
+        "SELECT job_id FROM jobs WHERE target=? AND kind=? AND owner_id=? AND status IN ('queued', 'running') "
+        "ORDER BY job_id LIMIT 1",
+        (target, kind, owner_id)
+    ).fetchone()
+    return row[0] if row else None
+
+def q_has_jobs(conn: sqlite3.Connection, target: str) -> bool:
+    return conn.execute(
+        "SELECT 1 FROM jobs WHERE target=? AND status='queued' LIMIT 1", (target,)
+    ).fetchone() is not None
+
+def q_claim_jobs(conn: sqlite3.Connection, target: str, limit: int = 50) -> List[tuple]:
+    rows = conn.execute(
+        "SELECT job_id, kind, owner_id, payload, attempts + 1 FROM jobs "
+        "WHERE target=? AND status='queued' ORDER BY job_id LIMIT ?",
+        (target, limit)
+    ).fetchall()
+    conn.executemany(
+        "UPDATE jobs SET status='running', started_at=?, attempts=attempts+1 WHERE job_id=?",
+        [(now(), r[0]) for r in rows]
+    )
+    return rows
+
+def q_finish_job(conn: sqlite3.Connection, job_id: int, status: str, result):
+    conn.execute(
+        "UPDATE jobs SET status=?, finished_at=?, result=? WHERE job_id=?",
+        (status, now(), json.dumps(result, ensure_ascii=False) if result is not None else None, job_id)
+    )
+
+def q_requeue_jobs(conn: sqlite3.Connection, target: str) -> int:
+    # job yang kepotong karena proses mati -> antri lagi
+    return conn.execute(
+        "UPDATE jobs SET status='queued' WHERE target=? AND status='running'", (target,)
+    ).rowcount
+
+def q_prune_jobs(conn: sqlite3.Connection):
+    conn.execute(
+        "DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished_at < ?",
+        (now() - JOB_KEEP_DAYS * 86400,)
+    )
+
+def ring(target: str):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    s.setblocking(False)
+    try:
+        s.sendto(b"1", job_socket(target))
+    except OSError:
+        pass  # proses tujuan belum jalan / buffer penuh -> ketangkep poll
+    finally:
+        s.close()
+
+async def enqueue_job(target: str, kind: str, owner_id: int, payload: Optional[dict] = None) -> int:
+    job_id = await db_write(q_enqueue_job, target, kind, owner_id, payload)
+    ring(target)
+    return job_id
+
+async def notify(owner_id: int, payload: Optional[dict], text: str):
+    # balasan ke chat asal command, dikirim bot panel (sender gak pegang token bot)
+    if payload and payload.get("chat_id"):
+        await enqueue_job("panel", "notify", owner_id,
+                          {"chat_id": payload["chat_id"], "reply_to": payload.get("reply_to"), "text": text})
+
+class _Bell(asyncio.DatagramProtocol):
+    def __init__(self, event: asyncio.Event):
+        self.event = event
+
+    def datagram_received(self, data, addr):
+        self.event.set()
+
+class JobWorker:
+    def __init__(self, target: str, handlers: Dict):
+        self.target = target
+        self.handlers = handlers
+        self._wake = asyncio.Event()
+        self._transport = None
+        self._task: Optional[asyncio.Task] = None
+        self._running: Set[asyncio.Task] = set()
+
+    async def start(self):
+        await db_write(q_requeue_jobs, self.target)
+        path = job_socket(self.target)
+        try:
+            if os.path.exists(path):
+                os.unlink(path)
+            self._transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+                lambda: _Bell(self._wake), local_addr=path, family=socket.AF_UNIX
+            )
+        except OSError as e:
+            log_error("job_socket_failed", e, path=path)  # tetap jalan, cuma ngandelin poll
+        self._task = asyncio.create_task(self._loop())
+
+    def has_bell(self) -> bool:
+        return self._transport is not None
+
+    async def _loop(self):
+        last_prune = 0.0
+        while True:
+            self._wake.clear()
+            try:
+                # antrian kosong (hampir selalu) -> cukup baca, gak ngunci writer
+                jobs = await db_write(q_claim_jobs, self.target) if await db_read(q_has_jobs, self.target) else []
+            except Exception as e:
+                log_error("job_claim_failed", e, target=self.target)
+                jobs = []
+            for job_id, kind, owner_id, payload, attempts in jobs:
+                run = self._run(job_id, kind, owner_id, json.loads(payload) if payload else {}, attempts)
+                if kind in LONG_JOBS:
+                    task = asyncio.create_task(run)
+                    self._running.add(task)
+                    task.add_done_callback(self._running.discard)
+                else:
+                    await run
+            if jobs:
+                continue  # mungkin masih ada sisa di atas limit
+            if time.monotonic() - last_prune > 3600:
+                last_prune = time.monotonic()
+                await db_write(q_prune_jobs)
+            try:
+                poll = JOB_POLL_SEC if self.has_bell() else JOB_POLL_NOBELL_SEC
+                await asyncio.wait_for(self._wake.wait(), timeout=poll)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run(self, job_id: int, kind: str, owner_id: int, payload: dict, attempts: int):
+        fn = self.handlers.get(kind)
+        try:
+            if fn is None:
+                raise ValueError(f"job kind '{kind}' gak dikenal di {self.target}")
+            result = await fn(owner_id, payload, attempts)
+            await db_write(q_finish_job, job_id, "done", result)
+        except asyncio.CancelledError:
+            raise  # shutdown -> status tetap running, di-requeue pas start berikutnya
+        except Exception as e:
+            log_error("job_failed", e, level=logging.ERROR, exc_info=True, job_id=job_id, kind=kind,
+                      owner_id=owner_id)
+            await db_write(q_finish_job, job_id, "failed", {"error": type(e).__name__, "msg": str(e)})
+            if kind != "notify":
+                await notify(owner_id, payload, f"❌ Job #{job_id} ({kind}) gagal: {type(e).__name__}")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+        for task in list(self._running):
+            task.cancel()
+        if self._transport is not None:
+            self._transport.close()
+            try:
+                os.unlink(job_socket(self.target))
+            except OSError:
+                pass
+
+def panel_jobs(bot) -> Dict:
+    async def job_notify(owner_id: int, payload: dict, attempts: int):
+        await bot.send_message(
+            chat_id=payload["chat_id"], text=payload["text"],
+            reply_to_message_id=payload.get("reply_to"), allow_sending_without_reply=True
+        )
+
+    async def job_reload_panel(owner_id: int, payload: dict, attempts: int):
+        CONFIG.invalidate(owner_id)
+
+    return {"notify": job_notify, "reload": job_reload_panel}
 
-    application.add_handler(CommandHandler("start", cmd_start))
-    application.add_handler(CommandHandler("cancel", cmd_cancel))
-    application.add_handler(CommandHandler("setmsg", cmd_setmsg))
+# ---- mode both: panel di proses ini, sender di child process (diawasi + restart) ----
+SENDER_RESTART_MAX_SEC = 60
 
-    application.add_handler(CommandHandler("adddest", cmd_adddest))
-    application.add_handler(CommandHandler("unwhitelist", cmd_unwhitelist))
-    application.add_handler(CommandHandler("blacklist", cmd_blacklist))
-    application.add_handler(CommandHandler("unblacklist", cmd_unblacklist))
+async def supervise_sender():
+    env = dict(os.environ)
+    if METRICS_PORT:
+        env["METRICS_PORT"] = str(METRICS_PORT + 1)  # sender expose metrics di port+1
+    backoff = 1
+    while True:
+        started = time.monotonic()
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, str(Path(__file__).resolve()), "ubot", env=env
+        )
+        log_event(logging.INFO, "sender_spawned", pid=proc.pid)
+        try:
+            code = await proc.wait()
+        except asyncio.CancelledError:
+            # panel shutdown -> matiin sender baik-baik (SIGINT = KillSignal di ubot.service)
+            if proc.returncode is None:
+                proc.send_signal(signal.SIGINT)
+                try:
+                    await asyncio.wait_for(proc.wait(), timeout=15)
+                except asyncio.TimeoutError:
+                    proc.kill()
+                    await proc.wait()
+            raise
+        if time.monotonic() - started > 60:
+            backoff = 1
+        log_event(logging.WARNING, "sender_exited", code=code, restart_in_sec=backoff)
+        await asyncio.sleep(backoff)
+        backoff = min(backoff * 2, SENDER_RESTART_MAX_SEC)
+
+# =======================
+# PANEL CONCURRENCY (paralel antar user, urut per user)
+# =======================
+# Default PTB proses update satu-satu: 1 handler lambat (export/import 100k,
+# /stats panjang) nahan command semua user. Sekarang update jalan paralel,
+# tapi update dari user yang SAMA tetap antri sesuai urutan masuk, jadi
+# user_data ("awaiting"/"mode"/"import") dan flow /setmsg -> teks,
+# /adddest -> forward tetap aman tanpa lock tambahan di handler.
+PANEL_CONCURRENCY = int(os.getenv("PANEL_CONCURRENCY", "256"))  # handler yang jalan barengan
+# semaphore bawaan PTB dipegang dari update masuk (termasuk yang lagi antri lock user),
+# jadi dibikin longgar; yang beneran ngebatesin handler = PANEL_CONCURRENCY
+PANEL_MAX_PENDING = int(os.getenv("PANEL_MAX_PENDING", "100000"))
+
+class UserLocks:
+    # 1 asyncio.Lock per user (FIFO -> urutan terjaga); dibuang lagi pas gak ada yang antri
+    def __init__(self):
+        self._locks: Dict[int, list] = {}  # key -> [lock, jumlah update yang pegang/antri]
+
+    async def run(self, key: Optional[int], coroutine):
+        if key is None:
+            return await coroutine
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                return await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+def update_key(update) -> Optional[int]:
+    # serialisasi per user; update tanpa user (post channel dll) per chat
+    user = getattr(update, "effective_user", None)
+    if user is not None:
+        return user.id
+    chat = getattr(update, "effective_chat", None)
+    return chat.id if chat is not None else None
+
+def user_serial_processor(max_concurrent: int = PANEL_CONCURRENCY):
+    from telegram.ext import BaseUpdateProcessor
+
+    class UserSerialProcessor(BaseUpdateProcessor):
+        def __init__(self):
+            super().__init__(max(PANEL_MAX_PENDING, max_concurrent))
+            self.locks = UserLocks()
+            self.slots = asyncio.BoundedSemaphore(max_concurrent)
+
+        async def do_process_update(self, update, coroutine):
+            # antri lock per user dulu, slot handler cuma dipegang pas handler jalan
+            # -> update yang nunggu di belakang 1 user (spam /status, import panjang)
+            # gak makan slot user lain
+            await self.locks.run(update_key(update), self._limited(coroutine))
+
+        async def _limited(self, coroutine):
+            async with self.slots:
+                await coroutine
+
+        async def initialize(self):
+            pass
 
-    application.add_handler(CommandHandler("setinterval", cmd_setinterval))
-    application.add_handler(CommandHandler("setdelay", cmd_setdelay))
+        async def shutdown(self):
+            pass
 
-    application.add_handler(CommandHandler("enable", cmd_enable))
-    application.add_handler(CommandHandler("disable", cmd_disable))
-    application.add_handler(CommandHandler("status", cmd_status))
-    application.add_handler(CommandHandler("listdest", cmd_listdest))
-    application.add_handler(CommandHandler("listblack", cmd_listblack))
+    return UserSerialProcessor()
 
-    application.add_handler(CommandHandler("force", cmd_force))
-    application.add_handler(CommandHandler("forcehere", cmd_forcehere))
+# =======================
+# RUNNERS
+# =======================
+def build_panel() -> Application:
+    from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters
+    STARTUP.mark("import_ptb")
+
+    application = Application.builder().token(TOKEN).concurrent_updates(user_serial_processor()).build()
+
+    application.add_handler(CommandHandler("start", timed("start", cmd_start)))
+    application.add_handler(CommandHandler("cancel", timed("cancel", cmd_cancel)))
+    application.add_handler(CommandHandler("setmsg", timed("setmsg", cmd_setmsg)))
+
+    application.add_handler(CommandHandler("adddest", timed("adddest", cmd_adddest)))
+    application.add_handler(CommandHandler("unwhitelist", timed("unwhitelist", cmd_unwhitelist)))
+    application.add_handler(CommandHandler("blacklist", timed("blacklist", cmd_blacklist)))
+    application.add_handler(CommandHandler("unblacklist", timed("unblacklist", cmd_unblacklist)))
+
+    application.add_handler(CommandHandler("setinterval", timed("setinterval", cmd_setinterval)))
+    application.add_handler(CommandHandler("setdelay", timed("setdelay", cmd_setdelay)))
+
+    application.add_handler(CommandHandler("enable", timed("enable", cmd_enable)))
+    application.add_handler(CommandHandler("disable", timed("disable", cmd_disable)))
+    application.add_handler(CommandHandler("status", timed("status", cmd_status)))
+    application.add_handler(CommandHandler("listdest", timed("listdest", cmd_listdest)))
+    application.add_handler(CommandHandler("listblack", timed("listblack", cmd_listblack)))
+    application.add_handler(CommandHandler("stats", timed("stats", cmd_stats)))
+    application.add_handler(CallbackQueryHandler(timed("on_list_page", on_list_page), pattern=r"^l[db]\|"))
+    application.add_handler(CommandHandler("exportdest", timed("exportdest", cmd_exportdest)))
+    application.add_handler(CommandHandler("importdest", timed("importdest", cmd_importdest)))
+    application.add_handler(CallbackQueryHandler(timed("on_import_confirm", on_import_confirm), pattern=r"^imp\|"))
+
+    application.add_handler(CommandHandler("force", timed("force", cmd_force)))
+    application.add_handler(CommandHandler("forcehere", timed("forcehere", cmd_forcehere)))
 
     # forward handler (fallback private)
-    application.add_handler(MessageHandler(filters.FORWARDED, on_forward))
+    application.add_handler(MessageHandler(filters.FORWARDED, timed("on_forward", on_forward)))
     # text handler untuk setmsg
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_text_input))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, timed("on_text_input", on_text_input)))
+    # media (foto/video/GIF/dokumen) untuk setmsg
+    application.add_handler(MessageHandler(
+        (filters.PHOTO | filters.VIDEO | filters.ANIMATION | filters.Document.ALL) & ~filters.COMMAND,
+        timed("on_media_input", on_media_input)))
+    # file untuk /importdest (group=1 biar file yang di-forward tetap kebaca walau on_forward match)
+    application.add_handler(MessageHandler(filters.Document.ALL, timed("on_document", on_document)), group=1)
 
-    await application.run_polling(close_loop=False)
+    STARTUP.mark("panel_build")
+    return application
+
+async def run_panel():
+    application = build_panel()
+    # lifecycle manual (run_polling() itu blocking & bikin loop sendiri, gak bisa di-await
+    # bareng ubot_loop dalam 1 event loop)
+    async with application:
+        await application.start()
+        await application.updater.start_polling()
+        worker = JobWorker("panel", panel_jobs(application.bot))
+        await worker.start()
+        STARTUP.ready("panel")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await worker.stop()
+            await application.updater.stop()
+            await application.stop()
 
 async def main():
     import argparse
@@ -795,15 +3713,28 @@ async def main():
     p.add_argument("mode", choices=["panel", "ubot", "both"], help="Jalankan panel / ubot / keduanya")
     args = p.parse_args()
 
-    c = db()
-    c.close()
+    setup_logging()
+    STARTUP.mark("module_load")
+    # mode both: proses ini cuma panel, sender jalan di child process
+    STARTUP.expect(args.mode, {"ubot"} if args.mode == "ubot" else {"panel"})
+    init_db()
+    STARTUP.mark("db_init")
+    if METRICS_PORT:
+        await start_metrics()
 
-    if args.mode == "panel":
-        await run_panel()
-    elif args.mode == "ubot":
-        await ubot_loop()
-    else:
-        await asyncio.gather(run_panel(), ubot_loop())
+    try:
+        if args.mode == "panel":
+            await run_panel()
+        elif args.mode == "ubot":
+            await ubot_loop()
+        else:
+            await asyncio.gather(run_panel(), supervise_sender())
+    finally:
+        await UBOT.stop()
+        # flush sisa antrian tulis sebelum exit
+        await DELIVERIES.flush()
+        WRITER.stop()
+        stop_logging()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,653 @@
+# bench_aio_bc.py
+# Benchmark + load test aio_bc TANPA akun Telegram beneran
+# - FakeClient gantiin pyrogram Client (latency + inject FloodWait/SlowmodeWait/RPCError)
+# - FakeUpdate/FakeContext gantiin objek PTB, handler panel dipanggil langsung
+# - panel + sender jalan di 1 proses ini (worker job 'panel' pakai FakeBot, ubot_loop = sender)
+# - DB sementara di tempdir (data.db production gak kesentuh)
+#
+# Contoh:
+#   python bench_aio_bc.py                                   # semua skenario, 1k + 10k dest
+#   python bench_aio_bc.py --dests 100000 --only force       # cek streaming 100k (memori + first send)
+#   python bench_aio_bc.py --dests 100000 --only stream      # streaming vs loop lama (fetchall + set blacklist)
+#   python bench_aio_bc.py --latency-ms 20 --flood-rate 0.001 --error-rate 0.01
+#   python bench_aio_bc.py --json hasil.json                 # simpan angka buat dibandingin antar commit
+#   python bench_aio_bc.py --only startup --repeat 10        # cold start per mode (proses baru tiap kali)
+#   python bench_aio_bc.py --only users --sequential         # ratusan user barengan vs proses urut
+#   python bench_aio_bc.py --only due --owners 20000         # owner parkir gak di-run ulang tiap bangun
+#
+# Skenario yang punya cek ("ok [..]" / "!! GAGAL [..]") bikin exit code 1 kalau ada yang gagal.
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+# env HARUS diset sebelum import aio_bc (config dibaca pas import)
+# (child skenario startup dikasih DB parent lewat BENCH_DB_PATH -> restart = DB udah ke-migrate)
+_TMP = tempfile.mkdtemp(prefix="aio_bc_bench_")
+os.environ["DB_PATH"] = os.environ.get("BENCH_DB_PATH") or os.path.join(_TMP, "data.db")
+os.environ.setdefault("SEND_MIN_GAP_SEC", "0")
+os.environ.setdefault("DEFAULT_DELAY_SEC", "0")
+os.environ.setdefault("LOG_LEVEL", "ERROR")  # error injeksi gak usah banjir stdout
+os.environ.setdefault("METRICS_PORT", "0")
+
+import aio_bc as bc  # noqa: E402
+
+# =======================
+# FAKE PYROGRAM
+# =======================
+class Faults:
+    latency = 0.0
+    flood_rate = 0.0
+    flood_sec = 1
+    slowmode_rate = 0.0
+    slowmode_sec = 1
+    error_rate = 0.0
+    rng = random.Random(1)
+
+class FakeClient:
+    # dipasang lewat bc.UBOT.client_cls = FakeClient -> UbotManager bikin ini, bukan Client beneran
+    sent = 0
+    attempts = 0
+    first_send_at: Optional[float] = None
+
+    def __init__(self, name=None, api_id=None, api_hash=None, **kwargs):
+        self.is_connected = False
+
+    async def start(self):
+        self.is_connected = True
+
+    async def stop(self):
+        self.is_connected = False
+
+    async def get_me(self):
+        return SimpleNamespace(id=1, is_self=True)
+
+    async def get_chat(self, chat_id):
+        # refresh chat_meta: semua chat "normal" (boleh kirim, tanpa slowmode)
+        if Faults.latency:
+            await asyncio.sleep(Faults.latency)
+        perms = SimpleNamespace(can_send_messages=True, can_send_media_messages=True)
+        return SimpleNamespace(id=chat_id, permissions=perms, is_forum=False, slow_mode_delay=0)
+
+    async def send_message(self, chat_id, text, entities=None, message_thread_id=None, **kwargs):
+        from pyrogram.errors import FloodWait, SlowmodeWait, ChatWriteForbidden, PeerIdInvalid, InternalServerError
+        FakeClient.attempts += 1
+        if Faults.latency:
+            await asyncio.sleep(Faults.latency)
+        r = Faults.rng.random()
+        if r < Faults.flood_rate:
+            raise FloodWait(value=Faults.flood_sec)
+        r -= Faults.flood_rate
+        if r < Faults.slowmode_rate:
+            raise SlowmodeWait(value=Faults.slowmode_sec)
+        r -= Faults.slowmode_rate
+        if r < Faults.error_rate:
+            # campur 3 kategori classify_error: permanent / permission / transient
+            raise Faults.rng.choice((PeerIdInvalid, ChatWriteForbidden, InternalServerError))()
+        FakeClient.sent += 1
+        if FakeClient.first_send_at is None:
+            FakeClient.first_send_at = time.perf_counter()
+        return SimpleNamespace(id=FakeClient.sent, chat=SimpleNamespace(id=chat_id))
+
+def reset_client_stats():
+    FakeClient.sent = 0
+    FakeClient.attempts = 0
+    FakeClient.first_send_at = None
+
+# =======================
+# FAKE PTB
+# =======================
+class FakeBot:
+    # tujuan job 'notify' (balasan hasil /force dll)
+    def __init__(self):
+        self.sent: List[SimpleNamespace] = []
+        self.event = asyncio.Event()
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append(SimpleNamespace(chat_id=chat_id, text=text, **kwargs))
+        self.event.set()
+
+    async def wait_for(self, chat_id: int, after: int) -> SimpleNamespace:
+        # notif pertama ke chat_id setelah index `after`
+        while True:
+            for m in self.sent[after:]:
+                if m.chat_id == chat_id:
+                    return m
+            self.event.clear()
+            await self.event.wait()
+
+BOT = FakeBot()
+_msg_ids = [0]
+
+class FakeMessage:
+    # latency palsu Bot API (0 = instan); skenario users yang nyalain
+    reply_sec = 0.0
+    upload_sec = 0.0
+
+    def __init__(self, text: str, chat, thread_id: Optional[int] = None):
+        _msg_ids[0] += 1
+        self.message_id = _msg_ids[0]
+        self.text = text
+        self.chat = chat
+        self.message_thread_id = thread_id
+        self.entities = None
+        self.document = None
+        self.forward_from_chat = None
+        self.replies: List[str] = []
+
+    async def reply_text(self, text, **kwargs):
+        if FakeMessage.reply_sec:
+            await asyncio.sleep(FakeMessage.reply_sec)
+        self.replies.append(text)
+        return SimpleNamespace(text=text)
+
+    async def reply_document(self, document=None, **kwargs):
+        if FakeMessage.upload_sec:
+            await asyncio.sleep(FakeMessage.upload_sec)
+        self.replies.append("<document>")
+        return SimpleNamespace()
+
+def fake_update(owner_id: int, text: str, chat_id: Optional[int] = None, chat_type: str = "private",
+                title: Optional[str] = None, thread_id: Optional[int] = None):
+    chat = SimpleNamespace(id=chat_id if chat_id is not None else owner_id, type=chat_type, title=title)
+    msg = FakeMessage(text, chat, thread_id)
+    user = SimpleNamespace(id=owner_id, first_name="bench", username=None)
+    return SimpleNamespace(effective_user=user, effective_chat=chat, effective_message=msg,
+                           message=msg, callback_query=None)
+
+def fake_context(text: str):
+    return SimpleNamespace(args=text.split()[1:], user_data={}, bot=None)
+
+async def call(handler, owner_id: int, text: str, **kw) -> FakeMessage:
+    update = fake_update(owner_id, text, **kw)
+    await handler(update, fake_context(text))
+    return update.message
+
+# =======================
+# UKUR
+# =======================
+def db_ops() -> int:
+    # jumlah db_read/db_write, diambil dari histogram metrics (1 observe per call)
+    return sum(sum(hits) for hits, _ in bc.DB_LATENCY._v.values())
+
+def pct(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    s = sorted(values)
+    # nearest-rank
+    return s[max(0, math.ceil(p / 100.0 * len(s)) - 1)]
+
+def rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+RESULTS: List[Dict] = []
+
+def report(name: str, **fields):
+    RESULTS.append({"scenario": name, **fields})
+    body = "  ".join(f"{k}={v:.3f}" if isinstance(v, float) else f"{k}={v}" for k, v in fields.items())
+    print(f"{name:<22} {body}", flush=True)
+
+# cek yang gagal -> exit code 1 (bisa dipasang di CI / sebelum merge)
+FAILED: List[str] = []
+
+def check(name: str, ok: bool, detail: str):
+    print(f"  {'ok' if ok else '!! GAGAL'} [{name}] {detail}", flush=True)
+    if not ok:
+        FAILED.append(name)
+
+# =======================
+# SEED
+# =======================
+_next_owner = [1000]
+
+async def seed_owner(n_dest: int, blacklist_every: int = 0) -> int:
+    owner_id = _next_owner[0]
+    _next_owner[0] += 1
+    await bc.ensure_user(owner_id)
+    wl = [(-1000000000000 - i, (i % 7) or None, f"grup {i:06d}") for i in range(n_dest)]
+    bl = [(c, t) for c, _, t in wl[::blacklist_every]] if blacklist_every else []
+    await bc.db_write(bc.q_apply_import, owner_id, wl, bl, True)
+    await bc.set_message(owner_id, "halo dari bench", "[]")
+    await bc.set_delay(owner_id, 0.0)
+    bc.CONFIG.invalidate(owner_id)
+    return owner_id
+
+async def wait_writes():
+    await bc.DELIVERIES.flush()
+    await bc.db_write(lambda conn: None)
+
+# =======================
+# SKENARIO
+# =======================
+async def bench_safe_send(n: int):
+    # overhead per send: governor + delivery log + metrics, 1 dest
+    owner_id = await seed_owner(1)
+    app = await bc.UBOT.get()
+    cm = bc.compile_message("halo", None)
+    reset_client_stats()
+    ops0 = db_ops()
+    t0 = time.perf_counter()
+    outcomes: Dict[str, int] = {}
+    for _ in range(n):
+        o = await bc.safe_send(app, owner_id, -1000000000000, None, cm, delay_sec=0.0)
+        outcomes[o] = outcomes.get(o, 0) + 1
+    dt = time.perf_counter() - t0
+    await wait_writes()
+    report("safe_send", calls=n, sends_per_sec=n / dt, us_per_call=dt / n * 1e6,
+           db_ops=db_ops() - ops0, **outcomes)
+
+async def bench_force(n_dest: int, trace_mem: bool):
+    owner_id = await seed_owner(n_dest, blacklist_every=50)
+    await bc.UBOT.get()
+    reset_client_stats()
+    ops0 = db_ops()
+    if trace_mem:
+        tracemalloc.start()
+    mark = len(BOT.sent)
+    t0 = time.perf_counter()
+    await call(bc.cmd_force, owner_id, "/force")
+    enqueue = time.perf_counter() - t0
+    done = await BOT.wait_for(owner_id, mark)
+    dt = time.perf_counter() - t0
+    peak = tracemalloc.get_traced_memory()[1] / 1e6 if trace_mem else None
+    if trace_mem:
+        tracemalloc.stop()
+    await wait_writes()
+    first = (FakeClient.first_send_at - t0) if FakeClient.first_send_at else -1.0
+    fields = dict(dests=n_dest, sent=FakeClient.sent, attempts=FakeClient.attempts,
+                  sends_per_sec=FakeClient.sent / dt if dt else 0.0, handler_ms=enqueue * 1000,
+                  first_send_sec=first, total_sec=dt, db_ops=db_ops() - ops0, rss_mb=rss_mb())
+    if peak is not None:
+        fields["py_peak_mb"] = peak
+    report("cmd_force", **fields)
+    if "selesai" not in done.text:
+        print(f"  !! notif: {done.text!r}")
+
+# ---- loop kirim lama (baseline) vs broadcast streaming ----
+# Baseline = cara lama: seluruh whitelist di-fetchall, blacklist jadi set Python, filter di loop.
+# Dua-duanya pakai safe_send + FakeClient yang sama (latency 0), jadi yang beda cuma cara
+# ambil target. Peak = alokasi Python (tracemalloc), first = detik sampai send pertama.
+def _baseline_targets(conn, owner_id: int):
+    wl = conn.execute("SELECT chat_id, thread_id FROM whitelist WHERE owner_id=?", (owner_id,)).fetchall()
+    bl = set(r[0] for r in conn.execute("SELECT chat_id FROM blacklist WHERE owner_id=?", (owner_id,)).fetchall())
+    return wl, bl
+
+async def _baseline_run(owner_id: int, cm):
+    app = await bc.UBOT.get()
+    wl, bl = await bc.db_read(_baseline_targets, owner_id)
+    for chat_id, thread_id in wl:
+        if chat_id in bl:
+            continue
+        await bc.safe_send(app, owner_id, chat_id, thread_id, cm, max_retry=3, delay_sec=0.0)
+
+async def _measure_run(fn) -> tuple:
+    reset_client_stats()
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    await fn()
+    dt = time.perf_counter() - t0
+    peak = tracemalloc.get_traced_memory()[1] / 1e6
+    tracemalloc.stop()
+    await wait_writes()
+    first = (FakeClient.first_send_at - t0) if FakeClient.first_send_at else -1.0
+    return FakeClient.sent, peak, first, dt
+
+async def bench_stream(n_dest: int):
+    owner_id = await seed_owner(n_dest, blacklist_every=10)
+    st = await bc.CONFIG.get(owner_id)
+    cm = bc.owner_message(st)
+    latency, Faults.latency = Faults.latency, 0.0
+    try:
+        base = await _measure_run(lambda: _baseline_run(owner_id, cm))
+        stream = await _measure_run(lambda: bc.broadcast(owner_id, "force", cm, 0.0, resume=False))
+    finally:
+        Faults.latency = latency
+    for name, (sent, peak, first, dt) in (("baseline", base), ("streaming", stream)):
+        report(f"stream {name}", dests=n_dest, sent=sent, py_peak_mb=peak, first_send_sec=first, total_sec=dt)
+    # target yang kekirim harus sama persis, baru bandingin biayanya
+    check("stream_sent", base[0] == stream[0], f"baseline={base[0]} streaming={stream[0]}")
+    if n_dest >= 10 * bc.RUN_STREAM_BATCH:
+        # whitelist kecil muat di 1-2 batch -> beda memorinya cuma noise, gak dicek
+        check("stream_peak", stream[1] < base[1], f"peak {stream[1]:.1f}MB vs baseline {base[1]:.1f}MB")
+        check("stream_first_send", stream[2] <= base[2],
+              f"first send {stream[2] * 1000:.0f}ms vs baseline {base[2] * 1000:.0f}ms")
+
+async def bench_ubot_loop(n_dest: int):
+    # jalur terjadwal: enable -> next_run di-set ke sekarang -> scheduler bangun -> run_owner
+    owner_id = await seed_owner(n_dest)
+    await bc.enable_owner(owner_id)
+    reset_client_stats()
+    ops0 = db_ops()
+    t0 = time.perf_counter()
+    await bc.db_write(bc.q_update_next_run, owner_id, bc.now())
+    bc.CONFIG.invalidate(owner_id)
+    await bc.config_changed(owner_id)
+
+    conn = bc.db()
+    while True:
+        await asyncio.sleep(0.05)
+        row = conn.execute(
+            "SELECT status FROM runs WHERE owner_id=? AND kind='scheduled' ORDER BY run_id DESC LIMIT 1",
+            (owner_id,)
+        ).fetchone()
+        if row and row[0] == "done":
+            break
+    dt = time.perf_counter() - t0
+    await bc.disable_owner(owner_id)
+    await wait_writes()
+    first = (FakeClient.first_send_at - t0) if FakeClient.first_send_at else -1.0
+    report("ubot_loop", dests=n_dest, sent=FakeClient.sent, sends_per_sec=FakeClient.sent / dt,
+           first_send_sec=first, total_sec=dt, db_ops=db_ops() - ops0, rss_mb=rss_mb())
+
+def _seed_parked(conn, owner_ids: List[int], due: int):
+    # owner enabled + jadwal udah lewat, tapi belum ada pesan/whitelist -> harus diparkir
+    conn.executemany("INSERT INTO users(owner_id, enabled, next_run) VALUES(?,1,?)",
+                     [(o, due) for o in owner_ids])
+
+async def bench_due(n_owners: int):
+    # owner parkir gak boleh ikut ke-scan + di-run ulang tiap scheduler bangun
+    owner_ids = list(range(_next_owner[0], _next_owner[0] + n_owners))
+    _next_owner[0] += n_owners
+    await bc.db_write(_seed_parked, owner_ids, bc.now() - 60)
+
+    t0 = time.perf_counter()
+    due = await bc.db_read(bc.q_due_owners, bc.now())
+    due_ms = (time.perf_counter() - t0) * 1000
+
+    # bangunin ubot_loop yang jalan di background, tunggu sampai semua diparkir
+    ops0 = db_ops()
+    t0 = time.perf_counter()
+    bc.SCHEDULER.set_due(owner_ids[0], bc.now())
+    left = len(due)
+    while left and time.perf_counter() - t0 < 120:
+        await asyncio.sleep(0.05)
+        left = len(await bc.db_read(bc.q_due_owners, bc.now()))
+    park_sec = time.perf_counter() - t0
+    park_ops = db_ops() - ops0
+
+    # bangun berikutnya: harusnya gak ada owner parkir yang di-run ulang
+    ops0 = db_ops()
+    t0 = time.perf_counter()
+    after = await bc.db_read(bc.q_due_owners, bc.now())
+    idle_ms = (time.perf_counter() - t0) * 1000
+    idle_ops = db_ops() - ops0
+    report("due", owners=n_owners, due_before=len(due), due_query_ms=due_ms, park_sec=park_sec,
+           park_db_ops=park_ops, due_after=len(after), idle_wakeup_ms=idle_ms, idle_db_ops=idle_ops)
+    check("due_parked", not after, f"{len(after)} owner parkir masih due setelah {park_sec:.1f}s")
+    # biaya per bangun gak ikut jumlah owner: 1 query, range scan di idx_users_due (bukan scan users)
+    plan = " ".join(r[-1] for r in bc.db().execute(
+        "EXPLAIN QUERY PLAN SELECT owner_id FROM users WHERE enabled=1 AND next_run>0 AND next_run<=?",
+        (bc.now(),)
+    ))
+    check("due_scan", "idx_users_due" in plan and idle_ops == 1, f"plan={plan!r}, db_ops per bangun={idle_ops}")
+
+PANEL_MIX = [
+    ("start", "/start", {}),
+    ("status", "/status", {}),
+    ("listdest", "/listdest", {}),
+    ("listdest_q", "/listdest grup 0001", {}),
+    ("listblack", "/listblack", {}),
+    ("stats", "/stats", {}),
+    ("setdelay", "/setdelay 0", {}),
+    ("setinterval", "/setinterval 12", {}),
+    ("adddest", "/adddest", {"chat_type": "supergroup", "title": "bench grup"}),
+    ("blacklist", "/blacklist", {"chat_type": "supergroup", "title": "bench blok"}),
+]
+
+def _handler_for(name: str):
+    return getattr(bc, "cmd_" + name.split("_")[0])
+
+async def _panel_round(owner_id: int, rounds: int, lat: Dict[str, List[float]], ops: Dict[str, int]):
+    # catatan: pas skenario load, db_ops ikut ngitung op /force yang jalan barengan
+    for i in range(rounds):
+        for name, text, kw in PANEL_MIX:
+            if "chat_type" in kw:
+                kw = dict(kw, chat_id=-2000000000000 - i)
+            before = db_ops()
+            t0 = time.perf_counter()
+            await call(_handler_for(name), owner_id, text, **kw)
+            lat.setdefault(name, []).append(time.perf_counter() - t0)
+            ops[name] = ops.get(name, 0) + db_ops() - before
+
+def _report_panel(label: str, rounds: int, lat: Dict[str, List[float]], ops: Dict[str, int]):
+    every = [v for vs in lat.values() for v in vs]
+    report(label, calls=len(every), p50_ms=pct(every, 50) * 1000, p99_ms=pct(every, 99) * 1000,
+           max_ms=max(every) * 1000)
+    for name, vs in lat.items():
+        report(f"  {name}", p50_ms=pct(vs, 50) * 1000, p99_ms=pct(vs, 99) * 1000,
+               db_ops_per_cmd=ops[name] / rounds)
+
+async def bench_panel(n_dest: int, rounds: int, max_p99_ms: float):
+    owner_id = await seed_owner(n_dest, blacklist_every=20)
+
+    # idle: cuma panel
+    lat: Dict[str, List[float]] = {}
+    ops: Dict[str, int] = {}
+    await _panel_round(owner_id, rounds, lat, ops)
+    _report_panel(f"panel idle {n_dest}", rounds, lat, ops)
+
+    # load: owner lain lagi /force ke n_dest grup, panel harus tetap responsif
+    busy_owner = await seed_owner(n_dest)
+    await bc.UBOT.get()
+    reset_client_stats()
+    mark = len(BOT.sent)
+    await call(bc.cmd_force, busy_owner, "/force")
+    force = asyncio.create_task(BOT.wait_for(busy_owner, mark))
+    while FakeClient.first_send_at is None and not force.done():
+        await asyncio.sleep(0.001)
+    lat, ops = {}, {}
+    await _panel_round(owner_id, rounds, lat, ops)
+    loaded = not force.done()
+    _report_panel(f"panel load {n_dest}", rounds, lat, ops)
+    # panel harus tetap datar selama broadcast besar lagi nulis (DB di thread, bukan di event loop)
+    p99 = pct([v for vs in lat.values() for v in vs], 99) * 1000
+    check("panel_under_load", loaded and p99 <= max_p99_ms,
+          f"p99={p99:.1f}ms (maks {max_p99_ms:g}ms), broadcast masih jalan={loaded}"
+          + ("" if loaded else " -> naikin --latency-ms / --dests"))
+    await force
+    await wait_writes()
+
+# ---- banyak user barengan: user_serial_processor() (dipakai Application) vs 1 slot global (default PTB) ----
+# Tiap user datang di waktu acak dalam USERS_ARRIVAL_SEC dan kirim 3 update sekaligus
+# (/setmsg, teks pesan, /status); tiap HEAVY_EVERY user ada 1 yang /exportdest whitelist besar.
+# Latency = dari update masuk sampai handler-nya selesai (termasuk antri di belakang update
+# user yang sama). Urutan per user dicek: pesan yang tersimpan harus teks dari burst itu.
+USERS_ARRIVAL_SEC = 1.0
+HEAVY_EVERY = 50
+
+async def _user_burst(processor, owner_id: int, heavy: bool, lat: List[float], rng: random.Random) -> bool:
+    await asyncio.sleep(rng.random() * USERS_ARRIVAL_SEC)
+    user_data: Dict = {}
+    text = f"pesan bench {owner_id} {rng.random():.6f}"
+    steps = [(bc.cmd_setmsg, "/setmsg"), (bc.on_text_input, text), (bc.cmd_status, "/status")]
+    if heavy:
+        steps.append((bc.cmd_exportdest, "/exportdest"))
+
+    async def one(handler, t: str, t0: float):
+        update = fake_update(owner_id, t)
+        ctx = SimpleNamespace(args=t.split()[1:], user_data=user_data, bot=None)
+        # lewat processor yang sama kayak Application (urut per user + batas global)
+        await processor.process_update(update, handler(update, ctx))
+        lat.append(time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    # 1 task per update, dibuat urut (sama kayak update fetcher PTB)
+    await asyncio.gather(*(one(h, t, t0) for h, t in steps))
+    st = await bc.CONFIG.get(owner_id)
+    return st.message_text == text
+
+async def bench_users(counts: List[int], heavy_dests: int, sequential: bool):
+    FakeMessage.reply_sec, FakeMessage.upload_sec = 0.02, 0.3
+    # concurrent = processor panel beneran; sequential = 1 slot (setara PTB default)
+    modes = [("concurrent", bc.PANEL_CONCURRENCY)]
+    if sequential:
+        modes.append(("sequential", 1))
+    try:
+        for n in counts:
+            owners = [await seed_owner(heavy_dests if i % HEAVY_EVERY == 0 else 5) for i in range(n)]
+            for mode, max_concurrent in modes:
+                processor = bc.user_serial_processor(max_concurrent)
+                lat: List[float] = []
+                rng = random.Random(n)
+                t0 = time.perf_counter()
+                ordered = await asyncio.gather(*(
+                    _user_burst(processor, o, i % HEAVY_EVERY == 0, lat, rng) for i, o in enumerate(owners)
+                ))
+                report(f"users {n} {mode}", updates=len(lat), p50_ms=pct(lat, 50) * 1000,
+                       p99_ms=pct(lat, 99) * 1000, total_sec=time.perf_counter() - t0,
+                       out_of_order=ordered.count(False), locks_left=len(processor.locks))
+    finally:
+        FakeMessage.reply_sec = FakeMessage.upload_sec = 0.0
+
+# =======================
+# MAIN
+# =======================
+# ---- cold start per mode: spawn proses baru, ukur sampai "ready" ----
+# Child jalanin jalur startup yang sama kayak main() minus network (getMe/polling PTB,
+# connect MTProto diganti FakeClient), terus lapor modul apa aja yang ke-load.
+async def startup_child(mode: str):
+    bc.STARTUP.mark("module_load")
+    bc.STARTUP.expect(mode, {mode})
+    bc.init_db()
+    bc.STARTUP.mark("db_init")
+    if mode == "panel":
+        bc.build_panel()
+        bc.STARTUP.ready("panel")
+    if mode == "ubot":
+        from pyrogram import Client  # noqa: F401  (biaya import sama kayak UbotManager._restart)
+        bc.STARTUP.mark("import_pyrogram")
+        bc.UBOT.client_cls = FakeClient
+        await bc.UBOT.get()
+        await bc.SCHEDULER.reload_all()
+        bc.STARTUP.ready("ubot")
+    print("READY " + json.dumps({
+        "phases_ms": bc.STARTUP.phases,
+        "pyrogram": "pyrogram" in sys.modules,
+        "telegram": "telegram" in sys.modules,
+    }), flush=True)
+    await bc.UBOT.stop()
+    bc.WRITER.stop()
+
+def bench_startup(repeat: int):
+    env = dict(os.environ, BENCH_DB_PATH=os.environ["DB_PATH"])
+    # mode both = proses panel + child ubot, jadi cukup ukur 2 ini
+    for mode in ("panel", "ubot"):
+        times: List[float] = []
+        info: Dict = {}
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            p = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--startup-child", mode],
+                                 stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, env=env)
+            for line in p.stdout:
+                if line.startswith("READY "):
+                    times.append(time.perf_counter() - t0)
+                    info = json.loads(line[6:])
+                    break
+            p.wait()
+        if not times:
+            print(f"  !! child {mode} gak pernah ready (exit={p.returncode})")
+            continue
+        report(f"startup {mode}", runs=len(times), p50_ms=pct(times, 50) * 1000, max_ms=max(times) * 1000,
+               pyrogram=info["pyrogram"], telegram=info["telegram"])
+        report("  phases_ms", **info["phases_ms"])
+        leaked = (mode == "panel" and info["pyrogram"]) or (mode == "ubot" and info["telegram"])
+        if leaked:
+            print(f"  !! mode {mode} ke-load library mode lain")
+
+SCENARIOS = ("startup", "safe_send", "force", "stream", "ubot_loop", "panel", "users", "due")
+
+async def main_async(args):
+    bc.setup_logging()
+    bc.init_db()
+    only = set(args.only.split(",")) if args.only else set(SCENARIOS)
+    sizes = [int(x) for x in args.dests.split(",") if x]
+    print(f"DB sementara: {os.environ['DB_PATH']}  latency={Faults.latency * 1000:.1f}ms "
+          f"flood={Faults.flood_rate} slowmode={Faults.slowmode_rate} error={Faults.error_rate}")
+    sender = asyncio.create_task(bc.ubot_loop())
+    panel = bc.JobWorker("panel", bc.panel_jobs(BOT))
+    await panel.start()
+    try:
+        if "startup" in only:
+            bench_startup(args.repeat)
+        if "safe_send" in only:
+            await bench_safe_send(args.calls)
+        for n in sizes:
+            if "force" in only:
+                await bench_force(n, args.tracemalloc)
+            if "stream" in only:
+                await bench_stream(n)
+            if "ubot_loop" in only:
+                await bench_ubot_loop(n)
+            if "panel" in only:
+                await bench_panel(n, args.rounds, args.max_panel_p99_ms)
+        if "users" in only:
+            await bench_users([int(x) for x in args.users.split(",") if x], args.heavy_dests, args.sequential)
+        if "due" in only:
+            await bench_due(args.owners)
+    finally:
+        sender.cancel()
+        await asyncio.gather(sender, return_exceptions=True)
+        await panel.stop()
+        await bc.UBOT.stop()
+        await bc.DELIVERIES.flush()
+        bc.WRITER.stop()
+        bc.stop_logging()
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(RESULTS, f, indent=2)
+
+def main():
+    p = argparse.ArgumentParser(description="Benchmark aio_bc pakai fake Pyrogram/PTB")
+    p.add_argument("--dests", default="1000,10000", help="ukuran whitelist, koma (mis. 1000,10000,100000)")
+    p.add_argument("--only", default="", help=f"skenario, koma: {','.join(SCENARIOS)}")
+    p.add_argument("--calls", type=int, default=5000, help="jumlah call di skenario safe_send")
+    p.add_argument("--rounds", type=int, default=30, help="putaran command mix di skenario panel")
+    p.add_argument("--max-panel-p99-ms", type=float, default=50.0,
+                   help="skenario panel: batas p99 command pas broadcast jalan (lewat = exit 1)")
+    p.add_argument("--latency-ms", type=float, default=1.0, help="latency palsu per send_message")
+    p.add_argument("--flood-rate", type=float, default=0.0)
+    p.add_argument("--flood-sec", type=int, default=1)
+    p.add_argument("--slowmode-rate", type=float, default=0.0)
+    p.add_argument("--slowmode-sec", type=int, default=1)
+    p.add_argument("--error-rate", type=float, default=0.0, help="RPCError (permanent/permission/transient)")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--tracemalloc", action="store_true", help="ukur peak alokasi Python di cmd_force (lebih lambat)")
+    p.add_argument("--users", default="50,200,500", help="jumlah user simultan di skenario users, koma")
+    p.add_argument("--heavy-dests", type=int, default=10000, help="whitelist user berat (/exportdest) di skenario users")
+    p.add_argument("--sequential", action="store_true", help="skenario users: bandingkan dengan proses urut global")
+    p.add_argument("--owners", type=int, default=5000, help="jumlah owner parkir di skenario due")
+    p.add_argument("--repeat", type=int, default=5, help="jumlah spawn per mode di skenario startup")
+    p.add_argument("--json", default="", help="tulis hasil ke file JSON")
+    p.add_argument("--startup-child", default="", help=argparse.SUPPRESS)
+    args = p.parse_args()
+
+    if args.startup_child:
+        asyncio.run(startup_child(args.startup_child))
+        return
+
+    Faults.latency = args.latency_ms / 1000.0
+    Faults.flood_rate, Faults.flood_sec = args.flood_rate, args.flood_sec
+    Faults.slowmode_rate, Faults.slowmode_sec = args.slowmode_rate, args.slowmode_sec
+    Faults.error_rate = args.error_rate
+    Faults.rng = random.Random(args.seed)
+    bc.UBOT.client_cls = FakeClient
+
+    asyncio.run(main_async(args))
+    if FAILED:
+        print(f"!! cek gagal: {', '.join(FAILED)}")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())